@@ -0,0 +1,57 @@
+# coding: utf-8
+"""
+Contention benchmark for the persistent generators: CentralizedGenerator vs DistributedGenerator.
+
+Runs many concurrent workers (threads), each with its own storage connection, and each
+generating the ids in a loop, as the web processes do. Reports the throughput, the number
+of failures (retries exhausted under contention), and the number of duplicate ids.
+
+Usage:
+    python generators_contention.py [mysql|sdb] [workers] [ids_per_worker]
+"""
+import sys
+import time
+import random
+import threading
+import settings
+from lib.daal.storages import MysqlStorage, SDBStorage, WrappedStorage, StorageExpectationError
+from lib.generators import CentralizedGenerator, DistributedGenerator
+
+
+def make_storage(backend, host):
+    if backend == 'mysql':
+        storage = MysqlStorage(settings.MYSQL_HOSTNAME, settings.MYSQL_USERNAME, settings.MYSQL_PASSWORD, settings.MYSQL_DATABASE, 'sequences')
+    else:
+        storage = SDBStorage(settings.AWS_ACCESS_KEY, settings.AWS_SECRET_KEY, 'sequences')
+    return WrappedStorage(storage, host=host)
+
+def worker(make_generator, n, ids, failures):
+    generator = make_generator()
+    for i in xrange(n):
+        try:
+            ids.append(generator.generate())
+        except StorageExpectationError, e:
+            failures.append(e)
+
+def bench(name, make_generator, workers, n):
+    ids = []
+    failures = []
+    threads = [threading.Thread(target=worker, args=(make_generator, n, ids, failures)) for i in xrange(workers)]
+    ts = time.time()
+    for thread in threads: thread.start()
+    for thread in threads: thread.join()
+    td = time.time() - ts
+    print('%-12s workers=%d ids=%d failures=%d duplicates=%d time=%.2fs rate=%.1f ids/s' % (
+        name, workers, len(ids), len(failures), len(ids) - len(set(ids)), td, len(ids) / td))
+
+def main():
+    backend = sys.argv[1] if len(sys.argv) > 1 else 'mysql'
+    workers = int(sys.argv[2]) if len(sys.argv) > 2 else 50
+    n = int(sys.argv[3]) if len(sys.argv) > 3 else 100
+    host = 'bench-%s-%d' % (time.strftime('%Y%m%d%H%M%S'), random.randint(0, 1000000))
+
+    bench('centralized', lambda: CentralizedGenerator(make_storage(backend, host), id='centralized'), workers, n)
+    bench('distributed', lambda: DistributedGenerator(make_storage(backend, host), id='distributed', pool_size=10, part_length=2), workers, n)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,53 @@
+# coding: utf-8
+"""
+Memory & speed benchmark for the url items: dict-based URL vs. slots-based URLRecord.
+
+Measures the memory per object (the object itself plus its dict, if any; the values are
+shared by all the objects, so they are not counted), and the time of construction from
+a row as the storages return it, of attribute access, and of conversion to a dict.
+
+Usage:
+    python item_records.py [count]
+"""
+import sys
+import time
+from lib.url import URL, URLRecord
+
+ROW = {'id': u'abc', 'host': u'example.com', 'code': u'abc', 'url': u'http://example.com/some/long/path?query=1',
+       'created_ts': 1300000000, 'remote_addr': u'127.0.0.1', 'remote_port': 12345}
+
+
+def size_of(obj):
+    size = sys.getsizeof(obj)
+    if hasattr(obj, '__dict__'):
+        size += sys.getsizeof(obj.__dict__)
+    return size
+
+def timed(fn, n):
+    ts = time.time()
+    fn(n)
+    return (time.time() - ts) / n * 1000000 # microseconds per object.
+
+def bench(name, cls, n):
+    objects = [cls(**ROW) for i in xrange(1000)]
+    def construct(n):
+        for i in xrange(n):
+            cls(**ROW)
+    def access(n):
+        obj = objects[0]
+        for i in xrange(n):
+            obj.url; obj.code; obj.created_ts
+    def convert(n):
+        obj = objects[0]
+        for i in xrange(n):
+            dict(obj.items())
+    print('%-10s size=%4d bytes  construct=%.2fus  access(3 fields)=%.2fus  dict(items())=%.2fus' % (
+        name, size_of(objects[0]), timed(construct, n), timed(access, n), timed(convert, n)))
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    bench('URL', URL, n)
+    bench('URLRecord', URLRecord, n)
+
+if __name__ == '__main__':
+    main()
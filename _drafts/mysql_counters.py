@@ -0,0 +1,125 @@
+# coding: utf-8
+"""
+Benchmark for the row lock hold time of MysqlStorage.increment() & append() under concurrent
+registration of the urls (as PopularDomainsDimension.register() does: increment the domain
+counter, and sometimes append the domain to the grid level and increment the level counter).
+
+Compares two patterns of the same queries:
+    * "fetch":  INSERT ... ON DUPLICATE KEY UPDATE, then SELECT of the row, then COMMIT
+                (the row lock is held for two round-trips; this is how it was done before);
+    * "single": INSERT ... ON DUPLICATE KEY UPDATE which remembers the new value in the connection
+                (LAST_INSERT_ID(expr) or a user variable), then COMMIT (the lock is held for one
+                round-trip); the value of a user variable is read after the commit, with no lock.
+
+The lock hold time is measured on the client, from the start of the INSERT till the end of
+the COMMIT. The registrations use a small set of hot domains, so the threads do contend.
+The tables are dropped after the benchmark.
+
+Usage:
+    python mysql_counters.py [threads] [registrations per thread] [domains]
+"""
+import sys
+import time
+import random
+import threading
+import settings
+import MySQLdb
+from lib.daal.storages import MysqlStorage, MysqlPool
+
+TABLE_COUNTERS = 'bench_counters'
+TABLE_LISTS = 'bench_lists'
+
+
+def make_storage(table, size):
+    pool = MysqlPool.get(settings.MYSQL_HOSTNAME, settings.MYSQL_USERNAME, settings.MYSQL_PASSWORD, settings.MYSQL_DATABASE, size=size)
+    return MysqlStorage(settings.MYSQL_HOSTNAME, settings.MYSQL_USERNAME, settings.MYSQL_PASSWORD, settings.MYSQL_DATABASE, table, pool=pool)
+
+def locked(storage, timings, inserts, updates, values, read):
+    """
+    Executes the counter query, reads the new value in one of the ways, and records the lock hold time.
+    """
+    with storage._connected() as connection:
+        query = "INSERT INTO %s SET %s ON DUPLICATE KEY UPDATE %s" % (storage.name, inserts, updates)
+        cursor = connection.cursor(MySQLdb.cursors.DictCursor)
+        ts = time.time()
+        cursor.execute(query, values)
+        if read == 'fetch':
+            cursor.execute("SELECT value FROM %s WHERE id=%%(id)s" % storage.name, values)
+            value = cursor.fetchone()['value']
+        elif read == 'insert_id':
+            value = connection.insert_id()
+        connection.commit()
+        timings.append(time.time() - ts)
+        if read == 'variable':
+            cursor.execute("SELECT @daal_append AS value")
+            value = cursor.fetchone()['value']
+        return value
+
+def increment(storage, timings, id, step, fetch):
+    if fetch:
+        return locked(storage, timings, 'id=%%(id)s,value=%d' % step, 'value=value+%d' % step, dict(id=id), 'fetch')
+    else:
+        return locked(storage, timings, 'id=%%(id)s,value=LAST_INSERT_ID(%d)' % step, 'value=LAST_INSERT_ID(value+%d)' % step, dict(id=id), 'insert_id')
+
+def append(storage, timings, id, value, fetch):
+    if fetch:
+        return locked(storage, timings, 'id=%(id)s,value=%(value)s', 'value=concat(value, %(value)s)', dict(id=id, value=value), 'fetch')
+    else:
+        return locked(storage, timings, 'id=%(id)s,value=(@daal_append:=%(value)s)', 'value=(@daal_append:=concat(value, %(value)s))', dict(id=id, value=value), 'variable')
+
+def register(counters, lists, timings, domains, fetch):
+    domain = random.choice(domains)
+    value = increment(counters, timings, domain, 1, fetch)
+    if value in (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000):
+        append(lists, timings, 'level%d' % value, ':::' + domain, fetch)
+        increment(counters, timings, 'level%d' % value, 1, fetch)
+
+def setup():
+    connection = MySQLdb.connect(host=settings.MYSQL_HOSTNAME, user=settings.MYSQL_USERNAME, passwd=settings.MYSQL_PASSWORD, db=settings.MYSQL_DATABASE)
+    cursor = connection.cursor()
+    for table, value in [(TABLE_COUNTERS, "integer not null default 0"), (TABLE_LISTS, "mediumtext not null default ''")]:
+        cursor.execute("DROP TABLE IF EXISTS %s" % table)
+        cursor.execute("CREATE TABLE %s (id varchar(255) not null primary key, value %s) engine=innodb" % (table, value))
+    connection.commit()
+    return connection
+
+def teardown(connection):
+    cursor = connection.cursor()
+    for table in [TABLE_COUNTERS, TABLE_LISTS]:
+        cursor.execute("DROP TABLE IF EXISTS %s" % table)
+    connection.commit()
+
+def run(fetch, threads, registrations, domains):
+    connection = setup()
+    try:
+        counters = make_storage(TABLE_COUNTERS, threads)
+        lists = make_storage(TABLE_LISTS, threads)
+        timings = []
+        def worker():
+            for i in xrange(registrations):
+                register(counters, lists, timings, domains, fetch)
+        workers = [threading.Thread(target=worker) for i in xrange(threads)]
+        ts = time.time()
+        for thread in workers: thread.start()
+        for thread in workers: thread.join()
+        duration = time.time() - ts
+        timings.sort()
+        return dict(
+            throughput = threads * registrations / duration,
+            lock_avg = sum(timings) / len(timings) * 1000,
+            lock_p99 = timings[int(len(timings) * 0.99)] * 1000,
+        )
+    finally:
+        teardown(connection)
+
+def main():
+    threads = int(sys.argv[1]) if len(sys.argv) > 1 else 16
+    registrations = int(sys.argv[2]) if len(sys.argv) > 2 else 1000
+    domains = ['domain%d.com' % i for i in xrange(int(sys.argv[3]) if len(sys.argv) > 3 else 20)]
+    print('%8s %14s %14s %14s' % ('pattern', 'regs/sec', 'lock avg, ms', 'lock p99, ms'))
+    for name, fetch in [('fetch', True), ('single', False)]:
+        result = run(fetch, threads, registrations, domains)
+        print('%8s %14.1f %14.3f %14.3f' % (name, result['throughput'], result['lock_avg'], result['lock_p99']))
+
+if __name__ == '__main__':
+    main()
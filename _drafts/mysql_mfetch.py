@@ -0,0 +1,74 @@
+# coding: utf-8
+"""
+Benchmark for the strategies of MysqlStorage.mfetch() over the growing number of ids,
+to find the crossover points for the automatic choice (mfetch_chunk & mfetch_temp_threshold).
+
+Creates a table with compound primary key, as for the popular domains counters
+(host, time_shard, domain), fills it with the rows, and fetches random subsets of them
+(with half of the ids absent) with each of the strategies. Prints the time per query.
+The table is dropped after the benchmark.
+
+Usage:
+    python mysql_mfetch.py [max_ids] [rows]
+"""
+import sys
+import time
+import random
+import settings
+import MySQLdb
+from lib.daal.storages import MysqlStorage, WrappedStorage
+from lib.dimensions.popular_domains import DomainCounterID
+
+TABLE = 'bench_mfetch'
+STRATEGIES = ['or', 'in', 'chunks', 'temp']
+COUNTS = [1000, 2000, 5000, 10000, 20000, 50000, 100000]
+
+
+def make_storage(strategy):
+    storage = MysqlStorage(settings.MYSQL_HOSTNAME, settings.MYSQL_USERNAME, settings.MYSQL_PASSWORD, settings.MYSQL_DATABASE, TABLE,
+                           mfetch_strategy=strategy)
+    return WrappedStorage(storage, host='bench')
+
+def make_id(index):
+    return DomainCounterID(time_shard=index % 30, domain='domain%d.com' % index)
+
+def setup(rows):
+    connection = MySQLdb.connect(host=settings.MYSQL_HOSTNAME, user=settings.MYSQL_USERNAME, passwd=settings.MYSQL_PASSWORD, db=settings.MYSQL_DATABASE)
+    cursor = connection.cursor()
+    cursor.execute("DROP TABLE IF EXISTS %s" % TABLE)
+    cursor.execute("""CREATE TABLE %s (
+        host varchar(100) not null, time_shard integer unsigned not null, domain varchar(255) not null,
+        value integer unsigned not null default 0, primary key (host, time_shard, domain)) engine=innodb""" % TABLE)
+    connection.commit()
+    storage = make_storage(None)
+    for offset in xrange(0, rows, 10000):
+        storage.mstore([(make_id(index), {'value': index}) for index in xrange(offset, min(rows, offset + 10000))])
+    return connection
+
+def teardown(connection):
+    connection.cursor().execute("DROP TABLE IF EXISTS %s" % TABLE)
+    connection.commit()
+
+def main():
+    max_ids = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    rows = int(sys.argv[2]) if len(sys.argv) > 2 else 200000
+    connection = setup(rows)
+    try:
+        print('%8s %s' % ('ids', ' '.join(['%10s' % strategy for strategy in STRATEGIES])))
+        for count in [count for count in COUNTS if count <= max_ids]:
+            ids = [make_id(random.randint(0, rows * 2)) for i in xrange(count)] # half of them are absent.
+            timings = []
+            for strategy in STRATEGIES:
+                if strategy == 'or' and count > 20000:
+                    timings.append('%10s' % 'skipped') # takes minutes, and proves nothing new.
+                    continue
+                storage = make_storage(strategy)
+                ts = time.time()
+                storage.mfetch(ids)
+                timings.append('%9.3fs' % (time.time() - ts))
+            print('%8d %s' % (count, ' '.join(timings)))
+    finally:
+        teardown(connection)
+
+if __name__ == '__main__':
+    main()
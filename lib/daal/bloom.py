@@ -0,0 +1,82 @@
+# coding: utf-8
+import hashlib
+import math
+import os
+import struct
+
+__all__ = ['BloomFilter']
+
+
+class BloomFilter(object):
+    """
+    Probabilistic set of strings: it can tell that the key is definitely not in the set,
+    or that it is probably in the set (with the false positive rate specified). The keys
+    cannot be removed, and the filter cannot be enumerated; it only answers the lookups.
+
+    The filter is sized for the expected capacity: if more keys are added, it still works,
+    but the false positive rate grows (see error_rate() for the estimated current rate).
+
+    The filter can be saved to a file and loaded back, so that the processes do not rebuild
+    it from the storage on every start. The file is written atomically (via rename).
+    """
+
+    MAGIC = 'BLM1'
+    HEADER = struct.Struct('<4sQIQ') # magic, size in bits, number of hashes, number of keys.
+
+    def __init__(self, capacity=100000, error_rate=0.01, size=None, hashes=None, bits=None, count=0):
+        super(BloomFilter, self).__init__()
+        capacity = max(1, capacity)
+        self.size = size or int(math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hashes = hashes or max(1, int(round(float(self.size) / capacity * math.log(2))))
+        self.bits = bits if bits is not None else bytearray((self.size + 7) // 8)
+        self.count = count
+
+    def add(self, key):
+        for position in self._positions(key):
+            self.bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def __contains__(self, key):
+        for position in self._positions(key):
+            if not self.bits[position >> 3] & (1 << (position & 7)):
+                return False
+        return True
+
+    def __len__(self):
+        return self.count
+
+    def error_rate(self):
+        """
+        Estimated false positive rate for the number of keys added so far.
+        """
+        return (1.0 - math.exp(-float(self.hashes) * self.count / self.size)) ** self.hashes
+
+    def capacity(self, error_rate=0.01):
+        """
+        Number of keys the filter can hold with the specified false positive rate.
+        """
+        return int(self.size * math.log(2) ** 2 / -math.log(error_rate))
+
+    def save(self, path):
+        temp_path = '%s.%s.tmp' % (path, os.getpid())
+        with open(temp_path, 'wb') as f:
+            f.write(self.HEADER.pack(self.MAGIC, self.size, self.hashes, self.count))
+            f.write(self.bits)
+        os.rename(temp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        with open(path, 'rb') as f:
+            magic, size, hashes, count = cls.HEADER.unpack(f.read(cls.HEADER.size))
+            if magic != cls.MAGIC:
+                raise ValueError("File %s is not a bloom filter." % path)
+            bits = bytearray(f.read())
+        if len(bits) != (size + 7) // 8:
+            raise ValueError("File %s is truncated." % path)
+        return cls(size=size, hashes=hashes, bits=bits, count=count)
+
+    def _positions(self, key):
+        # Double hashing: k positions from two 64-bit halves of one digest (Kirsch & Mitzenmacher).
+        digest = hashlib.md5(key.encode('utf-8') if isinstance(key, unicode) else key).digest()
+        h1, h2 = struct.unpack('<QQ', digest)
+        return [(h1 + i * h2) % self.size for i in xrange(self.hashes)]
@@ -0,0 +1,121 @@
+# coding: utf-8
+import mmap
+import os
+import struct
+
+__all__ = ['CDB', 'CDBWriter']
+
+
+def cdb_hash(key):
+    h = 5381
+    for c in key:
+        h = (((h << 5) + h) & 0xffffffff) ^ ord(c)
+    return h
+
+
+class CDBWriter(object):
+    """
+    Writer of the constant database files (cdb format by D. J. Bernstein): the key-value
+    pairs are written once, and the file is only read after that. The file is written to
+    a temporary one, and is renamed to the path on finish(), so the readers never see
+    a partial file, and the file can be replaced while the old one is still being read.
+
+    The format: 256 (position, length) pairs of the hash tables, then the records as
+    (key length, data length, key, data), then the hash tables of (hash, record position)
+    slots with open addressing. All numbers are little-endian 32-bit, so the file is 4GB max.
+    """
+
+    def __init__(self, path):
+        super(CDBWriter, self).__init__()
+        self.path = path
+        self.temp_path = '%s.%s.tmp' % (path, os.getpid())
+        self.file = open(self.temp_path, 'wb')
+        self.file.seek(2048)
+        self.position = 2048
+        self.tables = [[] for i in xrange(256)] # (hash, position) of the records.
+
+    def add(self, key, data):
+        """
+        Adds the record. Both the key and the data must be byte strings.
+        Adding the same key twice keeps both records; the first one is found by the readers.
+        """
+        self.file.write(struct.pack('<II', len(key), len(data)))
+        self.file.write(key)
+        self.file.write(data)
+        h = cdb_hash(key)
+        self.tables[h & 255].append((h, self.position))
+        self._advance(8 + len(key) + len(data))
+
+    def finish(self):
+        header = []
+        for table in self.tables:
+            # Tables are twice as long as the number of records, so the probes are short.
+            length = len(table) * 2
+            slots = [(0, 0)] * length
+            for h, position in table:
+                slot = (h >> 8) % length
+                while slots[slot][1]:
+                    slot = (slot + 1) % length
+                slots[slot] = (h, position)
+            header.append(struct.pack('<II', self.position, length))
+            self.file.write(''.join([struct.pack('<II', h, position) for h, position in slots]))
+            self._advance(8 * length)
+
+        self.file.seek(0)
+        self.file.write(''.join(header))
+        self.file.close()
+        os.rename(self.temp_path, self.path)
+
+    def abort(self):
+        self.file.close()
+        os.unlink(self.temp_path)
+
+    def _advance(self, length):
+        self.position += length
+        if self.position > 0xffffffff:
+            raise ValueError("Constant database %s is bigger than 4GB." % self.path)
+
+
+class CDB(object):
+    """
+    Reader of the constant database files (see CDBWriter). The file is memory-mapped, so the
+    lookups are the page cache reads with no system calls, and the data is returned as the
+    byte strings sliced from the mapping, with no deserialization of any kind.
+
+    The reader can be shared by the threads: it has no state except the mapping itself.
+    If the file is replaced with a new one, the reader keeps reading the old one until closed.
+    """
+
+    def __init__(self, path):
+        super(CDB, self).__init__()
+        self.path = path
+        with open(path, 'rb') as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            stat = os.fstat(f.fileno())
+            self.inode = stat.st_ino
+            self.mtime = stat.st_mtime
+        self.header = struct.unpack('<512I', self.map[:2048])
+
+    def get(self, key, default=None):
+        h = cdb_hash(key)
+        position, length = self.header[(h & 255) * 2], self.header[(h & 255) * 2 + 1]
+        if not length:
+            return default
+
+        slot = (h >> 8) % length
+        for probe in xrange(length):
+            slot_hash, record = struct.unpack_from('<II', self.map, position + slot * 8)
+            if not record:
+                return default
+            if slot_hash == h:
+                key_length, data_length = struct.unpack_from('<II', self.map, record)
+                if key_length == len(key) and self.map[record+8:record+8+key_length] == key:
+                    return self.map[record+8+key_length:record+8+key_length+data_length]
+            slot = (slot + 1) % length
+        return default
+
+    def __len__(self):
+        return sum(self.header[1::2]) // 2
+
+    def close(self):
+        self.map.close()
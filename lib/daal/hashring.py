@@ -0,0 +1,55 @@
+# coding: utf-8
+import bisect
+import hashlib
+import struct
+
+__all__ = ['HashRing']
+
+
+class HashRing(object):
+    """
+    Consistent hashing of the keys to the nodes (e.g., cache servers or storage shards).
+    Each node is placed on the ring at many points (replicas), and the key belongs to the
+    node of the first point after the key's hash. When a node is added or removed, only
+    the keys of its own points move (about 1/N of all keys), not all of them as with modulo.
+
+    More replicas spread the keys more evenly, but make the ring bigger; 100 replicas per
+    node give a few percent of deviation, which is fine for a handful of nodes.
+    """
+
+    def __init__(self, nodes=(), replicas=100):
+        super(HashRing, self).__init__()
+        self.replicas = replicas
+        self.points = [] # sorted hashes of all the points of all the nodes.
+        self.owners = {} # point hash -> node
+        for node in nodes:
+            self.add(node)
+
+    def add(self, node):
+        for replica in xrange(self.replicas):
+            point = self._hash('%s#%d' % (node, replica))
+            if point not in self.owners:
+                bisect.insort(self.points, point)
+            self.owners[point] = node
+
+    def remove(self, node):
+        for replica in xrange(self.replicas):
+            point = self._hash('%s#%d' % (node, replica))
+            if self.owners.get(point) == node:
+                del self.owners[point]
+                self.points.pop(bisect.bisect_left(self.points, point))
+
+    def nodes(self):
+        return sorted(set(self.owners.values()))
+
+    def get(self, key):
+        """
+        Returns the node the key belongs to, or None if there are no nodes at all.
+        """
+        if not self.points:
+            return None
+        index = bisect.bisect(self.points, self._hash(key)) % len(self.points)
+        return self.owners[self.points[index]]
+
+    def _hash(self, key):
+        return struct.unpack('>I', hashlib.md5(key.encode('utf-8') if isinstance(key, unicode) else key).digest()[:4])[0]
@@ -1,4 +1,5 @@
 # coding: utf-8
+import operator
 
 class Item(dict):
     """
@@ -34,3 +35,79 @@ class Item(dict):
             self[name] = value
         else:
             raise AttributeError("Item %s has no attribute '%s'." % (self.__class__.__name__, name))
+
+
+class RecordType(type):
+    # Prepares the fast getter of all the field values at once, for each class of records.
+    def __init__(cls, name, bases, attrs):
+        super(RecordType, cls).__init__(name, bases, attrs)
+        getter = operator.attrgetter(*cls.fields) if cls.fields else (lambda obj: ())
+        cls._getvalues = staticmethod(getter if len(cls.fields) != 1 else (lambda obj: (getter(obj),)))
+
+
+class Record(object):
+    """
+    Compact alternative to Item for the items with a fixed set of fields, which are created
+    in masses and are mostly read (e.g., resolved urls, rows of analytical dimensions).
+    Descendants declare their fields in __slots__ (and the same in "fields" for the order),
+    so the records have no per-instance dict, and the attributes are accessed natively.
+
+    Records mimic the dict protocol just enough to be used as items: item['field'], get(),
+    keys(), values(), items(), update() and dict(record) all work, but only for the declared fields.
+    They are not dicts though, so JSON encoders need a hint to convert them (with items()).
+    """
+
+    __metaclass__ = RecordType
+    __slots__ = ()
+    fields = ()
+
+    def __init__(self, **kwargs):
+        super(Record, self).__init__()
+        for field in self.fields:
+            setattr(self, field, kwargs.get(field))
+
+    def __getitem__(self, name):
+        if name not in self.fields:
+            raise KeyError(name)
+        return getattr(self, name)
+
+    def __setitem__(self, name, value):
+        if name not in self.fields:
+            raise KeyError("Record %s has no field '%s'." % (self.__class__.__name__, name))
+        setattr(self, name, value)
+
+    def __contains__(self, name):
+        return name in self.fields
+
+    def __iter__(self):
+        # Same as Item does: iterates over (field, value) pairs, not over the field names.
+        return iter(self.items())
+
+    def __eq__(self, other):
+        # As dicts do, the records are equal to the mappings (records, items, dicts) with the same values only.
+        if not hasattr(other, 'items'):
+            return NotImplemented
+        return dict(self.items()) == dict(other.items())
+
+    def __ne__(self, other):
+        equal = self.__eq__(other)
+        return equal if equal is NotImplemented else not equal
+
+    def __repr__(self):
+        return '%s(%s)' % (self.__class__.__name__, ', '.join('%s=%r' % pair for pair in self.items()))
+
+    def get(self, name, default=None):
+        return getattr(self, name) if name in self.fields else default
+
+    def keys(self):
+        return list(self.fields)
+
+    def values(self):
+        return list(self._getvalues(self))
+
+    def items(self):
+        return zip(self.fields, self._getvalues(self))
+
+    def update(self, *args, **kwargs):
+        for name, value in dict(*args, **kwargs).items():
+            self[name] = value
@@ -0,0 +1,315 @@
+# coding: utf-8
+from .hashring import HashRing
+import SocketServer
+import socket
+import threading
+import time
+
+__all__ = ['MemcachedClient', 'MemcachedServer']
+
+
+class MemcachedClient(object):
+    """
+    Client of the memcached servers (text protocol), with the keys distributed over the servers
+    by consistent hashing (see HashRing), so adding or removing a server re-maps few keys only.
+
+    Multi-key operations are grouped per server and pipelined: the requests are sent to all
+    the servers first, and the responses are read after, so each operation takes one round-trip
+    no matter how many keys and servers are there.
+
+    The client is a cache client: the failures of the servers are not errors. The keys of the
+    failed server are just misses (and their writes are lost), and the server is not contacted
+    for a while (dead_retry), so that a dead server does not add its timeout to every request.
+
+    The connections are per thread (sockets are not thread-safe), so one client can be shared
+    by all the threads of the process. Keys and values are byte strings; the keys must obey
+    the protocol (no whitespace or control characters, 250 bytes max) - see MemcachedCache.
+    """
+
+    def __init__(self, servers, timeout=0.5, dead_retry=10, replicas=100):
+        super(MemcachedClient, self).__init__()
+        self.servers = list(servers) # as 'hostname:port'
+        self.timeout = timeout
+        self.dead_retry = dead_retry
+        self.ring = HashRing(self.servers, replicas=replicas)
+        self.local = threading.local() # server -> (socket, file) of the current thread.
+        self.lock = threading.Lock()
+        self.dead = {} # server -> timestamp until which it is not contacted.
+        self.counters = dict(gets=0, hits=0, misses=0, sets=0, deletes=0, errors=0)
+
+    def get_multi(self, keys):
+        """
+        Returns the dict of {key: (flags, value)} for the keys found on the servers.
+        """
+        values = {}
+        for server, conversation in self._converse(self._group(keys), self._send_get):
+            try:
+                values.update(conversation())
+            except (socket.error, EOFError, ValueError), e:
+                self._fail(server)
+        self._count(gets=len(keys), hits=len(values), misses=len(keys) - len(values))
+        return values
+
+    def get(self, key):
+        return self.get_multi([key]).get(key)
+
+    def set_multi(self, entries, ttl=None):
+        """
+        Stores the [(key, flags, value)] entries for ttl seconds (None means "never expires").
+        """
+        exptime = int(ttl + 0.999) if ttl else 0 # relative, since it is less than 30 days.
+        groups = {}
+        for key, flags, value in entries:
+            groups.setdefault(self.ring.get(key), []).append((key, flags, value))
+        for server, conversation in self._converse(groups, lambda connection, group: self._send_set(connection, group, exptime)):
+            try:
+                conversation()
+            except (socket.error, EOFError, ValueError), e:
+                self._fail(server)
+        self._count(sets=len(entries))
+
+    def set(self, key, flags, value, ttl=None):
+        self.set_multi([(key, flags, value)], ttl=ttl)
+
+    def delete(self, key):
+        for server, conversation in self._converse(self._group([key]), self._send_delete):
+            try:
+                conversation()
+            except (socket.error, EOFError, ValueError), e:
+                self._fail(server)
+        self._count(deletes=1)
+
+    def stats(self):
+        with self.lock:
+            return dict(self.counters,
+                servers = len(self.servers),
+                dead = len([server for server, until in self.dead.items() if until > time.time()]),
+            )
+
+    def _group(self, keys):
+        groups = {}
+        for key in keys:
+            groups.setdefault(self.ring.get(key), []).append(key)
+        return groups
+
+    def _converse(self, groups, send):
+        """
+        Sends the requests to all the servers first, and then yields the (server, read_function)
+        pairs to read the responses. Servers that are dead or fail while sending are skipped.
+        """
+        conversations = []
+        for server, group in groups.items():
+            if server is None or not self._alive(server):
+                continue
+            try:
+                conversations.append((server, send(self._socket(server), group)))
+            except socket.error, e:
+                self._fail(server)
+        return conversations
+
+    def _send_get(self, connection, keys):
+        sock, file = connection
+        sock.sendall('get %s\r\n' % ' '.join(keys))
+        def read():
+            values = {}
+            while True:
+                line = self._readline(file)
+                if line == 'END':
+                    return values
+                command, key, flags, length = line.split(' ')[:4]
+                if command != 'VALUE':
+                    raise ValueError("Unexpected response: %r" % line)
+                data = file.read(int(length) + 2)
+                if len(data) != int(length) + 2:
+                    raise EOFError("Connection closed while reading %s." % key)
+                values[key] = (int(flags), data[:-2])
+        return read
+
+    def _send_set(self, connection, entries, exptime):
+        sock, file = connection
+        sock.sendall(''.join(['set %s %d %d %d\r\n%s\r\n' % (key, flags, exptime, len(value), value) for key, flags, value in entries]))
+        def read():
+            for entry in entries:
+                line = self._readline(file)
+                if line not in ('STORED', 'NOT_STORED'):
+                    with self.lock:
+                        self.counters['errors'] += 1 # e.g., SERVER_ERROR object too large for cache.
+        return read
+
+    def _send_delete(self, connection, keys):
+        sock, file = connection
+        sock.sendall(''.join(['delete %s\r\n' % key for key in keys]))
+        def read():
+            for key in keys:
+                self._readline(file) # DELETED or NOT_FOUND; both are fine.
+        return read
+
+    def _readline(self, file):
+        line = file.readline()
+        if not line.endswith('\r\n'):
+            raise EOFError("Connection closed by the server.")
+        return line[:-2]
+
+    def _socket(self, server):
+        connections = self.local.__dict__.setdefault('connections', {})
+        if server not in connections:
+            hostname, port = server.rsplit(':', 1)
+            sock = socket.create_connection((hostname, int(port)), timeout=self.timeout)
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            connections[server] = (sock, sock.makefile('rb'))
+        return connections[server]
+
+    def _alive(self, server):
+        with self.lock:
+            return self.dead.get(server, 0) <= time.time()
+
+    def _fail(self, server):
+        # The connection is in unknown state now (partial responses can be there), so it is closed.
+        connection = self.local.__dict__.get('connections', {}).pop(server, None)
+        if connection is not None:
+            for closeable in reversed(connection):
+                try:
+                    closeable.close()
+                except socket.error, e:
+                    pass
+        with self.lock:
+            self.counters['errors'] += 1
+            self.dead[server] = time.time() + self.dead_retry
+
+    def _count(self, **counters):
+        with self.lock:
+            for name, value in counters.items():
+                self.counters[name] += value
+
+
+class MemcachedServer(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
+    """
+    Small in-process stand-in for the memcached server, for tests and development setups,
+    where there are no real servers around. It supports only what MemcachedClient uses plus
+    a few more commands (get, gets, set, add, replace, delete, flush_all, version, quit),
+    keeps everything in a dict, and never evicts anything except the expired entries.
+
+        server = MemcachedServer().start()
+        client = MemcachedClient([server.address])
+        ...
+        server.stop()
+    """
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, hostname='127.0.0.1', port=0):
+        SocketServer.TCPServer.__init__(self, (hostname, port), MemcachedHandler)
+        self.entries = {} # key -> (flags, value, expiration timestamp or None)
+        self.lock = threading.RLock()
+        self.thread = None
+        self.connections = set() # the sockets of the clients, to close them on stop().
+
+    @property
+    def address(self):
+        return '%s:%s' % self.server_address
+
+    def start(self):
+        self.thread = threading.Thread(target=self.serve_forever, kwargs=dict(poll_interval=0.05)) # for fast stop().
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+        with self.lock:
+            for connection in list(self.connections):
+                try:
+                    connection.shutdown(socket.SHUT_RDWR)
+                except socket.error, e:
+                    pass
+
+    def lookup(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[2] is not None and entry[2] <= time.time():
+                del self.entries[key]
+                entry = None
+            return entry
+
+    def store(self, command, key, flags, exptime, value):
+        if exptime > 30 * 24 * 3600: # absolute unix timestamp, as memcached treats it.
+            expires = exptime
+        else:
+            expires = time.time() + exptime if exptime else None
+        with self.lock:
+            exists = self.lookup(key) is not None
+            if (command == 'add' and exists) or (command == 'replace' and not exists):
+                return False
+            self.entries[key] = (flags, value, expires)
+            return True
+
+
+class MemcachedHandler(SocketServer.StreamRequestHandler):
+    """
+    One client connection of MemcachedServer: reads the commands and writes the responses.
+    """
+
+    def setup(self):
+        SocketServer.StreamRequestHandler.setup(self)
+        self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1) # responses are written in pieces.
+        with self.server.lock:
+            self.server.connections.add(self.connection)
+
+    def finish(self):
+        with self.server.lock:
+            self.server.connections.discard(self.connection)
+        SocketServer.StreamRequestHandler.finish(self)
+
+    def handle(self):
+        try:
+            self.converse()
+        except socket.error, e:
+            pass # the client has gone.
+
+    def converse(self):
+        while True:
+            line = self.rfile.readline()
+            if not line.endswith('\r\n'):
+                return
+            words = line[:-2].split()
+            if not words:
+                self.wfile.write('ERROR\r\n')
+                continue
+
+            command, args = words[0], words[1:]
+            noreply = bool(args) and args[-1] == 'noreply'
+            if noreply:
+                args = args[:-1]
+
+            if command in ('get', 'gets'):
+                for key in args:
+                    entry = self.server.lookup(key)
+                    if entry is not None:
+                        self.wfile.write('VALUE %s %d %d\r\n%s\r\n' % (key, entry[0], len(entry[1]), entry[1]))
+                response = 'END'
+            elif command in ('set', 'add', 'replace'):
+                key, flags, exptime, length = args[0], int(args[1]), int(args[2]), int(args[3])
+                data = self.rfile.read(length + 2)
+                if not data.endswith('\r\n'):
+                    response = 'CLIENT_ERROR bad data chunk'
+                else:
+                    stored = self.server.store(command, key, flags, exptime, data[:-2])
+                    response = 'STORED' if stored else 'NOT_STORED'
+            elif command == 'delete':
+                with self.server.lock:
+                    response = 'DELETED' if self.server.entries.pop(args[0], None) is not None else 'NOT_FOUND'
+            elif command == 'flush_all':
+                with self.server.lock:
+                    self.server.entries.clear()
+                response = 'OK'
+            elif command == 'version':
+                response = 'VERSION 1.4.0-standin'
+            elif command == 'quit':
+                return
+            else:
+                response = 'ERROR'
+
+            if not noreply:
+                self.wfile.write(response + '\r\n')
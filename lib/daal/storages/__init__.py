@@ -2,5 +2,13 @@
 from ._base import Storage, StorageID
 from ._base import StorageExpectationError, StorageItemAbsentError, StorageUniquenessError
 from .wrapped import WrappedStorage
+from .cached import CachedStorage, LRUCache
+from .memcached import MemcachedCache
 from .sdb import SDBStorage
-from .mysql import MysqlStorage
+from .mysql import MysqlStorage, MysqlPool, MysqlPoolExhaustedError, MysqlReplica
+from .guarded import GuardedStorage
+from .sqlite import SQLiteStorage
+from .snapshot import SnapshotStorage, export_snapshot
+from .writebehind import WriteBehindStorage
+from .instrumented import InstrumentedStorage, StorageMetrics, traced
+from .sharded import ShardedStorage, rebalance
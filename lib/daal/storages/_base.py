@@ -1,6 +1,7 @@
 # coding: utf-8
 import functools
 import itertools
+import threading
 
 __all__ = ['Storage', 'StorageItemAbsentError', 'StorageExpectationError', 'StorageUniquenessError']
 
@@ -10,6 +11,18 @@ class StorageUniquenessError(Exception): pass
 class StorageExpectationError(Exception): pass
 
 
+# Per-thread count of the repeated tries made by Storage.repeat() & Storage.mcreate(), i.e. of the
+# conditional writes which failed and were tried again. It only grows; the instrumentation (see
+# InstrumentedStorage) takes the difference around the operation, so nested operations are fine.
+REPEATS = threading.local()
+
+def count_repeats(count=1):
+    REPEATS.count = getattr(REPEATS, 'count', 0) + count
+
+def get_repeats():
+    return getattr(REPEATS, 'count', 0)
+
+
 class StorageID(object):
     """
     Storage ID is used to uniquely identify an item in the storage. In most cases it is
@@ -113,6 +126,8 @@ class Storage(object):
                 retries = retries - 1
                 return fn()
             except StorageExpectationError, e:
+                if retries > 0:
+                    count_repeats()
                 if retries <= 0:
                     if callable(exception):# includes types and classes
                         exception = exception(e)
@@ -159,6 +174,52 @@ class Storage(object):
         """
         return self.repeat(functools.partial(self.try_replace, id, fn, field), retries=retries)
 
+    def mcreate(self, factories, retries=1):
+        """
+        Creates many new items at once, one per factory, as create() does for one item.
+        Returns the list of results in the order of the factories: either the created item,
+        or an instance of StorageExpectationError if the item could not be created (e.g.,
+        due to id collision). The batch never fails as a whole because of single items.
+
+        The collisions are retried as in create(): the factories of the failed items are
+        called again (so they can generate new ids), but in batches too, not one by one.
+        """
+        results = [None] * len(factories)
+        pending = range(len(factories))
+        while retries > 0 and pending:
+            retries = retries - 1
+            outcomes = self.try_mcreate([factories[index] for index in pending])
+            for index, outcome in zip(pending, outcomes):
+                results[index] = outcome
+            pending = [index for index in pending if isinstance(results[index], StorageExpectationError)]
+            if retries > 0 and pending:
+                count_repeats(len(pending))
+        return results
+
+    def mstore(self, items):
+        """
+        Creates or updates many items at once, unconditionally (there is no fetch before).
+        Items are the sequence of (id, values) pairs; the values are merged into existing
+        items, if any. Returns the list of values stored, in the order of the items.
+        Storages that have no batch writes fall back to update() of each item.
+        """
+        return [self.update(id, lambda item, values=values: dict(values)) for id, values in items]
+
+    def mincrement(self, steps, retries=1):
+        """
+        Increments many counters at once. Steps are the sequence of (id, step) pairs.
+        Returns the list of results in the order of the steps: either the new value of
+        the counter, or an instance of StorageExpectationError if it could not be changed.
+        Storages that have no batch writes fall back to increment() of each counter.
+        """
+        results = []
+        for id, step in steps:
+            try:
+                results.append(self.increment(id, step, retries=retries))
+            except StorageExpectationError, e:
+                results.append(e)
+        return results
+
     def append(self, id, value, retries=1):
         raise NotImplementedError()
 
@@ -175,6 +236,16 @@ class Storage(object):
     def try_create(self, factory):
         raise NotImplementedError()
 
+    def try_mcreate(self, factories):
+        # Storages that have no batch writes fall back to single creates, but keep the protocol.
+        results = []
+        for factory in factories:
+            try:
+                results.append(self.try_create(factory))
+            except StorageExpectationError, e:
+                results.append(e)
+        return results
+
     def try_update(self, id, fn, field):
         raise NotImplementedError()
 
@@ -0,0 +1,285 @@
+# coding: utf-8
+from ._base import Storage, StorageID
+from ._base import StorageItemAbsentError, StorageExpectationError
+import collections
+import functools
+import threading
+import time
+
+__all__ = ['CachedStorage', 'LRUCache']
+
+
+# Marker for the items known to be absent in the cached storage (negative caching).
+ABSENT = object()
+
+
+class LRUCache(object):
+    """
+    Bounded in-memory cache with least-recently-used eviction and per-entry expiration.
+    It knows nothing about storages and items; it just maps keys to values for a while.
+
+    The cache is thread-safe, so one instance can be shared by all the storages (and
+    all the threads) of the process. This is the way to keep the cache warm when the
+    storages themselves are constructed and thrown away on each request.
+
+    The counters are kept for sizing the cache: hits & misses on lookups, evictions of
+    the least recently used entries due to size limit, and expirations due to ttl.
+    """
+
+    def __init__(self, size=10000, ttl=None):
+        super(LRUCache, self).__init__()
+        self.size = size
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.entries = collections.OrderedDict() # key -> (value, expiration timestamp or None)
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def get(self, key, default=None):
+        """
+        Returns the value of the key, or the default if it is not cached or has expired.
+        Every successful lookup makes the entry the most recently used one.
+        """
+        with self.lock:
+            try:
+                value, expires = self.entries.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+
+            if expires is not None and expires <= time.time():
+                self.expirations += 1
+                self.misses += 1
+                return default
+
+            self.entries[key] = (value, expires)
+            self.hits += 1
+            return value
+
+    def get_many(self, keys):
+        """
+        Returns the dict of {key: value} for the keys found in the cache (and not expired).
+        """
+        values = {}
+        for key in keys:
+            value = self.get(key)
+            if value is not None:
+                values[key] = value
+        return values
+
+    def put(self, key, value, ttl=None):
+        """
+        Puts the value to the cache, evicting the least recently used entries if necessary.
+        If ttl is not specified, the cache-wide one is used; None means "never expires".
+        """
+        ttl = ttl if ttl is not None else self.ttl
+        expires = time.time() + ttl if ttl is not None else None
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = (value, expires)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def put_many(self, entries, ttl=None):
+        for key, value in entries:
+            self.put(key, value, ttl=ttl)
+
+    def pop(self, key):
+        """
+        Removes the key from the cache, if it is there. Never fails.
+        """
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self):
+        with self.lock:
+            return {
+                'size': len(self.entries),
+                'limit': self.size,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'expirations': self.expirations,
+            }
+
+
+class CachedStorage(Storage):
+    """
+    Read-through caching layer, which proxies all calls to the wrapped storage, but
+    remembers the results of fetch() & mfetch() in an in-memory LRU cache for a while.
+
+    Absent items are cached too, but for a shorter time (absent_ttl), so that repeated
+    lookups of non-existent ids (404 scans) stop hitting the wrapped storage at all.
+    Newly created items are put to the cache immediately, so they resolve with no trip
+    to the wrapped storage. All other writes just drop the item from the cache.
+
+    The cache is keyed by unicode(StorageID(id)), so it must be placed under the wrapper
+    storages that alter the ids (e.g., WrappedStorage), if the cache is shared among them.
+    Note that the cache is process-local and knows nothing about the writes made by other
+    processes; this is fine for write-once items (urls), but not for counters.
+
+    The cache can also be a shared one (see MemcachedCache), with the same interface. Then the
+    cached storages can be stacked: the process-local cache over the shared one over the storage.
+    """
+
+    def __init__(self, storage, cache=None, ttl=300, absent_ttl=5, size=10000):
+        super(CachedStorage, self).__init__()
+        self.storage = storage
+        self.cache = cache if cache is not None else LRUCache(size=size)
+        self.ttl = ttl
+        self.absent_ttl = absent_ttl
+
+    def fetch(self, id):
+        key = self._key(id)
+        item = self.cache.get(key)
+        if item is ABSENT:
+            raise StorageItemAbsentError("The item '%s' is not found." % key)
+        elif item is not None:
+            return dict(item)
+
+        try:
+            item = self.storage.fetch(id)
+        except StorageItemAbsentError, e:
+            if self.absent_ttl:
+                self.cache.put(key, ABSENT, ttl=self.absent_ttl)
+            raise
+
+        self.cache.put(key, dict(item), ttl=self.ttl)
+        return item
+
+    def mfetch(self, ids):
+        # Serve what we can from the cache, and fetch only the rest of the ids.
+        # Items found in the cache as absent are just skipped, as mfetch() does.
+        # The cache is asked for all the ids at once (it can be remote; see MemcachedCache).
+        result = []
+        missing = []
+        cached = self.cache.get_many([self._key(id) for id in ids])
+        for id in ids:
+            item = cached.get(self._key(id))
+            if item is None:
+                missing.append(id)
+            elif item is not ABSENT:
+                result.append(dict(item))
+        if not missing:
+            return result
+
+        # Since mfetch() returns items with no ids, we match them to the ids by the fields.
+        # Items that cannot be matched are returned, but are not cached.
+        items = self.storage.mfetch(missing)
+        self.cache.put_many([(self._key(id), dict(item)) for id, item in self._match(missing, items)], ttl=self.ttl)
+        result.extend(items)
+        return result
+
+    def select(self, filters={}, sorters=[], limit=None):
+        return self.storage.select(filters=filters, sorters=sorters, limit=limit)
+
+    def store(self, id, value, expect=None, unique=None):
+        self.cache.pop(self._key(id))
+        return self.storage.store(id, value, expect=expect, unique=unique)
+
+    def create(self, factory, retries=1):
+        # Remember the ids as they were generated by the factory on every try (the last one is
+        # the successful one), since the wrapped storage can normalize or rewrite it in the item.
+        ids = []
+        @functools.wraps(factory)
+        def remembering_factory(*args, **kwargs):
+            result = factory(*args, **kwargs)
+            ids.append(result['id'])
+            return result
+
+        # The ids that collided exist in the storage, so they must not stay cached as absent.
+        try:
+            item = self.storage.create(remembering_factory, retries=retries)
+        except StorageExpectationError, e:
+            for id in ids:
+                self.cache.pop(self._key(id))
+            raise
+        for id in ids[:-1]:
+            self.cache.pop(self._key(id))
+        self.cache.put(self._key(ids[-1]), dict(item), ttl=self.ttl)
+        return item
+
+    def mcreate(self, factories, retries=1):
+        # Same as in create(), but the ids are remembered per factory (and per try).
+        ids = [None] * len(factories)
+        def remembering(index, factory):
+            @functools.wraps(factory)
+            def remembering_factory(*args, **kwargs):
+                result = factory(*args, **kwargs)
+                ids[index] = result['id']
+                return result
+            return remembering_factory
+
+        results = self.storage.mcreate([remembering(index, factory) for index, factory in enumerate(factories)], retries=retries)
+        for id, result in zip(ids, results):
+            if isinstance(result, dict):
+                self.cache.put(self._key(id), dict(result), ttl=self.ttl)
+            elif id is not None:
+                self.cache.pop(self._key(id)) # collided, so it exists (see create()).
+        return results
+
+    def mstore(self, items):
+        for id, values in items:
+            self.cache.pop(self._key(id))
+        return self.storage.mstore(items)
+
+    def mincrement(self, steps, retries=1):
+        for id, step in steps:
+            self.cache.pop(self._key(id))
+        return self.storage.mincrement(steps, retries=retries)
+
+    def update(self, id, fn, retries=1, field=None):
+        self.cache.pop(self._key(id))
+        return self.storage.update(id, fn, retries=retries, field=field)
+
+    def replace(self, id, fn, retries=1, field=None):
+        self.cache.pop(self._key(id))
+        return self.storage.replace(id, fn, retries=retries, field=field)
+
+    def append(self, id, value, retries=1):
+        self.cache.pop(self._key(id))
+        return self.storage.append(id, value, retries=retries)
+
+    def prepend(self, id, value, retries=1):
+        self.cache.pop(self._key(id))
+        return self.storage.prepend(id, value, retries=retries)
+
+    def increment(self, id, step, retries=1):
+        self.cache.pop(self._key(id))
+        return self.storage.increment(id, step, retries=retries)
+
+    def decrement(self, id, step, retries=1):
+        self.cache.pop(self._key(id))
+        return self.storage.decrement(id, step, retries=retries)
+
+    def stats(self):
+        return self.cache.stats()
+
+    def _key(self, id):
+        return unicode(StorageID(id))
+
+    def _match(self, ids, items):
+        """
+        Matches the items returned from mfetch() to the ids requested, by comparing
+        all the fields of the ids to the fields of the items (as unicode strings).
+        Yields (id, item) pairs for the items matched; others are silently ignored.
+        """
+        index = {}
+        for id in ids:
+            pk = tuple(sorted((field, unicode(value)) for field, value in dict(StorageID(id)).items()))
+            index[pk] = id
+        shapes = set(tuple(field for field, value in pk) for pk in index)
+        for item in items:
+            for shape in shapes:
+                if all(field in item for field in shape):
+                    pk = tuple((field, unicode(item[field])) for field in shape)
+                    if pk in index:
+                        yield index[pk], item
+                        break
@@ -0,0 +1,333 @@
+# coding: utf-8
+from ..bloom import BloomFilter
+from ._base import Storage, StorageID
+from ._base import StorageExpectationError, StorageItemAbsentError
+import fcntl
+import functools
+import os
+import threading
+import time
+
+__all__ = ['GuardedStorage']
+
+
+class GuardedStorage(Storage):
+    """
+    Existence guard, which proxies all calls to the wrapped storage, but keeps a bloom filter
+    of all the ids stored there. The lookups of the ids which are definitely absent (according
+    to the filter) fail immediately, with no trip to the wrapped storage (e.g., 404 scans).
+    The creations with the ids which probably exist are checked with a fetch before the write,
+    and fail as collisions without the write (which is much more expensive than a read).
+
+    The filter is built once from the wrapped storage (with select(), so the storage must be
+    wrapped to the host already), and is then saved to the file at the path specified. This is
+    a full scan of the storage, so it is done offline (see rebuild() & shortener_filters_builder.py),
+    never in the requests: until the file exists, the guard passes all the lookups through, and
+    checks for the file every check_interval seconds. All the ids stored later are added to the filter, and appended to the journal file next to it.
+    This is how the processes share the ids they have stored: before rejecting the lookup,
+    the guard reads the ids appended to the journal by other processes since its last read.
+    The journal is merged into the filter file periodically, and is started from scratch.
+
+    The files must be local to all the processes writing to the storage, so the guard must not
+    be used if the urls are created from few machines (unless the directory is shared somehow).
+
+    Note that the ids are keyed as unicode(StorageID(id)); the field to take the ids from when
+    building the filter from the items is configurable, since the wrappers can rewrite the ids.
+    """
+
+    def __init__(self, storage, path, field='id', error_rate=0.01, min_capacity=10000, journal_limit=1000000, check_interval=10):
+        super(GuardedStorage, self).__init__()
+        self.storage = storage
+        self.path = path
+        self.field = field
+        self.error_rate = error_rate
+        self.min_capacity = min_capacity
+        self.journal_limit = journal_limit # in bytes.
+        self.check_interval = check_interval
+        self.checked_ts = None
+        self.lock = threading.RLock()
+        self.bloom = None
+        self.journal = None # the file being read; re-opened when the journal is started from scratch.
+        self.offset = 0 # the position in the journal up to which the ids are added to the filter.
+        self.counters = dict(lookups=0, rejected=0, passed=0, unguarded=0, false_positives=0, prechecks=0, collisions=0)
+
+    def fetch(self, id):
+        key = self._key(id)
+        if not self._contains(key):
+            raise StorageItemAbsentError("The item '%s' is not found." % key)
+        try:
+            return self.storage.fetch(id)
+        except StorageItemAbsentError, e:
+            self._count('false_positives')
+            raise
+
+    def mfetch(self, ids):
+        ids = [id for id in ids if self._contains(self._key(id))]
+        return self.storage.mfetch(ids) if ids else []
+
+    def select(self, filters={}, sorters=[], limit=None):
+        return self.storage.select(filters=filters, sorters=sorters, limit=limit)
+
+    def create(self, factory, retries=1):
+        # Ids which are probably stored already are checked before the write, and are
+        # rejected as collisions (the storage then retries with a new id, if it can).
+        @functools.wraps(factory)
+        def guarded_factory(*args, **kwargs):
+            result = factory(*args, **kwargs)
+            key = self._key(result['id'])
+            if self._contains(key, count=False) and self.bloom is not None:
+                self._count('prechecks')
+                try:
+                    self.storage.fetch(result['id'])
+                except StorageItemAbsentError, e:
+                    pass
+                else:
+                    self._count('collisions')
+                    raise StorageExpectationError("Storage expecation failed.")
+            ids[:] = [result['id']]
+            return result
+
+        ids = []
+        item = self.storage.create(guarded_factory, retries=retries)
+        self._record([ids[0]])
+        return item
+
+    def mcreate(self, factories, retries=1):
+        # Same as in create(), but with no pre-checks: the batch writes are cheap per item.
+        ids = [None] * len(factories)
+        def remembering(index, factory):
+            @functools.wraps(factory)
+            def remembering_factory(*args, **kwargs):
+                result = factory(*args, **kwargs)
+                ids[index] = result['id']
+                return result
+            return remembering_factory
+
+        results = self.storage.mcreate([remembering(index, factory) for index, factory in enumerate(factories)], retries=retries)
+        self._record([id for id, result in zip(ids, results) if not isinstance(result, StorageExpectationError)])
+        return results
+
+    # All the writes below can create the items, so their ids are added to the filter.
+    # It is fine to add the ids which are not stored eventually: this is a false positive.
+
+    def store(self, id, value, expect=None, unique=None):
+        self._record([id])
+        return self.storage.store(id, value, expect=expect, unique=unique)
+
+    def update(self, id, fn, retries=1, field=None):
+        self._record([id])
+        return self.storage.update(id, fn, retries=retries, field=field)
+
+    def replace(self, id, fn, retries=1, field=None):
+        return self.storage.replace(id, fn, retries=retries, field=field)
+
+    def mstore(self, items):
+        self._record([id for id, values in items])
+        return self.storage.mstore(items)
+
+    def mincrement(self, steps, retries=1):
+        self._record([id for id, step in steps])
+        return self.storage.mincrement(steps, retries=retries)
+
+    def append(self, id, value, retries=1):
+        self._record([id])
+        return self.storage.append(id, value, retries=retries)
+
+    def prepend(self, id, value, retries=1):
+        self._record([id])
+        return self.storage.prepend(id, value, retries=retries)
+
+    def increment(self, id, step, retries=1):
+        self._record([id])
+        return self.storage.increment(id, step, retries=retries)
+
+    def decrement(self, id, step, retries=1):
+        self._record([id])
+        return self.storage.decrement(id, step, retries=retries)
+
+    def stats(self):
+        """
+        Returns the counters of the guard. The observed false positive rate is the share
+        of the absent ids which were not rejected by the filter (and cost a storage trip).
+        """
+        with self.lock:
+            absent = self.counters['false_positives'] + self.counters['rejected']
+            return dict(self.counters,
+                keys = self.bloom.count if self.bloom is not None else 0,
+                capacity = self.bloom.capacity(self.error_rate) if self.bloom is not None else 0,
+                estimated_fp_rate = self.bloom.error_rate() if self.bloom is not None else 0.0,
+                observed_fp_rate = float(self.counters['false_positives']) / absent if absent else 0.0,
+            )
+
+    def rebuild(self):
+        """
+        Builds the filter from scratch with all the ids of the wrapped storage, and saves it.
+        The filter is sized for twice as many ids as there are now, to have room for growth.
+
+        The storage is scanned with no lock, so the writers are not blocked for the scan. The ids
+        stored meanwhile are either in the scan, or in the journal (which is merged into the new
+        filter under the lock), or are recorded after it (to the new journal); none is lost.
+        """
+        items = self.storage.select()
+        bloom = BloomFilter(capacity=max(self.min_capacity, len(items) * 2), error_rate=self.error_rate)
+        for item in items:
+            bloom.add(self._key(item[self.field]))
+        with self.lock:
+            with self._locked(fcntl.LOCK_EX):
+                if os.path.exists(self.path + '.journal'):
+                    with open(self.path + '.journal') as f:
+                        for line in f:
+                            if line.endswith('\n'):
+                                bloom.add(line[:-1].decode('utf-8'))
+                self._restart(bloom)
+
+    def overfilled(self):
+        """
+        Checks if the filter has more ids than it was sized for, so it must be rebuilt (offline).
+        """
+        with self.lock:
+            return self._load() and self.bloom.error_rate() > self.error_rate * 2
+
+    def compact(self):
+        """
+        Merges the journal into the filter file, and starts the journal from scratch.
+        The overfilled filter is merged too; it is rebuilt with a bigger size offline (see overfilled()).
+        """
+        with self.lock:
+            if not self._load():
+                return
+            with self._locked(fcntl.LOCK_EX):
+                self._catch_up(locked=True) # including the entries appended while we were waiting for the lock.
+                self._restart(self.bloom)
+
+    def _key(self, id):
+        return unicode(StorageID(id))
+
+    def _count(self, name):
+        with self.lock:
+            self.counters[name] += 1
+
+    def _contains(self, key, count=True):
+        with self.lock:
+            if not self._load():
+                # There is no filter yet, so nothing is known to be absent.
+                if count:
+                    self.counters['lookups'] += 1
+                    self.counters['unguarded'] += 1
+                return True
+            found = key in self.bloom
+            if not found:
+                # Maybe other processes have just stored it; read what they have added.
+                self._catch_up()
+                found = key in self.bloom
+            if count:
+                self.counters['lookups'] += 1
+                self.counters['passed' if found else 'rejected'] += 1
+            return found
+
+    def _record(self, ids):
+        if not ids:
+            return
+        keys = [self._key(id) for id in ids]
+        with self.lock:
+            # The ids are journaled even if there is no filter yet, so that they are merged into it when it is built.
+            loaded = self._load()
+            with self._locked(fcntl.LOCK_SH):
+                with open(self.path + '.journal', 'a') as f:
+                    f.write(''.join([key.encode('utf-8') + '\n' for key in keys]))
+                    size = f.tell()
+            if loaded:
+                self._catch_up() # adds our ids to the filter, and the ids of others appended before.
+        if loaded and size > self.journal_limit:
+            self.compact()
+
+    def _load(self):
+        """
+        Loads the filter from the file, and opens the journal, unless they are loaded already.
+        Returns False if there is no file yet (see rebuild()); it is checked once per check_interval.
+        """
+        if self.bloom is not None:
+            return True
+        now = time.time()
+        if self.checked_ts is not None and now - self.checked_ts < self.check_interval:
+            return False
+        self.checked_ts = now
+        if not os.path.exists(self.path):
+            return False
+        with self._locked(fcntl.LOCK_SH):
+            self._reload()
+        self._catch_up()
+        return True
+
+    def _reload(self):
+        if self.journal is not None:
+            self.journal.close()
+        self.bloom = BloomFilter.load(self.path)
+        self.journal = self._open_journal()
+
+    def _catch_up(self, locked=False):
+        """
+        Adds the ids appended to the journal since the last read. If the journal has been
+        started from scratch by another process, the filter is re-loaded from its file first.
+        If the caller holds the exclusive lock already, it is not taken again (flock would wait
+        for itself, since the locks are per open file, not per process).
+        """
+        try:
+            current = os.stat(self.path + '.journal').st_ino
+        except OSError, e:
+            current = None
+        self.journal.seek(self.offset) # also resets the end-of-file state after the previous read.
+        while True:
+            line = self.journal.readline()
+            if not line.endswith('\n'): # incomplete lines are being written now; they will be re-read.
+                break
+            self.bloom.add(line[:-1].decode('utf-8'))
+            self.offset += len(line)
+        if current is not None and current != os.fstat(self.journal.fileno()).st_ino:
+            if locked:
+                self._reload()
+            else:
+                with self._locked(fcntl.LOCK_SH):
+                    self._reload()
+            self._catch_up(locked=locked)
+
+    def _restart(self, bloom):
+        # Must be called under the exclusive lock: the readers see either the old filter with
+        # the old journal, or the new filter with the new (empty) journal; never a mix of them.
+        bloom.save(self.path)
+        temp_path = '%s.journal.%s.tmp' % (self.path, os.getpid())
+        open(temp_path, 'w').close()
+        os.rename(temp_path, self.path + '.journal')
+        if self.journal is not None:
+            self.journal.close()
+        self.bloom = bloom
+        self.journal = self._open_journal()
+
+    def _open_journal(self):
+        # Opened for reading and appending, so that it is created if it does not exist yet.
+        self.offset = 0
+        return open(self.path + '.journal', 'a+')
+
+    def _locked(self, mode):
+        return FileLock(self.path + '.lock', mode)
+
+
+class FileLock(object):
+    """
+    Inter-process lock on a file (flock), either shared or exclusive.
+    """
+
+    def __init__(self, path, mode):
+        super(FileLock, self).__init__()
+        self.path = path
+        self.mode = mode
+        self.file = None
+
+    def __enter__(self):
+        self.file = open(self.path, 'a')
+        fcntl.flock(self.file.fileno(), self.mode)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        fcntl.flock(self.file.fileno(), fcntl.LOCK_UN)
+        self.file.close()
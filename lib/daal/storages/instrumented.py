@@ -0,0 +1,250 @@
+# coding: utf-8
+from ._base import Storage, StorageID, StorageItemAbsentError, get_repeats
+import bisect
+import collections
+import contextlib
+import logging
+import threading
+import time
+
+__all__ = ['InstrumentedStorage', 'StorageMetrics', 'traced']
+
+
+# Per-thread trace of the storage operations of the current request (see traced()).
+TRACES = threading.local()
+
+@contextlib.contextmanager
+def traced():
+    """
+    Collects the storage operations made by the current thread within the block, as a dict
+    of {'table.operation': {'calls': N, 'duration': seconds}}, e.g. for a request's profile.
+    Only the instrumented storages are traced; nested blocks share the outer trace.
+    """
+    trace = getattr(TRACES, 'trace', None)
+    if trace is not None:
+        yield trace
+        return
+
+    trace = TRACES.trace = {}
+    try:
+        yield trace
+    finally:
+        TRACES.trace = None
+
+
+def measure(value):
+    """
+    Approximate size of the payload in bytes (characters, actually): the lengths of the strings
+    and of the numbers as strings, over the dicts & lists. Cheap enough to be done on every call.
+    """
+    if isinstance(value, basestring):
+        return len(value)
+    elif isinstance(value, dict):
+        # Most of the values are strings; they are measured inline, since this is the hot path.
+        return sum([len(key) + (len(item) if isinstance(item, basestring) else measure(item)) for key, item in value.iteritems()])
+    elif isinstance(value, (list, tuple)):
+        return sum([measure(item) for item in value])
+    elif value is None or isinstance(value, Exception):
+        return 0
+    else:
+        return len(str(value))
+
+
+class StorageMetrics(object):
+    """
+    Process-wide aggregated metrics of the storage operations, per table and per operation:
+    the numbers of calls, errors, repeated tries (see Storage.repeat), items and payload bytes,
+    and the histogram of the latencies (with the percentiles estimated from it). The slowest
+    operations are also kept in a short log with their ids (see InstrumentedStorage).
+
+    The histogram has fixed buckets, so the metrics of any number of calls take fixed memory,
+    and the percentiles are precise up to the bucket (i.e., they are the buckets' upper bounds).
+    """
+
+    BUCKETS = [0.0001, 0.0002, 0.0005, 0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1, 2, 5, 10] # seconds; the last one is unbounded.
+    PERCENTILES = [50, 90, 99]
+
+    def __init__(self, slow_log_size=100):
+        super(StorageMetrics, self).__init__()
+        self.lock = threading.Lock()
+        self.operations = {} # (table, operation) -> counters.
+        self.slow = collections.deque(maxlen=slow_log_size)
+        self.started_ts = time.time()
+
+    def record(self, table, operation, duration, items=1, size=0, repeats=0, error=False):
+        bucket = bisect.bisect_left(self.BUCKETS, duration)
+        with self.lock:
+            counters = self.operations.get((table, operation))
+            if counters is None:
+                counters = self.operations[(table, operation)] = dict(calls=0, errors=0, repeats=0, items=0, bytes=0, duration=0.0, max=0.0, histogram=[0] * (len(self.BUCKETS) + 1))
+            counters['calls'] += 1
+            counters['errors'] += int(bool(error))
+            counters['repeats'] += repeats
+            counters['items'] += items
+            counters['bytes'] += size
+            counters['duration'] += duration
+            counters['max'] = max(counters['max'], duration)
+            counters['histogram'][bucket] += 1
+
+    def record_slow(self, table, operation, duration, ids):
+        with self.lock:
+            self.slow.append(dict(ts=time.time(), table=table, operation=operation, duration=duration, ids=ids))
+
+    def snapshot(self):
+        """
+        Returns all the metrics: {'tables': {table: {operation: {...}}}, 'slow': [...], 'since': ts}.
+        """
+        with self.lock:
+            slow = list(self.slow)
+        return dict(tables=self.tables(), slow=slow, since=self.started_ts)
+
+    def tables(self, table=None):
+        """
+        Returns the metrics as {table: {operation: {...}}}, or as {operation: {...}} of one table.
+        """
+        with self.lock:
+            operations = [(key, dict(counters, histogram=list(counters['histogram']))) for key, counters in self.operations.items() if table is None or key[0] == table]
+
+        tables = {}
+        for (name, operation), counters in operations:
+            histogram = counters.pop('histogram')
+            counters['avg'] = counters['duration'] / counters['calls']
+            for percentile in self.PERCENTILES:
+                counters['p%d' % percentile] = self._percentile(histogram, counters['calls'], percentile, counters['max'])
+            counters['histogram'] = dict([('<%s' % bound, count) for bound, count in zip(self.BUCKETS + ['inf'], histogram) if count])
+            tables.setdefault(name, {})[operation] = counters
+        return tables.get(table, {}) if table is not None else tables
+
+    def reset(self):
+        with self.lock:
+            self.operations = {}
+            self.slow.clear()
+            self.started_ts = time.time()
+
+    def _percentile(self, histogram, calls, percentile, maximum):
+        threshold = calls * percentile / 100.0
+        total = 0
+        for bound, count in zip(self.BUCKETS, histogram):
+            total += count
+            if total >= threshold:
+                return min(bound, maximum)
+        return maximum
+
+
+class InstrumentedStorage(Storage):
+    """
+    Instrumentation layer, which proxies all calls to the wrapped storage, and records the metrics
+    of every operation to the metrics (see StorageMetrics), under the name of the table: duration,
+    number of items (ids, steps, factories), payload size (of the values written and read), and
+    the repeated tries of the conditional writes. The operations are also added to the trace of
+    the current request, if any (see traced()).
+
+    The operations slower than slow_threshold seconds are logged (to 'shortener.storages.slow')
+    with their ids, and are kept in the slow log of the metrics; None disables this.
+
+    It is placed right over the backend, so that only the real trips to the backend are measured,
+    not the cache hits; and under the wrappers that alter the ids, so the table name is enough.
+    """
+
+    logger = logging.getLogger('shortener.storages.slow')
+
+    MAX_LOGGED_IDS = 10
+
+    def __init__(self, storage, metrics, table=None, slow_threshold=None):
+        super(InstrumentedStorage, self).__init__()
+        self.storage = storage
+        self.metrics = metrics
+        self.table = table or getattr(storage, 'name', None) or storage.__class__.__name__
+        self.slow_threshold = slow_threshold
+
+    def fetch(self, id):
+        return self._call('fetch', [id], None, lambda: self.storage.fetch(id))
+
+    def mfetch(self, ids):
+        return self._call('mfetch', ids, None, lambda: self.storage.mfetch(ids))
+
+    def select(self, filters={}, sorters=[], limit=None):
+        return self._call('select', [filters], None, lambda: self.storage.select(filters=filters, sorters=sorters, limit=limit))
+
+    def store(self, id, value, expect=None, unique=None):
+        return self._call('store', [id], value, lambda: self.storage.store(id, value, expect=expect, unique=unique))
+
+    def create(self, factory, retries=1):
+        return self._call('create', None, None, lambda: self.storage.create(factory, retries=retries))
+
+    def mcreate(self, factories, retries=1):
+        return self._call('mcreate', None, None, lambda: self.storage.mcreate(factories, retries=retries))
+
+    def update(self, id, fn, retries=1, field=None):
+        return self._call('update', [id], None, lambda: self.storage.update(id, fn, retries=retries, field=field))
+
+    def replace(self, id, fn, retries=1, field=None):
+        return self._call('replace', [id], None, lambda: self.storage.replace(id, fn, retries=retries, field=field))
+
+    def mstore(self, items):
+        return self._call('mstore', [id for id, values in items], [values for id, values in items], lambda: self.storage.mstore(items))
+
+    def mincrement(self, steps, retries=1):
+        return self._call('mincrement', [id for id, step in steps], None, lambda: self.storage.mincrement(steps, retries=retries))
+
+    def append(self, id, value, retries=1):
+        return self._call('append', [id], value, lambda: self.storage.append(id, value, retries=retries))
+
+    def prepend(self, id, value, retries=1):
+        return self._call('prepend', [id], value, lambda: self.storage.prepend(id, value, retries=retries))
+
+    def increment(self, id, step, retries=1):
+        return self._call('increment', [id], None, lambda: self.storage.increment(id, step, retries=retries))
+
+    def decrement(self, id, step, retries=1):
+        return self._call('decrement', [id], None, lambda: self.storage.decrement(id, step, retries=retries))
+
+    def stats(self):
+        return self.metrics.tables(self.table)
+
+    def _call(self, operation, ids, written, fn):
+        """
+        Calls the operation, and records its metrics. The ids are None for the creations:
+        they are taken from the items created (the factories generate them while trying).
+        """
+        repeats = get_repeats()
+        result = None
+        error = True
+        ts = time.time()
+        try:
+            result = fn()
+            error = False
+            return result
+        except StorageItemAbsentError, e:
+            error = False # this is a normal outcome of the lookups (e.g., 404s), not a failure.
+            raise
+        finally:
+            duration = time.time() - ts
+            if ids is None:
+                created = result if isinstance(result, list) else [result]
+                ids = [item['id'] for item in created if isinstance(item, dict) and 'id' in item]
+                items = len(created)
+            else:
+                items = len(ids)
+            self.metrics.record(self.table, operation, duration,
+                items = items,
+                size = (measure(written) if written is not None else 0) + measure(result),
+                repeats = get_repeats() - repeats,
+                error = error,
+            )
+            self._trace(operation, duration)
+            if self.slow_threshold is not None and duration >= self.slow_threshold:
+                self._log_slow(operation, duration, ids or [])
+
+    def _trace(self, operation, duration):
+        trace = getattr(TRACES, 'trace', None)
+        if trace is not None:
+            entry = trace.setdefault('%s.%s' % (self.table, operation), dict(calls=0, duration=0.0))
+            entry['calls'] += 1
+            entry['duration'] += duration
+
+    def _log_slow(self, operation, duration, ids):
+        logged = [id if isinstance(id, dict) else unicode(StorageID(id)) for id in ids[:self.MAX_LOGGED_IDS]]
+        more = len(ids) - len(logged)
+        self.metrics.record_slow(self.table, operation, duration, logged + (['... %d more' % more] if more else []))
+        self.logger.warning("Slow storage operation %s.%s took %.3fs for %d items: %s%s", self.table, operation, duration, len(ids), ', '.join(map(unicode, logged)), ' and %d more' % more if more else '')
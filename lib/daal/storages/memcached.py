@@ -0,0 +1,91 @@
+# coding: utf-8
+from ..memcached import MemcachedClient
+from .cached import ABSENT
+import hashlib
+import json
+import re
+
+__all__ = ['MemcachedCache']
+
+
+class MemcachedCache(object):
+    """
+    Shared cache on the memcached servers, with the same interface as LRUCache, so it can be
+    used by CachedStorage instead of (or under) the in-process one. Unlike the in-process cache,
+    it is shared by all the processes on all the nodes: one of them fetches the item from the
+    storage, and all the others resolve it from the cache, with no cold start of each process.
+
+    The values are kept as JSON (so they must be JSON-serializable; those which are not are
+    just not cached). The keys are prefixed with the namespace, and the keys which cannot be
+    used in the protocol as is (too long, or with whitespace) are replaced with their hashes.
+    The failures of the servers are misses; they never fail the storage operations.
+    """
+
+    FLAG_JSON = 0
+    FLAG_ABSENT = 1
+    UNSAFE_KEY = re.compile(r'[\x00-\x20\x7f]')
+
+    def __init__(self, servers=None, client=None, prefix='', ttl=None, timeout=0.5, dead_retry=10):
+        super(MemcachedCache, self).__init__()
+        self.client = client if client is not None else MemcachedClient(servers, timeout=timeout, dead_retry=dead_retry)
+        self.prefix = prefix
+        self.ttl = ttl
+
+    def get(self, key, default=None):
+        return self.get_many([key]).get(key, default)
+
+    def get_many(self, keys):
+        """
+        Returns the dict of {key: value} for the keys found in the cache (in one round-trip).
+        """
+        mapping = dict((self._key(key), key) for key in keys)
+        values = {}
+        for memcached_key, (flags, data) in self.client.get_multi(mapping.keys()).items():
+            try:
+                values[mapping[memcached_key]] = self._decode(flags, data)
+            except ValueError, e:
+                pass # broken or foreign entry; treated as a miss, and will be overwritten.
+        return values
+
+    def put(self, key, value, ttl=None):
+        self.put_many([(key, value)], ttl=ttl)
+
+    def put_many(self, entries, ttl=None):
+        """
+        Puts the [(key, value)] entries to the cache (in one round-trip).
+        If ttl is not specified, the cache-wide one is used; None means "never expires".
+        """
+        encoded = []
+        for key, value in entries:
+            try:
+                encoded.append((self._key(key),) + self._encode(value))
+            except (TypeError, ValueError), e:
+                pass # not serializable; it is just not cached.
+        if encoded:
+            self.client.set_multi(encoded, ttl=ttl if ttl is not None else self.ttl)
+
+    def pop(self, key):
+        self.client.delete(self._key(key))
+
+    def stats(self):
+        return self.client.stats()
+
+    def _key(self, key):
+        key = self.prefix + (key if isinstance(key, unicode) else unicode(key, 'utf-8'))
+        key = key.encode('utf-8')
+        if len(key) > 250 or self.UNSAFE_KEY.search(key):
+            key = self.prefix.encode('utf-8') + 'sha1:' + hashlib.sha1(key).hexdigest()
+        return key
+
+    def _encode(self, value):
+        if value is ABSENT:
+            return self.FLAG_ABSENT, ''
+        return self.FLAG_JSON, json.dumps(value, separators=(',', ':'))
+
+    def _decode(self, flags, data):
+        if flags == self.FLAG_ABSENT:
+            return ABSENT
+        elif flags == self.FLAG_JSON:
+            return json.loads(data)
+        else:
+            raise ValueError("Unknown flags %s." % flags)
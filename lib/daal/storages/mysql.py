@@ -5,8 +5,263 @@ from ..item import Item
 from ._base import Storage, StorageID
 from ._base import StorageExpectationError, StorageItemAbsentError, StorageUniquenessError
 import MySQLdb
+import MySQLdb.constants.CLIENT
+import collections
+import contextlib
+import itertools
+import threading
+import time
+
+__all__ = ['MysqlStorage', 'MysqlPool', 'MysqlPoolExhaustedError', 'MysqlReplica']
+
+
+class MysqlPoolExhaustedError(Exception): pass
+
+
+class MysqlPool(object):
+    """
+    Pool of MySQL connections, shared by all the storages of the process that connect
+    to the same server and database with the same credentials (see MysqlPool.get()).
+    The storages borrow the connections for one operation and return them back after,
+    so one request opens at most one connection per thread, not one per storage.
+
+    The size of the pool is limited: if all the connections are borrowed, the borrower
+    waits for one to be returned, and fails with an error after the timeout. Connections
+    idle for longer than the ping interval are checked before they are borrowed, and
+    re-opened if they are dead (e.g., closed by the server due to its wait_timeout).
+
+    The statistics on the waits and exhaustions are kept to size the pool properly.
+    """
+
+    pools = {} # (hostname, username, database) -> MysqlPool
+    lock = threading.Lock()
+
+    @classmethod
+    def get(cls, hostname, username, password, database, **kwargs):
+        """
+        Returns the process-wide pool for the server & database, creating it if necessary.
+        """
+        key = (hostname, username, database)
+        with cls.lock:
+            if key not in cls.pools:
+                cls.pools[key] = cls(hostname, username, password, database, **kwargs)
+            return cls.pools[key]
+
+    def __init__(self, hostname, username, password, database, size=10, timeout=5, ping_interval=10):
+        super(MysqlPool, self).__init__()
+        self.hostname = hostname
+        self.username = username
+        self.password = password
+        self.database = database
+        self.size = size
+        self.timeout = timeout
+        self.ping_interval = ping_interval
+        self.condition = threading.Condition()
+        self.local = threading.local() # the connection borrowed by the current thread, if any.
+        self.idle = [] # [(connection, timestamp when returned)]
+        self.opened = 0 # both idle and borrowed ones.
+        self.counters = dict(checkouts=0, connects=0, pings=0, reconnects=0, discards=0, waits=0, exhaustions=0)
+        self.wait_time = 0.0
+        self.wait_time_max = 0.0
+
+    def checkout(self):
+        """
+        Borrows a connection from the pool. It must be returned with checkin() after use.
+        """
+        ts_start = time.time()
+        connection = None
+        with self.condition:
+            self.counters['checkouts'] += 1
+            if not self.idle and self.opened >= self.size:
+                self.counters['waits'] += 1
+            while not self.idle and self.opened >= self.size:
+                remaining = self.timeout - (time.time() - ts_start)
+                if remaining <= 0:
+                    self.counters['exhaustions'] += 1
+                    raise MysqlPoolExhaustedError("All %s connections to %s are in use." % (self.size, self.hostname))
+                self.condition.wait(remaining)
+            if self.idle:
+                connection, returned_ts = self.idle.pop()
+            else:
+                self.opened += 1
+            duration = time.time() - ts_start
+            self.wait_time += duration
+            self.wait_time_max = max(self.wait_time_max, duration)
+
+        try:
+            if connection is None:
+                connection = self._connect()
+            elif time.time() - returned_ts > self.ping_interval:
+                connection = self._ping(connection)
+        except:
+            with self.condition:
+                self.opened -= 1
+                self.condition.notify()
+            raise
+        return connection
+
+    def checkin(self, connection, broken=False):
+        """
+        Returns the borrowed connection to the pool. Broken connections are closed and
+        forgotten (new ones will be opened instead when needed).
+        """
+        with self.condition:
+            if broken:
+                self.opened -= 1
+                self.counters['discards'] += 1
+                try:
+                    connection.close()
+                except MySQLdb.Error, e:
+                    pass
+            else:
+                self.idle.append((connection, time.time()))
+            self.condition.notify()
+
+    def stats(self):
+        with self.condition:
+            return dict(self.counters,
+                size = self.size,
+                opened = self.opened,
+                idle = len(self.idle),
+                wait_time = self.wait_time,
+                wait_time_max = self.wait_time_max,
+            )
+
+    def _ping(self, connection):
+        self.counters['pings'] += 1
+        try:
+            connection.ping()
+            return connection
+        except MySQLdb.Error, e:
+            self.counters['reconnects'] += 1
+            try:
+                connection.close()
+            except MySQLdb.Error, e:
+                pass
+            return self._connect()
+
+    def _connect(self):
+        self.counters['connects'] += 1
+        return MySQLdb.connect(host = self.hostname,
+                               user = self.username,
+                               passwd = self.password,
+                               db = self.database,
+                               client_flag = MySQLdb.constants.CLIENT.FOUND_ROWS)
+
+
+class MysqlReplica(object):
+    """
+    Read replica of the MySQL server, as seen by this process: the pool of connections to it,
+    and its health, which is shared by all the storages reading from it (see MysqlReplica.get()),
+    as the pools are. The health is:
+    * The latency of the reads, as exponentially weighted moving average (see succeeded()).
+    * The failures: the replica which failed to connect or to execute the query is considered
+      down for retry_interval seconds, and the reads go to other replicas or to the primary.
+    * The replication lag (Seconds_Behind_Master), checked every lag_interval seconds on use.
+      The replica with the replication stopped is not used until it is started again.
+      If the lag cannot be checked (e.g., no REPLICATION CLIENT privilege), it is unknown.
+    """
+
+    replicas = {} # (hostname, username, database) -> MysqlReplica
+    lock = threading.Lock()
+
+    @classmethod
+    def get(cls, hostname, username, password, database, **kwargs):
+        """
+        Returns the process-wide replica for the server & database, creating it if necessary.
+        """
+        key = (hostname, username, database)
+        with cls.lock:
+            if key not in cls.replicas:
+                cls.replicas[key] = cls(MysqlPool.get(hostname, username, password, database), **kwargs)
+            return cls.replicas[key]
+
+    def __init__(self, pool, retry_interval=10, lag_interval=5, decay=0.2):
+        super(MysqlReplica, self).__init__()
+        self.pool = pool
+        self.hostname = pool.hostname
+        self.retry_interval = retry_interval
+        self.lag_interval = lag_interval # None disables the checks (the lag is unknown then).
+        self.decay = decay
+        self.lock = threading.Lock()
+        self.checking = threading.Lock() # one check of the lag at a time; other threads do not wait for it.
+        self.latency = None
+        self.lag = None
+        self.stopped = False
+        self.down_until = None
+        self.checked_ts = None
+        self.counters = dict(reads=0, failures=0, lag_checks=0, lag_errors=0)
+
+    def available(self, max_lag=None):
+        """
+        Checks if the reads can go to the replica: it is not down, it replicates, and it does not lag
+        behind the primary for more than max_lag seconds (if known). Checks the lag first if it is due.
+        """
+        now = time.time()
+        if self.lag_interval is not None and (self.checked_ts is None or now - self.checked_ts >= self.lag_interval):
+            self.check_lag()
+        with self.lock:
+            if self.down_until is not None and now < self.down_until:
+                return False
+            if self.stopped:
+                return False
+            return max_lag is None or self.lag is None or self.lag <= max_lag
+
+    def succeeded(self, duration):
+        with self.lock:
+            self.counters['reads'] += 1
+            self.latency = duration if self.latency is None else self.latency + self.decay * (duration - self.latency)
+
+    def failed(self):
+        with self.lock:
+            self.counters['failures'] += 1
+            self.down_until = time.time() + self.retry_interval
+
+    def check_lag(self):
+        if not self.checking.acquire(False):
+            return # other thread is checking it right now.
+        try:
+            with self.lock:
+                if self.down_until is not None and time.time() < self.down_until:
+                    return
+                self.checked_ts = time.time()
+                self.counters['lag_checks'] += 1
+            connection = self.pool.checkout()
+            broken = False
+            try:
+                cursor = connection.cursor(MySQLdb.cursors.DictCursor)
+                cursor.execute("SHOW SLAVE STATUS")
+                status = cursor.fetchone()
+            except MySQLdb.OperationalError, e:
+                broken = True
+                self.failed()
+                return
+            except MySQLdb.Error, e:
+                status = None
+                with self.lock:
+                    self.counters['lag_errors'] += 1
+            finally:
+                self.pool.checkin(connection, broken=broken)
+            with self.lock:
+                lag = status.get('Seconds_Behind_Master') if status else None
+                self.stopped = bool(status) and lag is None # NULL lag means the replication is not running.
+                self.lag = lag
+        except (MySQLdb.OperationalError, MysqlPoolExhaustedError), e:
+            self.failed() # could not connect; the replica is not usable for reads either.
+        finally:
+            self.checking.release()
+
+    def stats(self):
+        with self.lock:
+            return dict(self.counters,
+                hostname = self.hostname,
+                latency = self.latency,
+                lag = self.lag,
+                stopped = self.stopped,
+                down = self.down_until is not None and time.time() < self.down_until,
+                pool = self.pool.stats(),
+            )
 
-__all__ = ['MysqlStorage']
 
 class MysqlStorage(Storage):
     """
@@ -16,17 +271,67 @@ class MysqlStorage(Storage):
     * Limit on number of predicates in WHERE IN query for multi-id fetch (20 max).
     * Limit on the lenght of an attribute (1024 chars max).
     * Others to come.
+
+    The reads (fetch, mfetch, select) can be spread over the read replicas of the server: each of
+    them is a hostname (with the same credentials and database) or a dict of the connection options
+    which differ. The replica is chosen per read, either in turn ("round-robin" balancing), or the
+    one with the lowest latency of the recent reads ("latency"); the replicas which are down, which
+    lag behind the primary for more than max_lag seconds, or which do not replicate at all, are
+    skipped (see MysqlReplica). If there are no replicas available, or the read fails there, the
+    read goes to the primary. Writes always go to the primary, and so do the reads made within the
+    writes (e.g., in try_update() and mincrement()), since they must see the rows being written.
+
+    Since the replicas are behind the primary, the reads of the items written by this storage
+    within read_your_writes seconds go to the primary (and select() goes there if anything was
+    written), so the code is resolved right after it is created. The items written by other
+    processes are not known here; so the items absent on the replica are looked up on the primary
+    too. This makes the misses (404s) cost two reads, but they are rare comparing to the hits.
     """
 
-    def __init__(self, hostname, username, password, database, name):
+    def __init__(self, hostname, username, password, database, name, pool=None,
+                 mfetch_strategy=None, mfetch_chunk=1000, mfetch_temp_threshold=20000,
+                 replicas=None, balancing='round-robin', max_lag=None, read_your_writes=5, max_recent=10000):
         super(MysqlStorage, self).__init__()
-        self.connection = None
-        self.connected = False
         self.hostname = hostname
         self.username = username
         self.password = password
         self.database = database
         self.name = name
+        self.pool = pool or MysqlPool.get(hostname, username, password, database)
+        self.mfetch_strategy = mfetch_strategy # None means automatic choice (see mfetch()).
+        self.mfetch_chunk = mfetch_chunk
+        self.mfetch_temp_threshold = mfetch_temp_threshold
+        self.replicas = [self._make_replica(replica) for replica in replicas or []]
+        self.balancing = balancing
+        self.max_lag = max_lag
+        self.read_your_writes = read_your_writes
+        self.max_recent = max_recent
+        self.turns = itertools.count()
+        self.reading = threading.local() # the replica the current thread reads from, if any.
+        self.lock = threading.Lock() # for the state below.
+        self.recent = collections.OrderedDict() # pk key -> when it was written, the oldest first.
+        self.written_ts = None
+        self.counters = dict(replica_reads=0, primary_reads=0, recent=0, absent=0, failovers=0, unavailable=0)
+
+    @property
+    def connection(self):
+        """
+        The connection borrowed from the pool by the current thread, if any.
+        It is only available within the operations (see _connected()).
+        """
+        connection = getattr(self.pool.local, 'connection', None)
+        if connection is None and self.replicas:
+            replica = getattr(self.reading, 'replica', None)
+            if replica is not None:
+                connection = getattr(replica.pool.local, 'connection', None)
+        return connection
+
+    def stats(self):
+        with self.lock:
+            return dict(self.counters,
+                recent = len(self.recent),
+                replicas = [replica.stats() for replica in self.replicas],
+            )
 
     def store(self, id, value, expect=None, unique=None):
         """
@@ -51,16 +356,16 @@ class MysqlStorage(Storage):
         else:
             expect = None
 
-        self._connect()
-        try:
-            split = self._split(value)
-            #split['id'] = id
-            self.domain.put_attributes(id, split, expected_value=expect)
-        except SDBResponseError, e:
-            if e.code == 'ConditionalCheckFailed':
-                raise StorageExpectationError("Storage expecation failed.")
-            else:
-                raise
+        with self._connected():
+            try:
+                split = self._split(value)
+                #split['id'] = id
+                self.domain.put_attributes(id, split, expected_value=expect)
+            except SDBResponseError, e:
+                if e.code == 'ConditionalCheckFailed':
+                    raise StorageExpectationError("Storage expecation failed.")
+                else:
+                    raise
 
     def fetch(self, id):
         """
@@ -68,8 +373,13 @@ class MysqlStorage(Storage):
         otherwise id is treated as a sequence of ids and all of them are fetched.
         Actual fetch goes in batches of 20 items per requests (SimpleDB limitation).
         """
-        self._connect()
+        item = self._replicated([id], self._fetch, id)
+        if item is None:
+            with self._connected():
+                item = self._fetch(id)
+        return item
 
+    def _fetch(self, id):
         where, values = self._ids_to_sql([id])
         query = "SELECT * FROM `%s` WHERE %s" % (self.name, where) #!!! escape table name
 
@@ -88,26 +398,89 @@ class MysqlStorage(Storage):
 
     def mfetch(self, ids):
         """
-        Fetches one or many items by ids. If id is a string, one item is fetched,
-        otherwise id is treated as a sequence of ids and all of them are fetched.
-        Actual fetch goes in batches of 20 items per requests (SimpleDB limitation).
+        Fetches many items by ids. The ids are grouped by their sets of fields (usually
+        there is one group only), and each group is fetched with one of the strategies:
+        * "in": the fields equal for all the ids are factored out, and the rest ones are
+          matched with one IN list (or a row constructor IN list for compound ids), e.g.:
+              host=%(c_host)s AND (time_shard,domain) IN ((%(time_shard0)s,%(domain0)s), ...)
+        * "chunks": the same as "in", but split into few queries of mfetch_chunk ids each.
+        * "temp": the ids are inserted into a temporary table, which is joined then.
+        * "or": the ids are matched one by one with OR'ed clauses (see _ids_to_sql()).
+        If the strategy is not specified in the constructor, it is chosen by the number
+        of ids: "in" for few ids, "chunks" for many, "temp" for more than the threshold.
+        The thresholds depend on the server; use _drafts/mysql_mfetch.py to find them.
         """
-
-        self._connect()
         if not ids: return []
 
-        where, values = self._ids_to_sql(ids)
-        query = "SELECT * FROM `%s` WHERE %s" % (self.name, where) #!!! escape table name
+        items = self._replicated(ids, self._mfetch, ids)
+        if items is None:
+            with self._connected():
+                return self._mfetch(ids)
+
+        # The items absent on the replica may be not replicated yet; they are looked up on the primary.
+        stored = self._index_by_pk(ids, items)
+        missing = [id for id in ids if self._pk_key(id) not in stored]
+        if missing:
+            self._count('absent')
+            with self._connected():
+                items.extend(self._mfetch(missing))
+        return items
+
+    def _mfetch(self, ids):
+        strategy = self.mfetch_strategy
+        if strategy is None:
+            if len(ids) > self.mfetch_temp_threshold:
+                strategy = 'temp'
+            elif len(ids) > self.mfetch_chunk:
+                strategy = 'chunks'
+            else:
+                strategy = 'in'
+
+        items = []
+        for fields, group in self._group_by_fields([dict(StorageID(id)) for id in ids]):
+            items.extend(getattr(self, '_mfetch_%s' % strategy)(fields, self._unique_rows(fields, group)))
+
+        #??? factory? on Storage level?
+
+        return items
 
+    def _mfetch_or(self, fields, rows):
+        where, values = self._ids_to_sql(rows)
+        query = "SELECT * FROM `%s` WHERE %s" % (self.name, where) #!!! escape table name
         cursor = self.connection.cursor(MySQLdb.cursors.DictCursor)
         cursor.execute(query, values)
-        rows = cursor.fetchall()
-        items = rows
+        return list(cursor.fetchall())
 
-        #??? factory? on Storage level?
+    def _mfetch_in(self, fields, rows):
+        where, values = self._in_to_sql(fields, rows)
+        query = "SELECT * FROM `%s` WHERE %s" % (self.name, where) #!!! escape table name
+        cursor = self.connection.cursor(MySQLdb.cursors.DictCursor)
+        cursor.execute(query, values)
+        return list(cursor.fetchall())
 
+    def _mfetch_chunks(self, fields, rows):
+        items = []
+        for chunk in self._chunks(rows, self.mfetch_chunk):
+            items.extend(self._mfetch_in(fields, chunk))
         return items
 
+    def _mfetch_temp(self, fields, rows):
+        # The temporary table is per connection, so its name does not clash with other processes.
+        # Its columns are copied from the storage's table, so the types & collations are the same.
+        temp = '_mfetch_%s' % self.name
+        columns = ','.join(fields)
+        cursor = self.connection.cursor(MySQLdb.cursors.DictCursor)
+        cursor.execute("DROP TEMPORARY TABLE IF EXISTS %s" % temp)
+        cursor.execute("CREATE TEMPORARY TABLE %s (PRIMARY KEY (%s)) ENGINE=MEMORY SELECT %s FROM %s LIMIT 0" % (temp, columns, columns, self.name))
+        try:
+            for chunk in self._chunks(rows, self.mfetch_chunk):
+                query, values = self._multirow_sql(fields, chunk, table=temp)
+                cursor.execute(query, values)
+            cursor.execute("SELECT items.* FROM `%s` items JOIN %s ids USING (%s)" % (self.name, temp, columns)) #!!! escape table name
+            return list(cursor.fetchall())
+        finally:
+            cursor.execute("DROP TEMPORARY TABLE IF EXISTS %s" % temp)
+
     def select(self, filters={}, sorters=[], limit=None):
         """
         Builds and executes the SQL-like select to the storage.
@@ -116,9 +489,13 @@ class MysqlStorage(Storage):
         TODO: very complexed overhead to the semantics of the class. Try to remove it.
         TODO: As of now, it is used in analytics dimensions only.
         """
+        items = self._replicated(None, self._select, filters, sorters, limit)
+        if items is None:
+            with self._connected():
+                items = self._select(filters, sorters, limit)
+        return items
 
-        self._connect()
-
+    def _select(self, filters, sorters, limit):
         #TODO: escape domain name and field names
         values = dict(filters)
         extra_fields = [field for field, order in sorters if field not in filters]
@@ -145,26 +522,31 @@ class MysqlStorage(Storage):
         This method is never used directly; it is called from Storage.create() method in repeating cycle.
         """
 
-        self._connect()
-
-        # Generate an item. Field values and even id can be different on each try.
-        # Normalize the id for key-value usage scenario.
-        item = factory()
-        pk = dict(StorageID(item['id']))
-        item.update(pk)
-
-        # Ensure the item is absent using an attribute that always exists.
-#        pk_where, pk_values = self._ids_to_sql([item['id']])
+        with self._connected():
+            # Generate an item. Field values and even id can be different on each try.
+            # Normalize the id for key-value usage scenario.
+            item = factory()
+            id = item['id']
+            pk = dict(StorageID(id))
+            item.update(pk)
 
-        # Store the values to the physical storage if necessary.
-        assignments = ','.join(['%s=%%(%s)s' % (field, field) for field in item.keys()])
-        query = "INSERT INTO %s SET %s" % (self.name, assignments)
-        cursor = self.connection.cursor(MySQLdb.cursors.DictCursor)
-        cursor.execute(query, dict(item))
-        self.connection.commit()
+            # Ensure the item is absent using an attribute that always exists.
+#            pk_where, pk_values = self._ids_to_sql([item['id']])
+
+            # Store the values to the physical storage if necessary.
+            assignments = ','.join(['%s=%%(%s)s' % (field, field) for field in item.keys()])
+            query = "INSERT INTO %s SET %s" % (self.name, assignments)
+            cursor = self.connection.cursor(MySQLdb.cursors.DictCursor)
+            try:
+                cursor.execute(query, dict(item))
+            except MySQLdb.IntegrityError, e:
+                self.connection.rollback()
+                raise StorageExpectationError("Storage expecation failed.")
+            self.connection.commit()
+            self._written([id])
 
-        # Return
-        return item # re-fetch?
+            # Return
+            return item # re-fetch?
 
     def try_update(self, id, fn, field=None):
         """
@@ -173,37 +555,38 @@ class MysqlStorage(Storage):
         This method is never used directly; it is called from Storage.update() method in repeating cycle.
         """
 
-        self._connect()
-        pk = dict(StorageID(id))
+        with self._connected():
+            pk = dict(StorageID(id))
 
-        # Try to fetch the item's values from the physical storage.
-        # Fallback to empty list of values if the item does not exist.
-        try:
-            item = self.fetch(id)
-        except StorageItemAbsentError, e:
-            item = Item() # what if it is of another type???
-            item.update(pk)
+            # Try to fetch the item's values from the physical storage.
+            # Fallback to empty list of values if the item does not exist.
+            try:
+                item = self.fetch(id)
+            except StorageItemAbsentError, e:
+                item = Item() # what if it is of another type???
+                item.update(pk)
 
-        # Ensure the item is absent using an attribute that always exists.
-#        pk_where, pk_values = self._ids_to_sql([id]) # is it still used???
+            # Ensure the item is absent using an attribute that always exists.
+#            pk_where, pk_values = self._ids_to_sql([id]) # is it still used???
 
-        # Get the values to be updated. Store them to the physical storage if necessary.
-        changes = fn(item)
-        changes.update(dict(StorageID(id)))
-        values = dict(item, **changes)
-        #!!! separate and make it obvious which fields are for pk, and which are for values. merge them only for the query.
+            # Get the values to be updated. Store them to the physical storage if necessary.
+            changes = fn(item)
+            changes.update(dict(StorageID(id)))
+            values = dict(item, **changes)
+            #!!! separate and make it obvious which fields are for pk, and which are for values. merge them only for the query.
 
-        # Build SQL query to INSERT or UPDATE depending on absence of existence of the item.
-        assignments = ','.join(['%s=%%(%s)s' % (field, field) for field in changes.keys()])
-        query = "INSERT INTO %s SET %s ON DUPLICATE KEY UPDATE %s" % (self.name, assignments, assignments)
+            # Build SQL query to INSERT or UPDATE depending on absence of existence of the item.
+            assignments = ','.join(['%s=%%(%s)s' % (field, field) for field in changes.keys()])
+            query = "INSERT INTO %s SET %s ON DUPLICATE KEY UPDATE %s" % (self.name, assignments, assignments)
 
-        # Store the values to the physical storage if necessary.
-        cursor = self.connection.cursor(MySQLdb.cursors.DictCursor)
-        cursor.execute(query, values)
-        self.connection.commit()
+            # Store the values to the physical storage if necessary.
+            cursor = self.connection.cursor(MySQLdb.cursors.DictCursor)
+            cursor.execute(query, values)
+            self.connection.commit()
+            self._written([id])
 
-        # Return
-        return changes # re-fetch?
+            # Return
+            return changes # re-fetch?
 
     def try_replace(self, id, fn, field=None):
         """
@@ -212,88 +595,193 @@ class MysqlStorage(Storage):
         This method is never used directly; it is called from Storage.update() method in repeating cycle.
         """
 
-        self._connect()
+        with self._connected():
+            # Try to fetch the item's values from the physical storage.
+            # Fallback to empty list of values if the item does not exist.
+            try:
+                item = self.fetch(id)
+            except StorageItemAbsentError, e:
+                raise # just to make it very obvious that we pass it through.
+
+            # Identify the item by its primary key, and also by the value of the field if it is specified.
+            # This makes the write conditional: it fails if the item was changed after it was fetched.
+            pk_where, pk_values = self._ids_to_sql([id])
+            if field is not None:
+                pk_where = '%s AND %s<=>%%(_expected)s' % (pk_where, field)
+                pk_values['_expected'] = item.get(field, None)
+
+            # Get the values to be updated. Store them to the physical storage if necessary.
+            changes = fn(item)
+            values = dict(pk_values, **changes)
+
+            # Build SQL query to update an item if it exists.
+            assignments = ','.join(['%s=%%(%s)s' % (field, field) for field in changes.keys()])
+            query = "UPDATE %s SET %s WHERE %s" % (self.name, assignments, pk_where)
+
+            # Store the values to the physical storage if necessary.
+            # Note that we count matched rows, not changed ones (see FOUND_ROWS flag in MysqlPool._connect()).
+            cursor = self.connection.cursor(MySQLdb.cursors.DictCursor)
+            affected = cursor.execute(query, values)
+            if not affected:
+                self.connection.rollback()
+                raise StorageExpectationError("Storage expecation failed.")
+            self.connection.commit()
+            self._written([id])
 
-        # Try to fetch the item's values from the physical storage.
-        # Fallback to empty list of values if the item does not exist.
-        try:
-            item = self.fetch(id)
-        except StorageItemAbsentError, e:
-            raise # just to make it very obvious that we pass it through.
+            # Return
+            return changes # re-fetch?
 
-        # Ensure the item is absent using an attribute that always exists.
-        pk_where, pk_values = self._ids_to_sql([id])
+    def try_mcreate(self, factories):
+        """
+        Makes one attempt to create many unique items in the storage, with few multi-row INSERTs.
+        The items which ids already exist are not overwritten, and are reported as failed.
+        This method is never used directly; it is called from Storage.mcreate() method in repeating cycle.
+        """
 
-        # Get the values to be updated. Store them to the physical storage if necessary.
-        changes = fn(item)
-        #!!!TODO: I guess here is an error, since pk_values are not merged into changes. But seems we do not use replace() at all.
+        with self._connected():
+            # Generate the items and normalize their ids, as try_create() does.
+            # Remember the original ids, since the id field is overwritten with the normalized one.
+            ids = []
+            items = []
+            for factory in factories:
+                item = factory()
+                ids.append(item['id'])
+                item.update(dict(StorageID(item['id'])))
+                items.append(item)
+
+            # Insert the items with a no-op update for the duplicates, so they are skipped silently.
+            # Unlike INSERT IGNORE, this does not hide other errors (e.g., truncated or bad values).
+            # Items with different sets of fields cannot share one statement, so they are grouped.
+            cursor = self.connection.cursor(MySQLdb.cursors.DictCursor)
+            for fields, group in self._group_by_fields(items):
+                noop = '%s=%s' % (fields[0], fields[0])
+                for chunk in self._chunks(group):
+                    query, values = self._multirow_sql(fields, chunk)
+                    cursor.execute("%s ON DUPLICATE KEY UPDATE %s" % (query, noop), values)
+
+            # Find out which items are ours: skipped ones have other values in the stored rows.
+            # Note that an identical item stored before is indistinguishable, and is treated as created.
+            stored = self._index_by_pk(ids, self.mfetch(ids))
+            results = []
+            for id, item in zip(ids, items):
+                row = stored.get(self._pk_key(id))
+                if row is not None and all(unicode(row.get(field)) == unicode(value) for field, value in item.items()):
+                    results.append(item)
+                else:
+                    results.append(StorageExpectationError("Storage expecation failed."))
+            self.connection.commit()
+            self._written(ids)
+
+            # Return
+            return results
+
+    def mstore(self, items):
+        """
+        Creates or updates many items at once, with few multi-row INSERT ... ON DUPLICATE KEY UPDATE.
+        All the items are written in one transaction, so they are committed once.
+        """
 
-        # Build SQL query to update an item if it exists.
-        assignments = ','.join(['%s=%%(%s)s' % (field, field) for field in changes.keys()])
-        query = "UPDATE %s SET %s WHERE %s" % (self.name, assignments, pk_where)
+        with self._connected():
+            # Merge the primary key fields into the values, as try_update() does.
+            results = [dict(values, **dict(StorageID(id))) for id, values in items]
 
-        # Store the values to the physical storage if necessary.
-        cursor = self.connection.cursor(MySQLdb.cursors.DictCursor)
-        cursor.execute(query, changes)
-        #!!!todo: raise StorageItemAbsentError() if  affected_rows == 0
-        self.connection.commit()
+            cursor = self.connection.cursor(MySQLdb.cursors.DictCursor)
+            for fields, group in self._group_by_fields(results):
+                updates = ','.join(['%s=VALUES(%s)' % (field, field) for field in fields])
+                for chunk in self._chunks(group):
+                    query, values = self._multirow_sql(fields, chunk)
+                    cursor.execute("%s ON DUPLICATE KEY UPDATE %s" % (query, updates), values)
+            self.connection.commit()
+            self._written([id for id, values in items])
 
-        # Return
-        return changes # re-fetch?
+            # Return
+            return results
 
-    def append(self, id, value, retries=1):
+    def mincrement(self, steps, retries=1):
+        """
+        Increments many counters at once, with few multi-row INSERT ... ON DUPLICATE KEY UPDATE.
+        The new values are read back before the commit, while the rows are still locked by us.
+        """
         #NB: since we use SQL row locks, there is no need to retries.
-        #NB: value field must be declared as NOT NULL DEFAULT ''.
-        #TODO: we can remove that requirement for DEFAULT value, but have to rewrite all this dict manipulations.
+        #NB: value field must be declared as integer NOT NULL DEFAULT 0.
 
         value_field = 'value'
-        self._connect()
-
-        # Execute the query and aquire a row lock on the counter.
-        pk = dict(StorageID(id))
-        values = dict(pk, value=value)
-        assignments = ','.join(['%s=%%(%s)s' % (field, field) for field in pk.keys()]
-                             + ['%s=concat(%s, %%(%s)s)' % (value_field, value_field, value_field)])
-        query = "INSERT INTO %s SET %s ON DUPLICATE KEY UPDATE %s" % (self.name, assignments, assignments)
-        cursor = self.connection.cursor(MySQLdb.cursors.DictCursor)
-        cursor.execute(query, values)
+        with self._connected():
+            rows = [dict(dict(StorageID(id)), **{value_field: int(step)}) for id, step in steps]
 
-        # Fetch the value while it is locked - no one will change it since we updates and till we committed.
-        value = self.fetch(id)[value_field]
+            cursor = self.connection.cursor(MySQLdb.cursors.DictCursor)
+            for fields, group in self._group_by_fields(rows):
+                updates = '%s=%s+VALUES(%s)' % (value_field, value_field, value_field)
+                for chunk in self._chunks(group):
+                    query, values = self._multirow_sql(fields, chunk)
+                    cursor.execute("%s ON DUPLICATE KEY UPDATE %s" % (query, updates), values)
 
-        # Commit and release the row lock.
-        self.connection.commit()
+            # Fetch the values while they are locked - no one will change them till we committed.
+            ids = [id for id, step in steps]
+            stored = self._index_by_pk(ids, self.mfetch(ids))
+            results = [stored[self._pk_key(id)][value_field] for id, step in steps]
 
-        # Return
-        return value
+            # Commit and release the row locks.
+            self.connection.commit()
+            self._written(ids)
 
-    def prepend(self, id, value, retries=1):
-        raise NotImplementedError()#!!!todo later
+            # Return
+            return results
 
-    def increment(self, id, step, retries=1):
+    def append(self, id, value, retries=1):
         #NB: since we use SQL row locks, there is no need to retries.
-        #NB: value field must be declared as NOT NULL DEFAULT 0.
-        #TODO: we can remove that requirement for DEFAULT value, but have to rewrite all this dict manipulations.
+        #NB: value field must be declared as NOT NULL DEFAULT ''.
+        #NB: strings cannot be passed through LAST_INSERT_ID(expr) as in increment(), so the new value
+        #NB: is remembered in the connection's user variable by the same statement, and is read after
+        #NB: the commit: the row lock is held only for the statement itself, not for an extra fetch.
 
         value_field = 'value'
-        self._connect()
-
-        pk = dict(StorageID(id))
-        assignments = ','.join(['%s=%%(%s)s' % (field, field) for field in pk.keys()] + ['%s=%s+(%d)' % (value_field, value_field, int(step))])
-        query = "INSERT INTO %s SET %s ON DUPLICATE KEY UPDATE %s" % (self.name, assignments, assignments)
+        with self._connected():
+            pk = dict(StorageID(id))
+            values = dict(pk, value=value)
+            inserts = ','.join(['%s=%%(%s)s' % (field, field) for field in pk.keys()]
+                             + ['%s=(@daal_append:=%%(%s)s)' % (value_field, value_field)])
+            updates = '%s=(@daal_append:=concat(%s, %%(%s)s))' % (value_field, value_field, value_field)
+            query = "INSERT INTO %s SET %s ON DUPLICATE KEY UPDATE %s" % (self.name, inserts, updates)
+
+            # Execute the query, and commit to release the row lock immediately.
+            cursor = self.connection.cursor(MySQLdb.cursors.DictCursor)
+            cursor.execute(query, values)
+            self.connection.commit()
+            self._written([id])
+
+            # The variable belongs to this connection only, so no one could change it since the query.
+            cursor.execute("SELECT @daal_append AS value")
+            value = cursor.fetchone()['value']
+
+            # Return
+            return value
 
-        # Execute the query and aquire a row lock on the counter.
-        cursor = self.connection.cursor(MySQLdb.cursors.DictCursor)
-        cursor.execute(query, pk)
-
-        # Fetch the value while it is locked - no one will change it since we updates and till we committed.
-        value = self.fetch(id)[value_field]
+    def prepend(self, id, value, retries=1):
+        raise NotImplementedError()#!!!todo later
 
-        # Commit and release the row lock.
-        self.connection.commit()
+    def increment(self, id, step, retries=1):
+        #NB: since we use SQL row locks, there is no need to retries.
+        #NB: value field must be declared as integer NOT NULL DEFAULT 0.
+        #NB: LAST_INSERT_ID(expr) remembers the new value for the connection, so it is returned
+        #NB: to the client with the result of the statement, with no extra fetch under the lock.
 
-        # Return
-        return value
+        value_field = 'value'
+        with self._connected():
+            pk = dict(StorageID(id))
+            inserts = ','.join(['%s=%%(%s)s' % (field, field) for field in pk.keys()] + ['%s=LAST_INSERT_ID(%d)' % (value_field, int(step))])
+            updates = '%s=LAST_INSERT_ID(%s+(%d))' % (value_field, value_field, int(step))
+            query = "INSERT INTO %s SET %s ON DUPLICATE KEY UPDATE %s" % (self.name, inserts, updates)
+
+            # Execute the query, get the new value, and commit to release the row lock immediately.
+            cursor = self.connection.cursor(MySQLdb.cursors.DictCursor)
+            cursor.execute(query, pk)
+            value = self.connection.insert_id()
+            self.connection.commit()
+            self._written([id])
+
+            # Return
+            return value
 
     def decrement(self, id, step, retries=1):
         # No special support or optimizations for decrement operation.
@@ -310,6 +798,7 @@ class MysqlStorage(Storage):
         """
         Converts few storage IDs to SQL WHERE clause and dict with values for binding.
         List of ids must be non-empty (it's better to catch this situation at higher level).
+        The ids can also be given as dicts of their fields already (as dict(StorageID(id))).
 
         The clause returned is build as short as it is possible in this implementation.
         But it resolves all conflicts with the same-named fields with differently values
@@ -331,7 +820,7 @@ class MysqlStorage(Storage):
             # Build per-id expressions.
             id_wheres = []
             id_values = []
-            for field, value in dict(StorageID(id)).items():
+            for field, value in (id if isinstance(id, dict) else dict(StorageID(id))).items():
                 # First, check if this field&value pair exists already, and create it if it does not yet.
                 reference = references.setdefault(field, {}).setdefault(value, '%s%s' % (field, index))
 
@@ -346,15 +835,218 @@ class MysqlStorage(Storage):
         values = dict(values)
         return clause, values
 
-    def _connect(self):
+    def _multirow_sql(self, fields, rows, table=None):
+        """
+        Builds multi-row INSERT query for the rows with the same set of fields, and the values
+        for binding. The rows are dicts; the fields are the columns in the order of the query.
+        The rows are inserted into the storage's table, unless another table is specified.
         """
-        Connects to the storage if not connected yet.
-        If already connected, does nothing.
+        values = {}
+        tuples = []
+        for index, row in enumerate(rows):
+            references = []
+            for field in fields:
+                reference = '%s%s' % (field, index)
+                references.append('%%(%s)s' % reference)
+                values[reference] = row[field]
+            tuples.append('(%s)' % ','.join(references))
+        query = "INSERT INTO %s (%s) VALUES %s" % (table or self.name, ','.join(fields), ','.join(tuples)) #!!! escape
+        return query, values
+
+    def _in_to_sql(self, fields, rows):
         """
-        if not self.connected:
-            self.connection = MySQLdb.connect(host = self.hostname,
-                                     user = self.username,
-                                     passwd = self.password,
-                                     db = self.database)
-            self.connected = True
-        return self
+        Converts the ids (as dicts with the same set of fields) to SQL WHERE clause with IN list,
+        and dict with values for binding. The fields with the same value in all the ids are
+        factored out of the list (e.g., host of the wrapped ids), the rest ones are listed.
+        """
+        constant = [field for field in fields if len(set(row[field] for row in rows)) == 1]
+        varying = [field for field in fields if field not in constant]
+
+        wheres = []
+        values = {}
+        for field in constant:
+            wheres.append('%s=%%(c_%s)s' % (field, field))
+            values['c_%s' % field] = rows[0][field]
+        if varying:
+            tuples = []
+            for index, row in enumerate(rows):
+                references = []
+                for field in varying:
+                    references.append('%%(%s%s)s' % (field, index))
+                    values['%s%s' % (field, index)] = row[field]
+                tuples.append(references[0] if len(varying) == 1 else '(%s)' % ','.join(references))
+            column = varying[0] if len(varying) == 1 else '(%s)' % ','.join(varying)
+            wheres.append('%s IN (%s)' % (column, ','.join(tuples)))
+        return ' AND '.join(wheres), values
+
+    def _unique_rows(self, fields, rows):
+        # Repeated ids would make the lists longer, and would duplicate the items in joins.
+        seen = set()
+        unique = []
+        for row in rows:
+            key = tuple(row[field] for field in fields)
+            if key not in seen:
+                seen.add(key)
+                unique.append(row)
+        return unique
+
+    def _group_by_fields(self, rows):
+        """
+        Groups the rows by their sets of fields, since only such rows can share one INSERT.
+        Yields (fields, rows) pairs; the order of the rows within each group is kept.
+        """
+        groups = {}
+        for row in rows:
+            groups.setdefault(tuple(sorted(row.keys())), []).append(row)
+        return groups.items()
+
+    def _chunks(self, rows, length=100):
+        #NB: keeps the statements well below max_allowed_packet for the items we have (urls, counters).
+        for offset in xrange(0, len(rows), length):
+            yield rows[offset:offset+length]
+
+    def _pk_key(self, id):
+        return tuple(sorted((field, unicode(value)) for field, value in dict(StorageID(id)).items()))
+
+    def _index_by_pk(self, ids, rows):
+        """
+        Indexes the rows returned from mfetch() by the primary keys of the ids requested.
+        The rows have no ids, so they are matched by the fields of the ids (see _pk_key()).
+        """
+        shapes = set(tuple(sorted(dict(StorageID(id)).keys())) for id in ids)
+        index = {}
+        for row in rows:
+            for shape in shapes:
+                if all(field in row for field in shape):
+                    index[tuple((field, unicode(row[field])) for field in shape)] = row
+        return index
+
+    def _make_replica(self, replica):
+        # The replicas are given as hostnames, or as dicts of the options which differ from the primary's.
+        options = dict(hostname=self.hostname, username=self.username, password=self.password, database=self.database)
+        options.update({'hostname': replica} if isinstance(replica, basestring) else replica)
+        return MysqlReplica.get(**options)
+
+    def _replica(self, ids):
+        """
+        Chooses the replica to read the ids from (None means all the items), or returns None
+        if the read must go to the primary: there are no replicas available, or the items were
+        written recently, or the read is made within the write (the primary's connection is borrowed).
+        """
+        if not self.replicas:
+            return None
+        if getattr(self.pool.local, 'connection', None) is not None:
+            return None
+        if self._recent(ids):
+            self._count('recent')
+            return None
+
+        replicas = [replica for replica in self.replicas if replica.available(self.max_lag)]
+        if not replicas:
+            self._count('unavailable')
+            return None
+        if self.balancing == 'latency':
+            return min(replicas, key=lambda replica: replica.latency or 0.0) # not measured yet ones are tried first.
+        else:
+            return replicas[self.turns.next() % len(replicas)]
+
+    def _replicated(self, ids, fn, *args):
+        """
+        Makes the read on the replica chosen for the ids (see _replica()), and returns its result,
+        or None if the read must be repeated on the primary: there is no replica for it, the
+        replica has failed (it is considered down then), or the item is absent on the replica.
+        """
+        replica = self._replica(ids)
+        if replica is None:
+            if self.replicas:
+                self._count('primary_reads')
+            return None
+
+        ts = time.time()
+        try:
+            with self._connected(replica):
+                result = fn(*args)
+        except StorageItemAbsentError, e:
+            replica.succeeded(time.time() - ts)
+            self._count('absent')
+            return None
+        except MySQLdb.OperationalError, e:
+            replica.failed()
+            self._count('failovers')
+            return None
+        except MysqlPoolExhaustedError, e:
+            self._count('failovers') # the replica is busy, not down.
+            return None
+        replica.succeeded(time.time() - ts)
+        self._count('replica_reads')
+        return result
+
+    def _written(self, ids):
+        """
+        Remembers the ids written to the primary for read_your_writes seconds (see _recent()).
+        The oldest ones are forgotten when there are more than max_recent of them.
+        """
+        if not self.replicas or not self.read_your_writes:
+            return
+        now = time.time()
+        with self.lock:
+            self.written_ts = now
+            for id in ids:
+                key = self._pk_key(id)
+                self.recent.pop(key, None) # re-inserted to keep the order by time.
+                self.recent[key] = now
+            while self.recent and (len(self.recent) > self.max_recent or now - self.recent.itervalues().next() >= self.read_your_writes):
+                self.recent.popitem(last=False)
+
+    def _recent(self, ids):
+        # Whether any of the ids (or anything at all, if ids is None) was written by this storage recently.
+        if not self.read_your_writes or self.written_ts is None:
+            return False
+        now = time.time()
+        with self.lock:
+            if now - self.written_ts >= self.read_your_writes:
+                return False
+            if ids is None:
+                return True
+            for id in ids:
+                ts = self.recent.get(self._pk_key(id))
+                if ts is not None and now - ts < self.read_your_writes:
+                    return True
+            return False
+
+    def _count(self, name):
+        with self.lock:
+            self.counters[name] += 1
+
+    @contextlib.contextmanager
+    def _connected(self, replica=None):
+        """
+        Borrows a connection from the pool for the duration of one operation.
+        Nested operations (e.g., fetch() within try_update(), or any operation of another
+        storage on the same pool) re-use the same connection, so they are in the same transaction. Any transaction left open (e.g., by reads)
+        is rolled back when the connection is returned, so it does not keep old snapshots.
+        The reads routed to the replica borrow the connection from the replica's pool instead.
+        """
+        if self.connection is not None:
+            yield self.connection
+            return
+
+        pool = replica.pool if replica is not None else self.pool
+        connection = pool.checkout()
+        pool.local.connection = connection
+        self.reading.replica = replica
+        broken = False
+        try:
+            yield connection
+        except MySQLdb.OperationalError, e:
+            broken = True
+            raise
+        finally:
+            pool.local.connection = None
+            self.reading.replica = None
+            if not broken:
+                try:
+                    connection.rollback()
+                except MySQLdb.Error, e:
+                    broken = True
+            pool.checkin(connection, broken=broken)
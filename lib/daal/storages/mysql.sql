@@ -41,6 +41,31 @@ CREATE TABLE `sequences` (
     primary key (`host`, `id`)
 ) engine=innodb;
 
+/*
+ * Used by CounterGenerator to get unique numbers in one single statement (see MysqlStorage.increment).
+ * Value field must have a default of 0 as defined for counters (see mysql.py).
+ */
+DROP TABLE IF EXISTS `counters`;
+CREATE TABLE `counters` (
+    `host`              varchar(100) character set 'utf8' collate 'utf8_bin' not null,
+    `id`                varchar(100) character set 'utf8' collate 'utf8_bin' not null,
+    `value`             bigint unsigned not null default 0,
+    primary key (`host`, `id`)
+) engine=innodb;
+
+/*
+ * Used by PoolGenerator to keep the pre-generated ids in fixed number of slots.
+ * State is either "free" or "used"; the slots are claimed with conditional writes.
+ */
+DROP TABLE IF EXISTS `code_pool`;
+CREATE TABLE `code_pool` (
+    `host`              varchar(100) character set 'utf8' collate 'utf8_bin' not null,
+    `id`                varchar(100) character set 'utf8' collate 'utf8_bin' not null,
+    `code`              varchar(100) character set 'utf8' collate 'utf8_bin' not null,
+    `state`             varchar(10) not null,
+    primary key (`host`, `id`)
+) engine=innodb;
+
 /*
  * Used by PopularDomainsDimension to store per-domain counters.
  * Value field must have a default of 0 as defined for counters (see mysql.py).
@@ -79,3 +104,15 @@ CREATE TABLE `popular_grid_level_domains` (
     `value`             longtext not null default '',
     primary key (`host`, `time_shard`, `grid_level`)
 ) engine=innodb;
+
+/*
+ * Used by Shortener to find the codes of the urls shortened already (dedupe index).
+ * Id is the SHA1 hex digest of the normalized url; the code is the id in the urls table.
+ */
+DROP TABLE IF EXISTS `url_index`;
+CREATE TABLE `url_index` (
+    `host`              varchar(100) character set 'utf8' collate 'utf8_bin' not null,
+    `id`                char(40) character set 'ascii' collate 'ascii_bin' not null,
+    `code`              varchar(100) character set 'utf8' collate 'utf8_bin' not null,
+    primary key (`host`, `id`)
+) engine=innodb;
@@ -4,9 +4,25 @@ from ._base import Storage, StorageID
 from ._base import StorageExpectationError, StorageItemAbsentError, StorageUniquenessError
 from boto.exception import SDBResponseError
 from boto.sdb.connection import SDBConnection
+from multiprocessing.pool import ThreadPool
+import sys
+import threading
 
 __all__ = ['SDBStorage']
 
+
+# Process-wide pools of worker threads for the parallel requests, one per concurrency level.
+# They are shared by all the storages, since the storages are created per host (and there are many).
+POOLS = {}
+POOLS_LOCK = threading.Lock()
+
+def get_pool(size):
+    with POOLS_LOCK:
+        if size not in POOLS:
+            POOLS[size] = ThreadPool(size)
+        return POOLS[size]
+
+
 class SDBStorage(Storage):
     """
     Stores all information in Amazon SimpleDB.
@@ -15,16 +31,21 @@ class SDBStorage(Storage):
     * Limit on number of predicates in WHERE IN query for multi-id fetch (20 max).
     * Limit on the lenght of an attribute (1024 chars max).
     * Others to come.
+
+    The connections are kept per thread (boto's ones are not thread-safe), both for the
+    requesting threads and for the worker threads of mfetch(), so the storage can be shared.
     """
 
-    def __init__(self, access_key, secret_key, name):
+    def __init__(self, access_key, secret_key, name, concurrency=8):
         super(SDBStorage, self).__init__()
         self.access_key = access_key
         self.secret_key = secret_key
-        self.connected = False
-        self.connection = None
-        self.domain = None
         self.name = name
+        self.concurrency = concurrency
+        self.local = threading.local() # per-thread connections & domains (see _connect()).
+
+    connection = property(lambda self: getattr(self.local, 'connection', None))
+    domain = property(lambda self: getattr(self.local, 'domain', None))
 
     def store(self, id, value, expect=None, unique=None):
         """
@@ -83,21 +104,44 @@ class SDBStorage(Storage):
         Fetches one or many items by ids. If id is a string, one item is fetched,
         otherwise id is treated as a sequence of ids and all of them are fetched.
         Actual fetch goes in batches of 20 items per requests (SimpleDB limitation).
+
+        The batches are fetched in parallel by the worker threads (up to the concurrency
+        specified in the constructor), but the result is the same as if they were fetched
+        one by one: the items are in the order of the batches, and if any of the batches
+        fails, the error of the first failed one is raised (after all of them are done).
         """
 
         self._connect()
 
-        result = []
         #??? is there any itertools function to iterate the batches?
         chunk_length = 20 #NB: hard-coded limit on number of predicates in SimpleDB queries
-        for chunk_offset in xrange(0, len(ids), chunk_length):
-            chunk_ids = ids[chunk_offset:chunk_offset+chunk_length]
-            chunk_str = ','.join(["'%s'" % unicode(StorageID(id)) for id in chunk_ids])#!!!! add string escaping
-            query = 'SELECT * FROM %s WHERE itemName() in (%s)' % (self.domain.name, chunk_str)
-            items = self.domain.select(query)
-            result.extend(map(self._rejoin, items))
+        chunks = [ids[chunk_offset:chunk_offset+chunk_length] for chunk_offset in xrange(0, len(ids), chunk_length)]
+        if len(chunks) <= 1 or self.concurrency <= 1:
+            return [item for chunk_ids in chunks for item in self._select_chunk(self.domain, chunk_ids)]
+
+        outcomes = get_pool(self.concurrency).map(self._try_select_chunk, chunks)
+        result = []
+        for success, value in outcomes:
+            if not success:
+                raise value[0], value[1], value[2]
+            result.extend(value)
         return result
 
+    def _select_chunk(self, domain, chunk_ids):
+        chunk_str = ','.join(["'%s'" % unicode(StorageID(id)) for id in chunk_ids])#!!!! add string escaping
+        query = 'SELECT * FROM %s WHERE itemName() in (%s)' % (domain.name, chunk_str)
+        items = domain.select(query)
+        return list(map(self._rejoin, items))
+
+    def _try_select_chunk(self, chunk_ids):
+        # Runs in the worker threads, so it uses their own connections (see _connect()).
+        # The errors are returned, not raised, so that the caller re-raises them in the order of the chunks.
+        try:
+            self._connect()
+            return True, self._select_chunk(self.domain, chunk_ids)
+        except Exception, e:
+            return False, sys.exc_info()
+
     def select(self, filters={}, sorters=[], limit=None):
         """
         Builds and executes the SQL-like select to the storage.
@@ -207,6 +251,29 @@ class SDBStorage(Storage):
         # Return
         return changes # re-fetch?
 
+    def mstore(self, items):
+        """
+        Creates or updates many items at once, unconditionally (as mstore() is).
+        Actual writes go in batches of 25 items per request (SimpleDB limitation).
+
+        Note that only unconditional writes can be batched in SimpleDB, so mcreate()
+        and mincrement() fall back to per-item conditional writes (see Storage).
+        """
+
+        self._connect()
+
+        results = []
+        chunk_length = 25 #NB: hard-coded limit on number of items in SimpleDB BatchPutAttributes
+        for chunk_offset in xrange(0, len(items), chunk_length):
+            chunk_items = items[chunk_offset:chunk_offset+chunk_length]
+            batch = {}
+            for id, values in chunk_items:
+                values = dict(values, **dict(StorageID(id)))
+                batch[unicode(StorageID(id))] = self._split(values)
+                results.append(values)
+            self.domain.batch_put_attributes(batch, replace=True)
+        return results
+
     def append(self, id, value, retries=1):
         field = 'value'
         def try_append(item):
@@ -272,14 +339,13 @@ class SDBStorage(Storage):
 
     def _connect(self):
         """
-        Connects to the storage if not connected yet.
+        Connects to the storage in the current thread if not connected yet.
         If already connected, does nothing.
         """
-        if not self.connected:
-            self.connection = SDBConnection(self.access_key, self.secret_key)
+        if self.domain is None:
+            self.local.connection = SDBConnection(self.access_key, self.secret_key)
             try:
-                self.domain = self.connection.get_domain(self.name)
+                self.local.domain = self.local.connection.get_domain(self.name)
             except SDBResponseError:
-                self.domain = self.connection.create_domain(self.name)
-            self.connected = True
+                self.local.domain = self.local.connection.create_domain(self.name)
         return self
@@ -0,0 +1,281 @@
+# coding: utf-8
+from ..hashring import HashRing
+from ._base import Storage, StorageID
+from ._base import StorageExpectationError, StorageItemAbsentError
+from multiprocessing.pool import ThreadPool
+import sys
+import threading
+
+__all__ = ['ShardedStorage', 'rebalance']
+
+
+# Process-wide pools of worker threads for the fan-out to the shards, one per concurrency level.
+# They are not shared with the pools of the storages (e.g., SDBStorage), since the shards use
+# those from within these threads, and nested waits on the same pool can exhaust it.
+POOLS = {}
+POOLS_LOCK = threading.Lock()
+
+def get_pool(size):
+    with POOLS_LOCK:
+        if size not in POOLS:
+            POOLS[size] = ThreadPool(size)
+        return POOLS[size]
+
+
+class ShardedStorage(Storage):
+    """
+    Sharding layer, which spreads the items over few storages (shards; e.g., MySQL servers or
+    SimpleDB domains), so that their write throughput is added up. Each item lives in one shard,
+    chosen by consistent hashing of unicode(StorageID(id)) (see HashRing), so adding a shard moves
+    only about 1/N of the items to it, and the rest of them stay where they are.
+
+    The shards are named, and the names (not the order or the storages) define the layout, so the
+    storages can be reconfigured freely as long as the names are kept. The single-item operations
+    go to the item's shard; the multi-item ones are split per shard, sent to the shards in parallel
+    (up to the concurrency), and the results are put back in the order of the request. select()
+    goes to all the shards, and the results are merged (sorted and limited again).
+
+    When the shards are added, the items which move must be copied to their new shards (see
+    rebalance()). Until they are, the storage can be given the names of the shards of the previous
+    layout: the items which are absent in their new shard are then looked up in their old one.
+
+    The items are mapped back to their ids with the key function (the "id" field by default);
+    this is how select() skips the copies left in the old shards after the rebalancing (there is
+    no deletion in the protocol), how mfetch() knows which items are absent in their new shards,
+    and how rebalance() knows where the items belong. The items for which the key cannot be built
+    (e.g., with compound ids and no key function for them) are kept as is, and are not looked up.
+    """
+
+    def __init__(self, shards, key=None, previous=None, replicas=100, concurrency=8):
+        super(ShardedStorage, self).__init__()
+        self.shards = dict(shards) # name -> storage
+        self.ring = HashRing(sorted(self.shards.keys()), replicas=replicas)
+        self.previous = HashRing(previous, replicas=replicas) if previous else None
+        self.key = key or (lambda item: item['id'])
+        self.concurrency = concurrency
+        self.lock = threading.Lock()
+        self.counters = dict(fallbacks=0, stale=0)
+
+    def fetch(self, id):
+        try:
+            return self._storage(id).fetch(id)
+        except StorageItemAbsentError, e:
+            old = self._previous_shard(id)
+            if old is None:
+                raise
+            self._count('fallbacks')
+            return self.shards[old].fetch(id)
+
+    def mfetch(self, ids):
+        groups = self._group(ids)
+        results = self._scatter([(name, self.shards[name].mfetch, ([ids[index] for index in indexes],)) for name, indexes in groups])
+        items = [item for result in results for item in result]
+        if self.previous is None:
+            return items
+
+        # The items which are absent in their new shards are looked up in the old ones.
+        # If the items cannot be mapped to their ids, it is not known which ones are absent.
+        found = set([self._item_key(item) for item in items])
+        if None in found:
+            return items
+        missing = {}
+        for id in ids:
+            old = self._previous_shard(id)
+            if old is not None and unicode(StorageID(id)) not in found:
+                missing.setdefault(old, []).append(id)
+        if missing:
+            self._count('fallbacks', sum(map(len, missing.values())))
+            results = self._scatter([(name, self.shards[name].mfetch, (missing_ids,)) for name, missing_ids in missing.items()])
+            items.extend([item for result in results for item in result])
+        return items
+
+    def select(self, filters={}, sorters=[], limit=None):
+        """
+        Selects the items from all the shards (each of them sorts and limits its own part),
+        and merges them: the parts are sorted already, so the sort only merges the runs.
+        As in the storages themselves, sorters are (field, descending) pairs.
+        """
+        names = sorted(self.shards.keys())
+        results = self._scatter([(name, self.shards[name].select, (filters, sorters, limit)) for name in names])
+        items = []
+        owned = set()
+        others = []
+        for name, result in zip(names, results):
+            for item in result:
+                key = self._item_key(item)
+                if key is None or self.ring.get(key) == name:
+                    items.append(item)
+                    owned.add(key)
+                elif self.previous is not None and self.previous.get(key) == name:
+                    others.append((key, item)) # not copied yet, or copied already (then the owner has it too).
+                else:
+                    self._count('stale') # the copy left in the old shard by rebalance().
+        for key, item in others:
+            if key in owned:
+                self._count('stale')
+            else:
+                items.append(item)
+        for field, descending in reversed(sorters): # the sort is stable, so the first sorter wins.
+            items.sort(key=lambda item: item.get(field), reverse=bool(descending))
+        return items[:limit] if limit else items
+
+    def store(self, id, value, expect=None, unique=None):
+        return self._storage(id).store(id, value, expect=expect, unique=unique)
+
+    def update(self, id, fn, retries=1, field=None):
+        return self._storage(id).update(id, fn, retries=retries, field=field)
+
+    def replace(self, id, fn, retries=1, field=None):
+        return self._storage(id).replace(id, fn, retries=retries, field=field)
+
+    def mstore(self, items):
+        groups = self._group([id for id, values in items])
+        return self._gather(groups, self._scatter([(name, self.shards[name].mstore, ([items[index] for index in indexes],)) for name, indexes in groups]))
+
+    def mincrement(self, steps, retries=1):
+        groups = self._group([id for id, step in steps])
+        return self._gather(groups, self._scatter([(name, self.shards[name].mincrement, ([steps[index] for index in indexes], retries)) for name, indexes in groups]))
+
+    def append(self, id, value, retries=1):
+        return self._storage(id).append(id, value, retries=retries)
+
+    def prepend(self, id, value, retries=1):
+        return self._storage(id).prepend(id, value, retries=retries)
+
+    def increment(self, id, step, retries=1):
+        return self._storage(id).increment(id, step, retries=retries)
+
+    def decrement(self, id, step, retries=1):
+        return self._storage(id).decrement(id, step, retries=retries)
+
+    def try_create(self, factory):
+        """
+        Makes one attempt to create unique item in its shard (the shard is known only when the
+        factory has generated the id). The collision fails the attempt as in any other storage.
+        This method is never used directly; it is called from Storage.create() method in repeating cycle.
+        """
+        item = factory()
+        return self._storage(item['id']).create(lambda: item)
+
+    def try_mcreate(self, factories):
+        """
+        Makes one attempt to create many unique items, in one batch per shard.
+        This method is never used directly; it is called from Storage.mcreate() method in repeating cycle.
+        """
+        items = [factory() for factory in factories]
+        groups = self._group([item['id'] for item in items])
+        return self._gather(groups, self._scatter([(name, self.shards[name].mcreate, ([lambda item=items[index]: item for index in indexes],)) for name, indexes in groups]))
+
+    def stats(self):
+        with self.lock:
+            return dict(self.counters,
+                shards = len(self.shards),
+                previous = len(self.previous.nodes()) if self.previous is not None else 0,
+            )
+
+    def shard(self, id):
+        """
+        Returns the name of the shard the item with the id belongs to.
+        """
+        return self.ring.get(unicode(StorageID(id)))
+
+    def _storage(self, id):
+        return self.shards[self.shard(id)]
+
+    def _previous_shard(self, id):
+        # The old shard of the item, if it has moved (i.e., if it may still be only there).
+        if self.previous is None:
+            return None
+        old = self.previous.get(unicode(StorageID(id)))
+        return old if old != self.shard(id) and old in self.shards else None
+
+    def _item_key(self, item):
+        try:
+            return unicode(StorageID(self.key(item)))
+        except (KeyError, TypeError, NotImplementedError), e:
+            return None
+
+    def _group(self, ids):
+        # The (shard name, indexes of its ids in the request) pairs; the indexes are in the order of the request.
+        groups = {}
+        for index, id in enumerate(ids):
+            groups.setdefault(self.shard(id), []).append(index)
+        return sorted(groups.items())
+
+    def _gather(self, groups, results):
+        # Puts the per-shard results back in the order of the request (the results are in the order of the groups).
+        gathered = [None] * sum([len(indexes) for name, indexes in groups])
+        for (name, indexes), result in zip(groups, results):
+            for index, value in zip(indexes, result):
+                gathered[index] = value
+        return gathered
+
+    def _scatter(self, calls):
+        """
+        Makes the (name, function, args) calls to the shards, in parallel if there are few of them,
+        and returns the results in the order of the calls. If any of the calls fails, the error
+        of the first failed one is raised (after all of them are done), as SDBStorage does.
+        """
+        if len(calls) <= 1 or self.concurrency <= 1:
+            return [fn(*args) for name, fn, args in calls]
+
+        outcomes = get_pool(self.concurrency).map(self._try_call, calls)
+        results = []
+        for success, value in outcomes:
+            if not success:
+                raise value[0], value[1], value[2]
+            results.append(value)
+        return results
+
+    def _try_call(self, call):
+        # Runs in the worker threads; the errors are returned, not raised (see _scatter()).
+        name, fn, args = call
+        try:
+            return True, fn(*args)
+        except Exception, e:
+            return False, sys.exc_info()
+
+    def _count(self, name, value=1):
+        with self.lock:
+            self.counters[name] += value
+
+
+def rebalance(storage, chunk=500):
+    """
+    Copies the items which have moved from the shards of the previous layout to their new shards
+    (see ShardedStorage), and returns the counters of what was done. The items are created in the
+    new shards, so the items which are there already are kept (and are counted as conflicts):
+    e.g., the items written there after the layout has been changed, or the items copied by the
+    previous run of the rebalancing, so it can be re-run safely if it has failed in the middle.
+
+    Note that the counters and the lists incremented & appended in their new shards while they
+    have not been copied yet end up in conflicts; so the writes to these tables must be paused
+    (e.g., the analytics daemon) until their rebalancing is done. The write-once items are fine.
+
+    The copies in the old shards are not deleted (there is no deletion in the protocol); they are
+    skipped by select(), and never fetched. When it is done, the previous layout can be dropped.
+    """
+    if storage.previous is None:
+        raise ValueError("The previous layout of the shards is not specified; there is nothing to move.")
+
+    counters = dict(scanned=0, moved=0, conflicts=0, unknown=0)
+    for name in storage.previous.nodes():
+        if name not in storage.shards:
+            continue # the removed shards are not readable anymore; their items must be copied by other means.
+        moving = {}
+        for item in storage.shards[name].select():
+            counters['scanned'] += 1
+            key = storage._item_key(item)
+            if key is None:
+                counters['unknown'] += 1
+                continue
+            owner = storage.ring.get(key)
+            if owner != name and storage.previous.get(key) == name:
+                moving.setdefault(owner, []).append(dict(item, id=storage.key(item)))
+
+        for owner, items in moving.items():
+            for offset in xrange(0, len(items), chunk):
+                results = storage.shards[owner].mcreate([lambda item=item: dict(item) for item in items[offset:offset+chunk]])
+                for result in results:
+                    counters['conflicts' if isinstance(result, StorageExpectationError) else 'moved'] += 1
+    return counters
@@ -0,0 +1,211 @@
+# coding: utf-8
+from ..cdb import CDB, CDBWriter
+from ._base import Storage, StorageID
+import os
+import struct
+import threading
+import time
+
+__all__ = ['SnapshotStorage', 'export_snapshot']
+
+
+# The key of the record with the names of the fields, in the order of the values in the records.
+# Real keys cannot start with the zero byte, since it is not allowed in the values at all (see below).
+# The numeric fields are kept as "name:type", so that they are returned as numbers, as the live
+# storage returns them; the names with no type (and all the names in the older files) are unicode.
+FIELDS_KEY = '\x00fields'
+SEPARATOR = '\x00'
+TYPES = {int: 'int', long: 'int', float: 'float'}
+CONVERTERS = {'int': int, 'float': float}
+
+
+def _field_type(items, name):
+    """
+    Returns the type of the field (see TYPES) if it is the same for all the items having it, or None.
+    """
+    types = set([TYPES.get(type(item.get(name))) for item in items if item.get(name) is not None])
+    return types.pop() if len(types) == 1 else None
+
+def _parse_field(entry):
+    """
+    Returns the (name, converter) of the entry of the fields record; the converter is None for unicode.
+    """
+    name, colon, kind = entry.rpartition(':')
+    if not name or kind not in CONVERTERS:
+        return entry, None
+    return name, CONVERTERS[kind]
+
+
+def export_snapshot(storage, path, field='id', fields=None):
+    """
+    Exports all the items of the storage (as returned by select()) to the snapshot file,
+    keyed by the field specified. The file is replaced atomically (see CDBWriter).
+    The values of the fields are kept as unicode strings, separated with zero bytes;
+    None values are kept as empty strings, and are not returned as the item's fields.
+    The fields which are numbers in all the items are converted back to numbers on lookups.
+    Items with zero bytes in the values cannot be kept, and are skipped (they will be
+    fetched from the live storage). Returns the number of the items exported.
+
+    If the fields are not specified, all the fields of all the items are exported.
+    """
+    items = storage.select()
+    if fields is None:
+        fields = sorted(set([name for item in items for name in item.keys()]))
+
+    types = [_field_type(items, name) for name in fields]
+
+    count = 0
+    writer = CDBWriter(path)
+    try:
+        writer.add(FIELDS_KEY, SEPARATOR.join([name if kind is None else '%s:%s' % (name, kind) for name, kind in zip(fields, types)]))
+        for item in items:
+            #NB: repr() of the floats, since unicode() rounds them to 12 digits (e.g., the timestamps).
+            values = [u'' if item.get(name) is None else unicode(repr(item[name])) if kind == 'float' else unicode(item[name]) for name, kind in zip(fields, types)]
+            if any(SEPARATOR in value for value in values):
+                continue
+            writer.add(unicode(item[field]).encode('utf-8'), SEPARATOR.join(values).encode('utf-8'))
+            count += 1
+    except:
+        writer.abort()
+        raise
+    writer.finish()
+    return count
+
+
+class SnapshotStorage(Storage):
+    """
+    Read-only snapshot layer, which serves fetch() & mfetch() from the constant database file
+    (see export_snapshot()) if the items are there, and proxies everything else to the wrapped
+    storage, including the fetches of the items which are newer than the snapshot.
+
+    The file is memory-mapped, so the lookups are the page cache reads, and the values are
+    sliced from the mapping with no deserialization; and they do not depend on the wrapped
+    storage at all, so the items in the snapshot are resolved even if the storage is down.
+
+    The snapshot is exported periodically by other process (see shortener_snapshot_exporter.py),
+    and is replaced atomically; the storage checks the file for changes every check_interval
+    seconds, and re-maps the new one. If there is no file yet, all calls go to the storage.
+
+    Since the snapshot is never invalidated by the writes, it must only be used for write-once
+    items (urls). It is keyed by unicode(StorageID(id)), so it must be placed over the wrapper
+    storages that alter the ids (e.g., WrappedStorage), i.e. one snapshot per host.
+    """
+
+    def __init__(self, storage, path, check_interval=10):
+        super(SnapshotStorage, self).__init__()
+        self.storage = storage
+        self.path = path
+        self.check_interval = check_interval
+        self.lock = threading.Lock()
+        self.snapshot = None # (reader, [(name, converter)]) of the currently mapped file.
+        self.checked_ts = None
+        self.counters = dict(hits=0, misses=0, reloads=0, errors=0)
+
+    def fetch(self, id):
+        item = self._lookup(id)
+        if item is None:
+            return self.storage.fetch(id)
+        return item
+
+    def mfetch(self, ids):
+        result = []
+        missing = []
+        for id in ids:
+            item = self._lookup(id)
+            if item is None:
+                missing.append(id)
+            else:
+                result.append(item)
+        if missing:
+            result.extend(self.storage.mfetch(missing))
+        return result
+
+    def select(self, filters={}, sorters=[], limit=None):
+        return self.storage.select(filters=filters, sorters=sorters, limit=limit)
+
+    def store(self, id, value, expect=None, unique=None):
+        return self.storage.store(id, value, expect=expect, unique=unique)
+
+    def create(self, factory, retries=1):
+        return self.storage.create(factory, retries=retries)
+
+    def mcreate(self, factories, retries=1):
+        return self.storage.mcreate(factories, retries=retries)
+
+    def update(self, id, fn, retries=1, field=None):
+        return self.storage.update(id, fn, retries=retries, field=field)
+
+    def replace(self, id, fn, retries=1, field=None):
+        return self.storage.replace(id, fn, retries=retries, field=field)
+
+    def mstore(self, items):
+        return self.storage.mstore(items)
+
+    def mincrement(self, steps, retries=1):
+        return self.storage.mincrement(steps, retries=retries)
+
+    def append(self, id, value, retries=1):
+        return self.storage.append(id, value, retries=retries)
+
+    def prepend(self, id, value, retries=1):
+        return self.storage.prepend(id, value, retries=retries)
+
+    def increment(self, id, step, retries=1):
+        return self.storage.increment(id, step, retries=retries)
+
+    def decrement(self, id, step, retries=1):
+        return self.storage.decrement(id, step, retries=retries)
+
+    def stats(self):
+        snapshot = self._snapshot()
+        with self.lock:
+            return dict(self.counters,
+                keys = len(snapshot[0]) - 1 if snapshot is not None else 0,
+                exported_ts = snapshot[0].mtime if snapshot is not None else None,
+            )
+
+    def _lookup(self, id):
+        snapshot = self._snapshot()
+        if snapshot is None:
+            return None
+
+        reader, fields = snapshot
+        data = reader.get(unicode(StorageID(id)).encode('utf-8'))
+        if data is None:
+            self._count('misses')
+            return None
+
+        self._count('hits')
+        values = data.decode('utf-8').split(SEPARATOR)
+        return dict([(name, convert(value) if convert is not None else value) for (name, convert), value in zip(fields, values) if value])
+
+    def _snapshot(self):
+        """
+        Returns the (reader, fields) of the snapshot, re-mapping the file if it has been replaced.
+        """
+        now = time.time()
+        if self.checked_ts is not None and now - self.checked_ts < self.check_interval:
+            return self.snapshot
+
+        with self.lock:
+            if self.checked_ts is not None and now - self.checked_ts < self.check_interval:
+                return self.snapshot # other thread has just checked it.
+            self.checked_ts = now
+            try:
+                inode = os.stat(self.path).st_ino
+            except OSError, e:
+                return self.snapshot # no new file; keep the old one, if any (it can be deleted, but it is still mapped).
+            if self.snapshot is None or self.snapshot[0].inode != inode:
+                try:
+                    reader = CDB(self.path)
+                    fields = [_parse_field(entry) for entry in reader.get(FIELDS_KEY, '').split(SEPARATOR)]
+                except (EnvironmentError, ValueError, struct.error), e:
+                    self.counters['errors'] += 1
+                    return self.snapshot # broken file (e.g., copied by hand); keep the old one.
+                self.snapshot = (reader, fields) # the old reader is unmapped when it is garbage-collected.
+                self.counters['reloads'] += 1
+            return self.snapshot
+
+    def _count(self, name):
+        with self.lock:
+            self.counters[name] += 1
@@ -0,0 +1,337 @@
+# coding: utf-8
+from ..item import Item
+from ._base import Storage, StorageID
+from ._base import StorageExpectationError, StorageItemAbsentError
+import contextlib
+import sqlite3
+import threading
+
+__all__ = ['SQLiteStorage']
+
+
+# Per-thread connections to the database files, shared by all the storages of the thread
+# that use the same file (the storages are created per host, and there are many of them).
+# SQLite connections cannot be shared by the threads, so each thread opens its own one.
+LOCAL = threading.local()
+
+
+class SQLiteStorage(Storage):
+    """
+    Stores all information in a local SQLite database file, one table per storage.
+    Intended for single-node deployments and for test environments, where there is
+    no MySQL or SimpleDB around: the reads are local, with no network trip at all.
+
+    The database is opened in WAL mode, so the readers do not block the writer and
+    vice versa; the writes of all the processes are serialized by the database lock.
+    Each write takes the lock for the whole operation (BEGIN IMMEDIATE), so conditional
+    writes, increments and appends are atomic with no retries and no expectation errors.
+
+    The tables need no schema: they are created with the key column only, and the columns
+    for the fields are added when the items with new fields are stored. The items are keyed
+    as unicode(StorageID(id)), but the fields of the ids are stored as columns too (as in
+    MysqlStorage), so the items can be selected by them (e.g., by host of WrappedStorage).
+    The columns are untyped, so the values are read back with the types they were written.
+    Fields with NULL values are treated as absent, and are not returned with the items.
+
+    The path must be a file (not ":memory:"), since every thread opens its own connection.
+    """
+
+    KEY = '_key'
+
+    def __init__(self, path, name, timeout=10, mfetch_chunk=500):
+        super(SQLiteStorage, self).__init__()
+        self.path = path
+        self.name = name
+        self.timeout = timeout # how long to wait for the database lock, in seconds.
+        self.mfetch_chunk = mfetch_chunk # SQLite limits the number of parameters per query (999).
+        self.columns = None # the columns known to exist in the table; loaded on first use.
+
+    def store(self, id, value, expect=None, unique=None):
+        """
+        Stores one single item with its id. Supports atomic conditional writes:
+        * Item must be unique, i.e. raise an error if exists (usually checked by `id` field).
+        * Item must meet the condition by one of its fields being equal to specific value.
+        If conditional write fails, the storage raises expectation error.
+        See Storage.repeat() on how to work with this technique.
+        """
+
+        if unique is not None and expect is not None:
+            raise ValueError("Only expect or exists parameter maybe passed, not both.")
+        elif expect is not None:
+            expect_field, expect_value = expect.items()[0]
+        elif unique is not None:
+            expect_field = unique if isinstance(unique, basestring) else 'id'
+            expect_value = False if unique else True
+        else:
+            expect_field, expect_value = None, None
+
+        with self._transaction() as connection:
+            if expect_field is not None:
+                try:
+                    item = self.fetch(id)
+                except StorageItemAbsentError, e:
+                    item = {}
+                if expect_value is False:
+                    satisfied = expect_field not in item
+                elif expect_value is True:
+                    satisfied = expect_field in item
+                else:
+                    satisfied = expect_field in item and unicode(item[expect_field]) == unicode(expect_value)
+                if not satisfied:
+                    raise StorageExpectationError("Storage expecation failed.")
+
+            self._upsert(connection, id, dict(value, **dict(StorageID(id))))
+
+    def fetch(self, id):
+        with self._connected() as connection:
+            cursor = connection.execute('SELECT * FROM %s WHERE %s=?' % (self._quote(self.name), self.KEY), [self._key(id)])
+            items = self._items(cursor)
+            if not items:
+                raise StorageItemAbsentError("The item '%s' is not found." % self._key(id))
+            return items[0]
+
+    def mfetch(self, ids):
+        with self._connected() as connection:
+            keys = list(set([self._key(id) for id in ids]))
+            items = []
+            for offset in xrange(0, len(keys), self.mfetch_chunk):
+                chunk = keys[offset:offset+self.mfetch_chunk]
+                query = 'SELECT * FROM %s WHERE %s IN (%s)' % (self._quote(self.name), self.KEY, ','.join(['?'] * len(chunk)))
+                items.extend(self._items(connection.execute(query, chunk)))
+            return items
+
+    def select(self, filters={}, sorters=[], limit=None):
+        with self._connected() as connection:
+            # The fields which were never stored have no columns; no item can match them then.
+            self._load_columns(connection, refresh=bool(set(filters) - self.columns))
+            if set(filters) - self.columns:
+                return []
+
+            values = []
+            clauses = []
+            for field, value in filters.items():
+                clauses.append('%s IS ?' % self._quote(field) if value is None else '%s=?' % self._quote(field))
+                values.append(value)
+            orders = ['%s %s' % (self._quote(field), ["ASC","DESC"][int(bool(order))]) for field, order in sorters if field in self.columns]
+
+            query = ''
+            query += ('SELECT * FROM %s' % self._quote(self.name))
+            query += (' WHERE %s'    % ' AND '.join(clauses)) if clauses else ''
+            query += (' ORDER BY %s' % ', '.join(orders)    ) if orders  else ''
+            query += (' LIMIT %d'    % int(limit)           ) if limit   else ''
+            return self._items(connection.execute(query, values))
+
+    def try_create(self, factory):
+        """
+        Makes one attempt to create unique item in the storage.
+        Fails if there is an item with the same id.
+        This method is never used directly; it is called from Storage.create() method in repeating cycle.
+        """
+
+        with self._transaction() as connection:
+            return self._insert(connection, factory())
+
+    def try_mcreate(self, factories):
+        """
+        Makes one attempt to create many unique items in the storage, all in one transaction.
+        The items which ids already exist are not overwritten, and are reported as failed.
+        This method is never used directly; it is called from Storage.mcreate() method in repeating cycle.
+        """
+
+        with self._transaction() as connection:
+            results = []
+            for factory in factories:
+                try:
+                    results.append(self._insert(connection, factory()))
+                except StorageExpectationError, e:
+                    results.append(e)
+            return results
+
+    def try_update(self, id, fn, field=None):
+        """
+        Makes one attempt to create or update an item in the storage.
+        The item cannot be changed between fetch() and store(), since the database is locked.
+        This method is never used directly; it is called from Storage.update() method in repeating cycle.
+        """
+
+        with self._transaction() as connection:
+            pk = dict(StorageID(id))
+            try:
+                item = self.fetch(id)
+            except StorageItemAbsentError, e:
+                item = Item() # what if it is of another type???
+                item.update(pk)
+
+            changes = fn(item)
+            changes.update(pk)
+            self._upsert(connection, id, changes)
+            return changes
+
+    def try_replace(self, id, fn, field=None):
+        """
+        Makes one attempt to update an item in the storage. Fails if the item does not exist.
+        The item cannot be changed between fetch() and store(), since the database is locked.
+        This method is never used directly; it is called from Storage.replace() method in repeating cycle.
+        """
+
+        with self._transaction() as connection:
+            try:
+                item = self.fetch(id)
+            except StorageItemAbsentError, e:
+                raise # just to make it very obvious that we pass it through.
+
+            changes = fn(item)
+            self._upsert(connection, id, changes)
+            return changes
+
+    def mstore(self, items):
+        """
+        Creates or updates many items at once, all in one transaction (i.e., one disk sync).
+        """
+
+        with self._transaction() as connection:
+            results = [dict(values, **dict(StorageID(id))) for id, values in items]
+            for (id, values), result in zip(items, results):
+                self._upsert(connection, id, result)
+            return results
+
+    def mincrement(self, steps, retries=1):
+        """
+        Increments many counters at once, all in one transaction (i.e., one disk sync).
+        """
+
+        with self._transaction():
+            return [self.increment(id, step, retries=retries) for id, step in steps]
+
+    def append(self, id, value, retries=1):
+        return self._modify(id, "coalesce(value,'')||?", value, default=value)
+
+    def prepend(self, id, value, retries=1):
+        return self._modify(id, "?||coalesce(value,'')", value, default=value)
+
+    def increment(self, id, step, retries=1):
+        return self._modify(id, "coalesce(value,0)+?", int(step), default=int(step))
+
+    def decrement(self, id, step, retries=1):
+        # No special support or optimizations for decrement operation.
+        return self.increment(id, -step, retries=retries)
+
+    def _modify(self, id, expression, argument, default):
+        """
+        Changes the value field of the item with the SQL expression, or creates the item with
+        the default value if it does not exist. Returns the new value. The database is locked
+        for the whole operation, so no one can change the value between the write and the read.
+        """
+        #NB: since the database is locked, there is no need to retries.
+
+        value_field = 'value'
+        with self._transaction() as connection:
+            self._ensure_columns(connection, [value_field])
+            query = 'UPDATE %s SET %s=%s WHERE %s=?' % (self._quote(self.name), value_field, expression, self.KEY)
+            if not connection.execute(query, [argument, self._key(id)]).rowcount:
+                self._upsert(connection, id, dict(dict(StorageID(id)), **{value_field: default}))
+            return self.fetch(id)[value_field]
+
+    def _insert(self, connection, item):
+        # Normalize the id for key-value usage scenario, but keep its fields, as MysqlStorage does.
+        key = self._key(item['id'])
+        item.update(dict(StorageID(item['id'])))
+        values = dict(item)
+
+        self._ensure_columns(connection, values.keys())
+        fields = [self.KEY] + values.keys()
+        query = 'INSERT INTO %s (%s) VALUES (%s)' % (self._quote(self.name), ','.join(map(self._quote, fields)), ','.join(['?'] * len(fields)))
+        try:
+            connection.execute(query, [key] + values.values())
+        except sqlite3.IntegrityError, e:
+            raise StorageExpectationError("Storage expecation failed.")
+        return item
+
+    def _upsert(self, connection, id, values):
+        # Must be called within the transaction: nobody can insert the item between these two queries.
+        # This works with any version of SQLite, unlike INSERT ... ON CONFLICT DO UPDATE (3.24+).
+        key = self._key(id)
+        self._ensure_columns(connection, values.keys())
+        if values:
+            assignments = ','.join(['%s=?' % self._quote(field) for field in values.keys()])
+            query = 'UPDATE %s SET %s WHERE %s=?' % (self._quote(self.name), assignments, self.KEY)
+            if connection.execute(query, values.values() + [key]).rowcount:
+                return
+        fields = [self.KEY] + values.keys()
+        query = 'INSERT INTO %s (%s) VALUES (%s)' % (self._quote(self.name), ','.join(map(self._quote, fields)), ','.join(['?'] * len(fields)))
+        connection.execute(query, [key] + values.values())
+
+    def _items(self, cursor):
+        names = [description[0] for description in cursor.description]
+        return [dict((name, value) for name, value in zip(names, row) if name != self.KEY and value is not None)
+                for row in cursor.fetchall()]
+
+    def _key(self, id):
+        return unicode(StorageID(id))
+
+    def _quote(self, name):
+        """
+        Escapes field and table names for use in queries (they are quoted as identifiers).
+        Does not escape data values with this! Use parameter binding instead!
+        """
+        return '"%s"' % unicode(name).replace('"', '""')
+
+    def _load_columns(self, connection, refresh=False):
+        if self.columns is None or refresh:
+            cursor = connection.execute('PRAGMA table_info(%s)' % self._quote(self.name))
+            self.columns = set([row[1] for row in cursor.fetchall()])
+
+    def _ensure_columns(self, connection, fields):
+        """
+        Adds the columns for the fields which have none yet. Must be called within the transaction,
+        so that other processes cannot add the same columns at the same time (they wait for the lock).
+        """
+        missing = set(fields) - self.columns
+        if missing:
+            self._load_columns(connection, refresh=True) # maybe other processes have added them already.
+            for field in set(fields) - self.columns:
+                connection.execute('ALTER TABLE %s ADD COLUMN %s' % (self._quote(self.name), self._quote(field)))
+                self.columns.add(field)
+
+    @contextlib.contextmanager
+    def _connected(self):
+        """
+        Provides the connection of the current thread to the database file, opening it if necessary.
+        The connection is in autocommit mode: the reads see the latest data committed by anyone.
+        """
+        connections = LOCAL.__dict__.setdefault('connections', {})
+        connection = connections.get(self.path)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=self.timeout, isolation_level=None)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL') # durable enough in WAL mode; much faster writes.
+            connections[self.path] = connection
+        if self.columns is None:
+            connection.execute('CREATE TABLE IF NOT EXISTS %s (%s TEXT NOT NULL PRIMARY KEY)' % (self._quote(self.name), self.KEY))
+            self._load_columns(connection)
+        yield connection
+
+    @contextlib.contextmanager
+    def _transaction(self):
+        """
+        Runs the operation in a write transaction, which is committed if the operation succeeds,
+        and is rolled back if it fails. Nested operations (e.g., increment() within mincrement(),
+        or any operation of another storage on the same file) join the outer transaction.
+        """
+        with self._connected() as connection:
+            depths = LOCAL.__dict__.setdefault('depths', {})
+            if depths.get(self.path):
+                yield connection
+                return
+
+            connection.execute('BEGIN IMMEDIATE') # takes the write lock now, not on the first write.
+            depths[self.path] = 1
+            try:
+                yield connection
+            except:
+                connection.execute('ROLLBACK')
+                raise
+            else:
+                connection.execute('COMMIT')
+            finally:
+                depths[self.path] = 0
@@ -52,6 +52,9 @@ class WrappedStorage(Storage):
     def select(self, filters={}, sorters=[], limit=None):
         return self.storage.select(filters=dict(filters, host=self.host), sorters=sorters, limit=limit)
 
+    def store(self, id, value, expect=None, unique=None):
+        return self.storage.store(self._wrap_id(id), value, expect=expect, unique=unique)
+
     def create(self, factory, retries=1):
         return self.storage.create(self._wrap_factory(factory), retries=retries)
 
@@ -61,6 +64,15 @@ class WrappedStorage(Storage):
     def replace(self, id, fn, retries=1, field=None):
         return self.storage.replace(self._wrap_id(id), fn, retries=retries, field=field)
 
+    def mcreate(self, factories, retries=1):
+        return self.storage.mcreate(list(map(self._wrap_factory, factories)), retries=retries)
+
+    def mstore(self, items):
+        return self.storage.mstore([(self._wrap_id(id), values) for id, values in items])
+
+    def mincrement(self, steps, retries=1):
+        return self.storage.mincrement([(self._wrap_id(id), step) for id, step in steps], retries=retries)
+
     def append(self, id, value, retries=1):
         return self.storage.append(self._wrap_id(id), value, retries=retries)
 
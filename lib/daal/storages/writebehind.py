@@ -0,0 +1,303 @@
+# coding: utf-8
+from ._base import Storage, StorageID
+from ._base import StorageExpectationError
+import atexit
+import threading
+import time
+import traceback
+import weakref
+
+__all__ = ['WriteBehindStorage', 'flush_all']
+
+
+# All the write-behind storages of the process, to flush them periodically and on exit.
+INSTANCES = weakref.WeakSet()
+INSTANCES_LOCK = threading.Lock()
+FLUSHER = None
+FLUSHER_TICK = 0.1 # seconds between the checks of the time thresholds.
+STOPPING = threading.Event()
+
+
+def flush_all():
+    """
+    Flushes all the pending writes of all the write-behind storages of the process
+    (e.g., on the graceful shutdown of the daemon); the failures are printed, and do
+    not stop other storages. Called on the interpreter exit too.
+    """
+    with INSTANCES_LOCK:
+        storages = list(INSTANCES)
+    for storage in storages:
+        try:
+            storage.flush()
+        except Exception, e:
+            traceback.print_exc()
+
+
+def flush_due():
+    while not STOPPING.is_set():
+        time.sleep(FLUSHER_TICK)
+        with INSTANCES_LOCK:
+            storages = list(INSTANCES)
+        for storage in storages:
+            storage.flush_if_due()
+
+
+def shutdown():
+    # The flusher is stopped first, since the daemon threads must not run while the interpreter is finalized.
+    STOPPING.set()
+    if FLUSHER is not None:
+        FLUSHER.join()
+    flush_all()
+
+atexit.register(shutdown)
+
+
+class WriteBehindStorage(Storage):
+    """
+    Write-behind layer for the counters and the lists (e.g., of the analytics dimensions),
+    which accumulates increments & appends in memory, per item, and writes them to the wrapped
+    storage as aggregated deltas: one mincrement() of +k instead of k increments of +1, and
+    one append() of the concatenated values instead of k appends. So the hot items (popular
+    domains) cost one write per flush, no matter how many urls are registered for them.
+
+    The pending writes are flushed when there are max_pending items with pending writes,
+    or when the oldest pending write is max_delay seconds old (checked by the background
+    thread, so idle processes flush too), on flush(), when the storage is garbage-collected,
+    and on the interpreter exit. If the process is killed, the writes of at most max_delay
+    seconds (or max_pending items) are lost; this is the price of the batching. If the flush
+    fails, the writes are kept pending, and are retried on the next flush.
+
+    The first increment of the item since the previous flush is written through, since its
+    value is not known yet (a fetch would cost nearly the same as the write). The following ones
+    are pending, and return the last written value plus the pending delta, so that the callers
+    see the value growing by the step on every call, as with the direct writes. This is what
+    the grid levels of the popular domains dimension need to detect the threshold crossings.
+    The value does not include the increments of other processes since the last flush; they
+    appear (as a jump) after the flush. So the crossings within the jump are not detected,
+    and the crossings can be detected by few processes. Both are fine for the dimension.
+
+    The appends return None, since the value is not known until flushed. The reads (fetch &
+    mfetch) flush the pending writes of the items requested first, so the reads see the writes.
+    Everything else is proxied to the wrapped storage as is.
+    """
+
+    def __init__(self, storage, max_pending=1000, max_delay=1.0, retries=3):
+        super(WriteBehindStorage, self).__init__()
+        self.storage = storage
+        self.max_pending = max_pending
+        self.max_delay = max_delay # None disables the time threshold.
+        self.retries = retries
+        self.lock = threading.Lock() # for the state below.
+        self.flush_lock = threading.Lock() # one flush at a time, since they restore the failed deltas.
+        self.increments = {} # key -> [id, delta] of the pending increments.
+        self.appends = {} # key -> [id, [values]] of the pending appends.
+        self.pending_ts = None # when the oldest pending write was made.
+        self.known = {} # key -> the last value written (plus the deltas being flushed).
+        self.touched = set() # keys incremented since the last flush; other known values are dropped as stale.
+        self.counters = dict(increments=0, appends=0, written_through=0, flushes=0, flushed_increments=0, flushed_appends=0, errors=0)
+        self._register()
+
+    def __del__(self):
+        # E.g., the component is evicted from the cache of the components; its writes must not be lost.
+        try:
+            self.flush()
+        except Exception, e:
+            traceback.print_exc()
+
+    def fetch(self, id):
+        self._flush([self._key(id)])
+        return self.storage.fetch(id)
+
+    def mfetch(self, ids):
+        self._flush([self._key(id) for id in ids])
+        return self.storage.mfetch(ids)
+
+    def select(self, filters={}, sorters=[], limit=None):
+        self.flush()
+        return self.storage.select(filters=filters, sorters=sorters, limit=limit)
+
+    def store(self, id, value, expect=None, unique=None):
+        self._flush([self._key(id)])
+        return self.storage.store(id, value, expect=expect, unique=unique)
+
+    def create(self, factory, retries=1):
+        return self.storage.create(factory, retries=retries)
+
+    def mcreate(self, factories, retries=1):
+        return self.storage.mcreate(factories, retries=retries)
+
+    def update(self, id, fn, retries=1, field=None):
+        self._flush([self._key(id)])
+        return self.storage.update(id, fn, retries=retries, field=field)
+
+    def replace(self, id, fn, retries=1, field=None):
+        self._flush([self._key(id)])
+        return self.storage.replace(id, fn, retries=retries, field=field)
+
+    def mstore(self, items):
+        self._flush([self._key(id) for id, values in items])
+        return self.storage.mstore(items)
+
+    def mincrement(self, steps, retries=1):
+        return [self.increment(id, step, retries=retries) for id, step in steps]
+
+    def append(self, id, value, retries=1):
+        key = self._key(id)
+        with self.lock:
+            self.appends.setdefault(key, [id, []])[1].append(value)
+            self.counters['appends'] += 1
+            self._pending()
+        self.flush_if_due()
+
+    def prepend(self, id, value, retries=1):
+        # Not batched; the order against the pending appends does not matter for the value.
+        return self.storage.prepend(id, value, retries=retries)
+
+    def increment(self, id, step, retries=1):
+        key = self._key(id)
+        with self.lock:
+            self.counters['increments'] += 1
+            self.touched.add(key)
+            if key in self.known:
+                self.increments.setdefault(key, [id, 0])[1] += step
+                self.known[key] += step
+                self._pending()
+                value = self.known[key]
+            else:
+                value = None
+        if value is None:
+            value = self.storage.increment(id, step, retries=retries)
+            with self.lock:
+                self.counters['written_through'] += 1
+                if key in self.known:
+                    # Other thread has written it through too, and has pending deltas already. The value must not
+                    # go down for the callers, so the higher one is kept: the written one lacks the pending deltas,
+                    # and the known one lacks the increments of other processes and this step.
+                    pending = self.increments.get(key, [id, 0])[1]
+                    self.known[key] = max(self.known[key] + step, int(value) + pending)
+                    value = self.known[key]
+                else:
+                    self.known[key] = int(value)
+        self.flush_if_due()
+        return value
+
+    def decrement(self, id, step, retries=1):
+        # No special support or optimizations for decrement operation.
+        return self.increment(id, -step, retries=retries)
+
+    def flush(self):
+        """
+        Writes all the pending writes to the wrapped storage. If it fails, the writes are kept
+        pending, and the error is raised (unlike the automatic flushes, which only count them).
+        """
+        self._flush(None)
+
+    def flush_if_due(self):
+        """
+        Flushes the pending writes if the size or the time threshold is reached.
+        The errors are counted (see stats()); the writes are kept pending then.
+        """
+        with self.lock:
+            size = len(self.increments) + len(self.appends)
+            due = size >= self.max_pending or (self.pending_ts is not None and self.max_delay is not None and time.time() - self.pending_ts >= self.max_delay)
+        if due and self.flush_lock.acquire(False): # if it is being flushed already, this is fine.
+            try:
+                self._flush(None, locked=True)
+            except Exception, e:
+                pass # counted in _flush().
+            finally:
+                self.flush_lock.release()
+
+    def stats(self):
+        with self.lock:
+            return dict(self.counters,
+                pending_increments = len(self.increments),
+                pending_appends = len(self.appends),
+                pending_age = time.time() - self.pending_ts if self.pending_ts is not None else 0.0,
+                known = len(self.known),
+            )
+
+    def _flush(self, keys, locked=False):
+        """
+        Writes the pending writes of the keys (or all of them, if keys is None).
+        The deltas being written are taken out of the pending ones, so the new writes
+        are accumulated while the flush is in progress; the failed ones are put back.
+        """
+        if not locked:
+            with self.flush_lock:
+                return self._flush(keys, locked=True)
+
+        with self.lock:
+            if keys is None:
+                increments, self.increments = self.increments, {}
+                appends, self.appends = self.appends, {}
+                self.pending_ts = None
+                # The values of the items not incremented since the last flush are stale; they are written through again.
+                self.known = dict([(key, value) for key, value in self.known.items() if key in self.touched])
+                self.touched = set()
+            else:
+                increments = dict([(key, self.increments.pop(key)) for key in keys if key in self.increments])
+                appends = dict([(key, self.appends.pop(key)) for key in keys if key in self.appends])
+                if not self.increments and not self.appends:
+                    self.pending_ts = None
+        if not increments and not appends:
+            return
+
+        failed_increments = {}
+        failed_appends = {}
+        error = None
+        try:
+            steps = increments.items()
+            results = self.storage.mincrement([(id, delta) for key, (id, delta) in steps], retries=self.retries) if steps else []
+            for (key, (id, delta)), result in zip(steps, results):
+                if isinstance(result, StorageExpectationError):
+                    failed_increments[key] = [id, delta]
+                else:
+                    with self.lock:
+                        if key in self.known:
+                            # The deltas pending since the flush has started are not in the result yet.
+                            self.known[key] = max(self.known[key], int(result) + self.increments.get(key, [id, 0])[1])
+        except Exception, e:
+            failed_increments = dict(increments) # the batch is written as a whole or not at all.
+            error = e
+
+        for key, (id, values) in appends.items():
+            try:
+                self.storage.append(id, ''.join(values), retries=self.retries)
+            except Exception, e:
+                failed_appends[key] = [id, values]
+                error = e
+
+        with self.lock:
+            self.counters['flushes'] += 1
+            self.counters['flushed_increments'] += len(increments) - len(failed_increments)
+            self.counters['flushed_appends'] += len(appends) - len(failed_appends)
+            if failed_increments or failed_appends:
+                self.counters['errors'] += 1
+                for key, (id, delta) in failed_increments.items():
+                    self.increments.setdefault(key, [id, 0])[1] += delta
+                    self.touched.add(key) #NB: the known value is not changed, since the delta is still in it.
+                for key, (id, values) in appends.items():
+                    if key in failed_appends:
+                        self.appends.setdefault(key, [id, []])[1][:0] = values # before the newer ones.
+                self._pending()
+        if error is not None:
+            raise error
+        elif failed_increments:
+            raise StorageExpectationError("Storage expecation failed.")
+
+    def _pending(self):
+        if self.pending_ts is None:
+            self.pending_ts = time.time()
+
+    def _key(self, id):
+        return unicode(StorageID(id))
+
+    def _register(self):
+        global FLUSHER
+        with INSTANCES_LOCK:
+            INSTANCES.add(self)
+            if FLUSHER is None:
+                FLUSHER = threading.Thread(target=flush_due, name='write-behind flusher')
+                FLUSHER.daemon = True
+                FLUSHER.start()
@@ -1,5 +1,5 @@
 # coding: utf-8
-from ..url import URL
+from ..url import URLRecord
 from ._base import Dimension
 import time
 
@@ -49,7 +49,7 @@ class RecentTargetsDimension(Dimension):
         items = self.storage.select(sorters=[('timestamp', True)], limit=n)
         items = items[:n]
         #TODO: return as list of URL instances?
-        items = [URL(**item) for item in items]
+        items = [URLRecord(**item) for item in items]
         return items
 
     def maintain(self):
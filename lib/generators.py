@@ -1,5 +1,12 @@
 # coding: utf-8
 from .daal.storages import StorageExpectationError, StorageItemAbsentError
+import collections
+import hashlib
+import logging
+import os
+import random
+import threading
+import time
 import re
 
 LOWERS = 'abcdefghijklmnopqrstuvwxyz'
@@ -19,8 +26,14 @@ class Generator(object):
     are not in responsivility of the generators. IDs are strings with all the characters
     possible in URLs without being encoded. The main generation method is generate().
     The generator can also be used with the built-in next(generator_instance) method.
+
+    Content-addressed generators (with "addressable" flag set) derive the ids from the
+    urls, so the same url always gets the same candidate ids. They are used through
+    candidates() method, and the shortener checks if the url is stored already.
     """
 
+    addressable = False
+
     def __init__(self):
         super(Generator, self).__init__()
 
@@ -35,6 +48,21 @@ class Generator(object):
         """
         raise NotImplemented()
 
+    def generate_many(self, count):
+        """
+        Generates few identifiers at once. Generators that can allocate them in bulk
+        (e.g., with one single storage update) override this; others generate one by one.
+        """
+        return [self.generate() for i in xrange(count)]
+
+    def candidates(self, url):
+        """
+        Yields the identifiers to try for the url, one per each attempt to store it.
+        For regular generators, these are just the new identifiers, regardless of the url.
+        """
+        while True:
+            yield self.generate()
+
 
 class FakeGenerator(Generator):
     """
@@ -50,6 +78,110 @@ class FakeGenerator(Generator):
         return unicode(FakeGenerator.counter)
 
 
+class TimeGenerator(Generator):
+    """
+    Coordination-free generator, which needs no storage at all. Each id is built as a
+    number of three parts: the time (in ticks since the epoch), the node id, and the per-
+    process counter within the tick; and the number is then encoded with the letters.
+
+        number = (tick << (node_bits + counter_bits)) | (node << counter_bits) | counter
+
+    The node id must be unique for each process generating the ids (e.g., configured as
+    a combination of the machine and the worker numbers). If it is not specified, the pid
+    is used, which is unique within one machine only. If the ids collide anyway, the
+    shortener retries the creation with the next id, as with all other generators.
+
+    The length of the ids depends on the bits and the resolution: each tick gives
+    2**(node_bits+counter_bits) ids, so the coarser ticks and the fewer bits make the ids
+    shorter, but limit the capacity per node per tick. When the counter is exhausted
+    within the tick, the generator waits for the next tick.
+
+    The state (last tick and counter) is process-wide, so the instances can be created
+    per request. Same node id must never be used in two processes at the same time.
+    The state is kept per configuration, since the ticks of different resolutions and
+    epochs are not comparable (e.g., for the hosts with different capacity settings).
+    """
+
+    EPOCH = 1300000000 # 2011-03-13, an arbitrary moment before the very first id.
+
+    lock = threading.Lock()
+    states = {} # (node, node_bits, counter_bits, resolution, epoch) -> [last tick, last counter]
+
+    def __init__(self, node=None, node_bits=10, counter_bits=12, resolution=1.0, epoch=None, letters=None, prohibit=None):
+        super(TimeGenerator, self).__init__()
+        self.node_bits = node_bits
+        self.counter_bits = counter_bits
+        self.node = (node if node is not None else os.getpid()) % (1 << node_bits)
+        self.resolution = resolution
+        self.epoch = epoch if epoch is not None else self.EPOCH
+        self.codec = Codec(letters=letters, prohibit=prohibit)
+        self.key = (self.node, self.node_bits, self.counter_bits, self.resolution, self.epoch)
+
+    def generate(self):
+        while True:
+            tick, counter = self._next()
+            number = (tick << (self.node_bits + self.counter_bits)) | (self.node << self.counter_bits) | counter
+            result = self.codec.encode(number)
+            if not (self.codec.prohibit and self.codec.prohibit.search(result)):
+                return result
+
+    def _next(self):
+        """
+        Returns the next unique (tick, counter) pair for this node & configuration in this process.
+        If the clock goes backwards, the last known tick is used until the clock catches up.
+        """
+        while True:
+            tick = int((time.time() - self.epoch) / self.resolution)
+            with self.lock:
+                state = self.states.setdefault(self.key, [tick, -1])
+                if tick > state[0]:
+                    state[:] = [tick, -1]
+                if state[1] + 1 < (1 << self.counter_bits):
+                    state[1] = state[1] + 1
+                    return state[0], state[1]
+            time.sleep(self.resolution / 10.0)
+
+
+class HashGenerator(Generator):
+    """
+    Content-addressed generator: the id is the low-order digits of the url's hash, encoded
+    with the letters. There is no state and no storage, so there is no central counter.
+
+    The candidates start with the last min_length digits, and each next candidate is one
+    digit longer; they are used when the shorter one is taken by another url. The low-order
+    digits are uniform, unlike the leading ones: the hash is not a power of the base, so the
+    first digit of its encoding is heavily skewed to few letters, and the codes would collide.
+    The same url always gets the same candidates, so the shortener finds the url already
+    stored under one of them, and returns it instead of storing a duplicate.
+
+    The salt (e.g., the host) makes the hash space different for different shorteners;
+    otherwise, the same url would get the same id in all of them (which is not a problem,
+    since the storages are isolated per host anyway).
+    """
+
+    addressable = True
+
+    def __init__(self, min_length=4, max_length=None, letters=None, prohibit=None, salt=''):
+        super(HashGenerator, self).__init__()
+        self.min_length = min_length
+        self.max_length = max_length
+        self.salt = salt
+        self.codec = Codec(letters=letters, prohibit=prohibit)
+
+    def generate(self):
+        raise NotImplementedError("Content-addressed generator needs the url; use candidates(url).")
+
+    def candidates(self, url):
+        digest = hashlib.sha256((u'%s %s' % (self.salt, url)).encode('utf-8')).hexdigest()
+        value = self.codec.encode(int(digest, 16))
+        max_length = min(self.max_length or len(value), len(value))
+        for length in xrange(self.min_length, max_length + 1):
+            result = value[-length:]
+            if not (self.codec.prohibit and self.codec.prohibit.search(result)):
+                yield result
+        raise DepletedError("All ids for the url are taken.")
+
+
 class CentralizedGenerator(Generator):
     """
     Basic persistent generator. Stores its last generated value in the storage
@@ -58,34 +190,371 @@ class CentralizedGenerator(Generator):
     or write-expect'ing algorythms, being a bottleneck.
     """
 
-    def __init__(self, storage, id='centralized', letters=None, prohibit=None):
+    def __init__(self, storage, id='centralized', letters=None, prohibit=None, lease=None):
         super(CentralizedGenerator, self).__init__()
         self.storage = storage
         self.id = id
         self.letters = letters
         self.prohibit = prohibit
+        self.lease = lease
 
     def generate(self):
-        result = Sequence(self.storage, self.id, letters=self.letters, prohibit=self.prohibit).generate()
+        sequence = Sequence(self.storage, self.id, letters=self.letters, prohibit=self.prohibit)
+        if self.lease is not None:
+            result = self.lease.take(sequence)
+        else:
+            result = sequence.generate()
         return result
 
+    def generate_many(self, count):
+        # The whole batch is reserved at once, bypassing the lease (which is sized for single ids).
+        sequence = Sequence(self.storage, self.id, letters=self.letters, prohibit=self.prohibit)
+        return sequence.reserve(count) if count > 0 else []
+
+
+class DistributedGenerator(Generator):
+    """
+    Persistent generator with the state spread over a pool of sequences, so that the
+    flow of requests is distributed among few stored items instead of one single item.
+
+    The id is built of two parts: a prefix, which identifies one of the child sequences,
+    and a suffix of fixed length, generated by that child sequence. The suffix length is
+    fixed, so the ids from different children never collide ("ab"+"c" vs "a"+"bc" is not
+    possible). The root item keeps the pool of currently active children (their prefixes),
+    and the requesters choose one of them randomly for each id.
+
+    When a child is depleted (all suffixes of the fixed length are used), it is removed
+    from the pool, and the pool is re-populated with the new children, whose prefixes are
+    generated by the root's own sequence. Since each child has len(letters)**part_length
+    ids, the root is locked very rarely in comparison to the children.
+
+    All items (the root pool, the root sequence, the children sequences) are stored in the
+    same storage under the ids derived from the generator's id: "<id>", "<id>/", "<id>/<prefix>".
+    Only the "value" field is used, so it works with any storage suitable for Sequence.
+    Note that the pool is stored as a space-separated list of prefixes in one value, so
+    pool_size must be small enough to fit into the storage's limits on value length.
+
+    See _drafts/generators_distributed.py for the original concept. This implementation
+    has only two levels of the tree (root & leaves), since the root's sequence just grows
+    in length when depleted, and there is no need for deeper levels.
+    """
+
+    def __init__(self, storage, id='distributed', letters=None, prohibit=None, pool_size=10, part_length=2, retries=10):
+        super(DistributedGenerator, self).__init__()
+        self.storage = storage
+        self.id = id
+        self.letters = letters
+        self.prohibit = re.compile(prohibit, re.X) if prohibit else None
+        self.pool_size = pool_size
+        self.part_length = part_length
+        self.retries = retries
+
+    def generate(self):
+        retries = self.retries
+        while True:
+            # Choose one of the active children randomly; populate the pool if there are none yet.
+            children = self._fetch_children() or self._restructure(None)
+            prefix = random.choice(children)
+
+            # Generate the suffix in that child. If it is depleted, remove it from the pool and try again.
+            sequence = Sequence(self.storage, '%s/%s' % (self.id, prefix), letters=self.letters,
+                                min_length=self.part_length, max_length=self.part_length)
+            try:
+                result = prefix + sequence.generate()
+            except DepletedError, e:
+                retries = retries - 1
+                if retries <= 0:
+                    raise
+                self._restructure(prefix)
+                continue
+
+            # Prohibited ids are just skipped; the suffix is used, so next time it will be different.
+            if self.prohibit and self.prohibit.search(result):
+                continue
+
+            return result
+
+    def _fetch_children(self):
+        try:
+            item = self.storage.fetch(self.id)
+        except StorageItemAbsentError, e:
+            return []
+        return (item.get('value', None) or '').split()
+
+    def _restructure(self, depleted):
+        """
+        Removes the depleted child from the pool (if any), and re-populates the pool
+        with new children up to its size. Returns the new list of the children.
+        """
+        prefixes = Sequence(self.storage, '%s/' % self.id, letters=self.letters, prohibit=self.prohibit and self.prohibit.pattern)
+        def try_restructure(data):
+            children = (data.get('value', None) or '').split()
+            if depleted in children:
+                children.remove(depleted)
+            while len(children) < self.pool_size:
+                children.append(prefixes.generate())
+            return {'value': ' '.join(children)}
+        item = self.storage.update(self.id, try_restructure,
+            field = 'value',#!!! this should be somehow removed
+            retries = self.retries)
+        return item['value'].split()
+
+
+class CounterGenerator(Generator):
+    """
+    Persistent generator, which gets unique numbers from the storage's atomic counter
+    (see increment() in the storages), and converts them to the ids with the Codec.
+    With MysqlStorage, this is one single statement per id (no read-modify-write cycle
+    as in the Sequence), so the row lock on the counter is held for a very short time.
+
+    Prohibited ids are skipped by incrementing the counter over the whole prohibited
+    range at once. Note that the counter starts from scratch, so if it is used instead
+    of another generator, the ids can collide with the existing ones for a while
+    (they are then just skipped by the shortener's retries).
+    """
+
+    def __init__(self, storage, id='counter', letters=None, prohibit=None, min_length=None):
+        super(CounterGenerator, self).__init__()
+        self.storage = storage
+        self.id = id
+        self.codec = Codec(letters=letters, min_length=min_length, prohibit=prohibit)
+
+    def generate(self):
+        number = int(self.storage.increment(self.id, +1))
+        while True:
+            allowed = self.codec.skip(number)
+            if allowed == number:
+                return self.codec.encode(number)
+            number = int(self.storage.increment(self.id, allowed - number))
+
+    def generate_many(self, count):
+        # The counter is incremented once per batch, and the prohibited numbers of the
+        # range are dropped; the missing ids are then taken with another increment.
+        # If the prohibited range goes beyond the batch, the counter jumps over it at once.
+        result = []
+        while len(result) < count:
+            wanted = count - len(result)
+            last = int(self.storage.increment(self.id, +wanted))
+            for number in xrange(last - wanted + 1, last + 1):
+                allowed = self.codec.skip(number)
+                if allowed == number:
+                    result.append(self.codec.encode(number))
+                elif allowed > last:
+                    self.storage.increment(self.id, allowed - last - 1)
+                    break
+        return result
+
+
+class PoolGenerator(Generator):
+    """
+    Generator backed by a pool of pre-generated ids, stored in fixed number of slots.
+    Each slot contains an id and its state ("free" or "used"). The requesters claim
+    a random free slot with one conditional write, so they rarely compete for the same
+    item, and the latency does not depend on the contention of the source generator.
+
+    The pool is refilled in bulk by refill(), which is expected to be called in background
+    (e.g., by the analytics daemon when it is idle). It fills all used or absent slots with
+    new ids from the source generator, with one batch of ids and one batch write per chunk.
+    If there are no free slots found after few probes, the id is generated by the source
+    generator directly, so the pool never blocks.
+
+    The fill level of the pool is observable in two ways: refill() returns the exact
+    number of free slots before the refill (and logs a warning if it is below the low-water
+    mark); and the requesters estimate the fill level by the ratio of successful probes
+    (see stats()), since the slots are probed randomly.
+    """
+
+    logger = logging.getLogger('shortener.generators.pool')
+
+    def __init__(self, storage, generator, size=1000, probes=5, low_water=0.2, chunk=100):
+        super(PoolGenerator, self).__init__()
+        self.storage = storage
+        self.generator = generator
+        self.size = size
+        self.probes = probes
+        self.low_water = low_water
+        self.chunk = chunk
+        self.counters = dict(probes=0, claims=0, fallbacks=0)
+
+    def generate(self):
+        for probe in xrange(self.probes):
+            self.counters['probes'] += 1
+            claimed = []
+            def try_claim(item):
+                if item.get('state', None) != 'free':
+                    raise StorageExpectationError("The slot is not free.")
+                claimed[:] = [item['code']]
+                return {'state': 'used'}
+            try:
+                self.storage.replace(self._slot_id(random.randrange(self.size)), try_claim, field='state')
+            except (StorageItemAbsentError, StorageExpectationError), e:
+                continue
+            self.counters['claims'] += 1
+            return claimed[0]
+
+        self.counters['fallbacks'] += 1
+        return self.generator.generate()
+
+    def refill(self):
+        """
+        Fills all used or absent slots with the new ids. Returns the number of free slots
+        found before the refill. The slots claimed during the refill are refilled next time.
+
+        The slots are overwritten unconditionally: the used ones cannot be claimed anyway,
+        and if one is refilled by someone else meanwhile, only its unissued id is lost.
+        """
+        free = 0
+        for offset in xrange(0, self.size, self.chunk):
+            ids = [self._slot_id(index) for index in xrange(offset, min(offset + self.chunk, self.size))]
+            items = dict((item['id'], item) for item in self.storage.mfetch(ids))
+            stale = [id for id in ids if items.get(id, {}).get('state', None) != 'free']
+            free += len(ids) - len(stale)
+            if stale:
+                codes = self.generator.generate_many(len(stale))
+                self.storage.mstore([(id, {'code': code, 'state': 'free'}) for id, code in zip(stale, codes)])
+
+        if free < self.size * self.low_water:
+            self.logger.warning("Pool of ids is below the low-water mark: %d of %d slots are free.", free, self.size)
+        return free
+
+    def stats(self):
+        probes = self.counters['probes']
+        return dict(self.counters,
+            size = self.size,
+            estimated_fill = float(self.counters['claims']) / probes if probes else None,
+        )
+
+    def _slot_id(self, index):
+        return 'slot%d' % index
+
+
+class Lease(object):
+    """
+    Block of consecutive ids reserved in the sequence with one single update, which are
+    then handed out locally one by one, with no storage round trips at all. When the block
+    is exhausted, the next one is reserved. This removes the bottleneck of the centralized
+    generator, since the stored item is updated once per block, not once per id.
+
+    The size of the block adapts to the observed rate of requests, so that each block lasts
+    for approximately the specified period of time (but within the min/max size limits).
+
+    The lease is process-local and is never returned back: if the process dies or restarts,
+    the unused ids of the block are lost forever, so there will be gaps in the sequence.
+    Since the ids are neither sequential nor dense across few processes anyway, this is fine.
+
+    The lease must outlive the generators (which are created per request), and must be
+    used only with one and the same sequence. It is thread-safe.
+    """
+
+    def __init__(self, size=10, min_size=1, max_size=1000, period=10):
+        super(Lease, self).__init__()
+        self.size = size
+        self.min_size = min_size
+        self.max_size = max_size
+        self.period = period
+        self.lock = threading.Lock()
+        self.ids = collections.deque()
+        self.reserved_ts = None
+        self.reserved_size = 0
+
+    def take(self, sequence):
+        with self.lock:
+            if not self.ids:
+                self.ids.extend(sequence.reserve(self._adapt()))
+            return self.ids.popleft()
+
+    def _adapt(self):
+        """
+        Calculates the size of the next block based on how fast the previous one was used.
+        Never grows or shrinks more than twice at once, to smooth the spikes of requests.
+        """
+        now = time.time()
+        if self.reserved_ts is not None:
+            elapsed = max(now - self.reserved_ts, 0.001)
+            wanted = int(self.reserved_size / elapsed * self.period)
+            wanted = max(self.size // 2, min(self.size * 2, wanted))
+            self.size = max(self.min_size, min(self.max_size, wanted))
+        self.reserved_ts = now
+        self.reserved_size = self.size
+        return self.size
+
+
+class Codec(object):
+    """
+    Converts the integers to the ids and back, using the letters as the digits of a
+    positional numeral system (the first letter is zero), with the ids padded to the
+    minimal length with zeros. This is the same order as the ids were always generated
+    by the Sequence, so the stored values remain compatible: "a", "b", ..., "ba", "bb", ...
+
+    Prohibited ids are skipped with whole ranges at once: if the prohibiting pattern
+    matches within the first N characters of an id, then all ids of the same length
+    with the same N-character prefix are prohibited too, so we jump to the next prefix
+    instead of testing the ids one by one (e.g., the whole "v0/..." block is skipped
+    with one jump). This works for the patterns on prefixes and in the middle (^v\d+/, //).
+    Patterns on suffixes ($) match at the very end, so they are skipped one by one,
+    but this is fine since there are few of them in a row. Patterns with look-ahead
+    can cause some allowed ids to be skipped too, but never a prohibited one to be used.
+    """
+
+    def __init__(self, letters=None, min_length=None, max_length=None, prohibit=None):
+        super(Codec, self).__init__()
+        self.letters = letters or ALPHABET
+        self.min_length = min_length or 1
+        self.max_length = max_length
+        self.prohibit = re.compile(prohibit, re.X) if prohibit else None
+        self.base = len(self.letters)
+        self.digits = dict((letter, index) for index, letter in enumerate(self.letters))
+
+    def encode(self, number):
+        """
+        Converts non-negative integer to the id. Raises DepletedError if it is too long.
+        """
+        letters = []
+        while number > 0 or len(letters) < self.min_length:
+            number, digit = divmod(number, self.base)
+            letters.append(self.letters[digit])
+        if self.max_length is not None and len(letters) > self.max_length:
+            raise DepletedError("Codes longer than %s characters are not allowed." % self.max_length)
+        return ''.join(reversed(letters))
+
+    def decode(self, value):
+        """
+        Converts the id back to integer. Unknown characters are treated as the last letter.
+        """
+        number = 0
+        last = self.base - 1
+        for letter in value:
+            number = number * self.base + self.digits.get(letter, last)
+        return number
+
+    def skip(self, number):
+        """
+        Returns the first number starting from the specified one (inclusive),
+        which is converted to an allowed (non-prohibited) id.
+        """
+        while self.prohibit:
+            value = self.encode(number)
+            match = self.prohibit.search(value)
+            if match is None:
+                break
+            unit = self.base ** (len(value) - max(match.end(), 1))
+            number = (number // unit + 1) * unit
+        return number
+
 
 class Sequence(object):
+    """
+    Persistent sequence of ids, stored in the storage as the last generated value.
+    The value is stored as an id (not as a number) for compatibility and readability,
+    but all the calculations are made with integers (see Codec for details).
+    """
+
     def __init__(self, storage, id, min_length=None, max_length=None, letters=None, retries=3, prohibit=None):
         super(Sequence, self).__init__()
         self.storage = storage
         self.retries = retries
-        self.letters = letters or ALPHABET
         self.id = id
-        self.min_length = min_length or 1
-        self.max_length = max_length or 1024
-        self.prohibit = re.compile(prohibit, re.X) if prohibit else None
-        #!!!FIXME: this prohibition approach is not good, because you will stuch at "v0..." block,
-        #!!!FIXME: since it is VERY LARGE and you'll iterate over all of it.
-        #???TODO: possible solution is to prhibit some beginnings and endings only (v\d+/  & .html/.json)
-        #???TODO: and also some sequences in the middle (//) -- this can be controlled _inside_ the
-        #???TODO: Sequence recursion (i.e. not only on the resulting string) and be fastened easyly (probably).
-        #???TODO: SequenceRules class with check_start, check_end, check_middle methods?
+        self.codec = Codec(letters=letters, min_length=min_length, max_length=max_length or 1024, prohibit=prohibit)
 
     def generate(self):
         item = self.storage.update(self.id, lambda data: {'value': self.increment(data.get('value', None))},
@@ -93,22 +562,33 @@ class Sequence(object):
             retries = self.retries)
         return item.get('value', None)
 
+    def reserve(self, count):
+        """
+        Reserves the block of few consecutive values with one single update of the storage.
+        Returns the list of all the values reserved, in the order of generation.
+        """
+        values = []
+        def try_reserve(data):
+            del values[:] # the function can be called few times, if the update is retried.
+            number = self._next(data.get('value', None))
+            for i in xrange(count):
+                number = self.codec.skip(number)
+                values.append(self._encode(number))
+                number = number + 1
+            return {'value': values[-1]}
+        self.storage.update(self.id, try_reserve,
+            field = 'value',#!!! this should be somehow removed
+            retries = self.retries)
+        return values
+
     def increment(self, old_value):
-        result = None
-        while result is None or (self.prohibit and self.prohibit.search(result)):
-            if old_value:
-                pos = self.letters.find(old_value[-1])
-                if pos == -1:
-#                    raise SequenceLettersError("Unsupported character in the initial value of the sequence.")
-                    pos = len(self.letters) - 1
-
-                if pos < len(self.letters) - 1:
-                    result = old_value[:-1] + self.letters[pos+1]
-                else:
-                    result = self.increment(old_value[:-1] or self.letters[0]) + self.letters[0]
-                    if len(result) > self.max_length:
-                        raise DepletedError("Sequence %s is depleted." % self.id)
-            else:
-                result = self.letters[0] * self.min_length
-        return result
+        return self._encode(self.codec.skip(self._next(old_value)))
+
+    def _next(self, old_value):
+        return self.codec.decode(old_value) + 1 if old_value else 0
 
+    def _encode(self, number):
+        try:
+            return self.codec.encode(number)
+        except DepletedError, e:
+            raise DepletedError("Sequence %s is depleted." % self.id)
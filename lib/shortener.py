@@ -1,6 +1,8 @@
 # coding: utf-8
 from .daal.storages import StorageItemAbsentError, StorageExpectationError
-from .url import URL
+from .generators import DepletedError
+from .url import URL, URLRecord, normalize_url
+import hashlib
 import time
 
 
@@ -9,6 +11,12 @@ class ShortenerIdExistsError(Exception): pass
 class ShortenerBadUrlError(Exception): pass
 
 
+# Policies of re-using the existing codes for the same urls (see Shortener).
+DEDUPE_ALWAYS = 'always'    # even if a specific id is wanted, the existing one is returned.
+DEDUPE_UNWANTED = 'unwanted'# only if no specific id is wanted, i.e. the id is generated.
+DEDUPE_NEVER = 'never'      # the index is not used at all.
+
+
 class Shortener(object):
     """
     API methods to shorten long urls and to resolve short ones.
@@ -23,13 +31,23 @@ class Shortener(object):
     Note that Shortener knows nothing about multi-hosted services. This feature is implemented
     as a wrapper for storages, and is initialized when creating the shortener instance. All other
     storages and shortener just do their job within their simplified responsibilities.
+
+    Optionally, the shortener keeps an index of the urls shortened, from the hash of the
+    normalized url to its code, in a separate storage. With the index, the same url is
+    shortened only once, and all the next times the existing code is returned, with no
+    generation, no creation and no registration. The index is checked depending on the
+    dedupe policy: always, only for the generated ids (i.e., unwanted ones), or never.
     """
 
-    def __init__(self, storage, registry, generator):
+    def __init__(self, storage, registry, generator, index=None, dedupe=DEDUPE_UNWANTED):
         super(Shortener, self).__init__()
+        if dedupe not in (DEDUPE_ALWAYS, DEDUPE_UNWANTED, DEDUPE_NEVER):
+            raise ValueError("Unknown dedupe policy: %r." % dedupe)
         self.storage = storage
         self.registry = registry
         self.generator = generator
+        self.index = index
+        self.dedupe = dedupe
 
     def resolve(self, id):
         """
@@ -37,52 +55,162 @@ class Shortener(object):
         first parse it into a host & id parts, and the ask proper shortener
         instance (specific for each host) to resolve that id.
 
-        Returns an URL instance with all fields fulfilled.
+        Returns an URLRecord instance with all fields fulfilled.
         """
 
         try:
             item = self.storage.fetch(id)
             #todo later: we can add checks for moderation status here, etc.
-            return URL(**item)
+            return URLRecord(**item)
         except StorageItemAbsentError, e:
             raise ShortenerIdAbsentError("Such url does not exist.")
 
-    def shorten(self, url, id_wanted=None, retries=10, remote_addr=None, remote_port=None):
+    def resolve_many(self, ids):
         """
-        Shortens the long url and saves it with the id requested or generated.
+        Resolves few short ids at once, with one multi-id fetch from the storage.
 
-        Returns an URL instance with all fields fulfilled as if it has been resolved.
+        Returns the list of results in the order of the ids: either an URLRecord instance,
+        or an instance of ShortenerIdAbsentError if there is no such url.
         """
 
-        #??? do we care? maybe that is a view's responsibility to validate the input?
-        if '://' not in url or len(url) > 8*1024:
-            raise ShortenerBadUrlError("URL is not an URL?")
+        # The items are returned with no ids, so they are matched back by their codes.
+        items = dict((item.get('code'), item) for item in self.storage.mfetch(list(ids)))
+        results = []
+        for id in ids:
+            item = items.get(id)
+            if item is not None:
+                results.append(URLRecord(**item))
+            else:
+                results.append(ShortenerIdAbsentError("Such url does not exist."))
+        return results
 
-        # Despite that generator guaranties unique ids within that generator,
-        # there could be other urls stored already with this id. For example,
-        # if the url was stored with the manually specified id earlier; or if
-        # there was another generator algorithm before. The only way to catch
-        # these conflicts is to try to store, and see if that was successful
-        # (note that the generators should not know the purpose of the id and
-        # cannot check for uniqueness by themselves; that would not help, btw).
-        try:
-            def gen_data():
-                code = id_wanted or self.generator.generate()
+    def shorten_many(self, urls, retries=10, remote_addr=None, remote_port=None):
+        """
+        Shortens few long urls at once: the ids are generated in bulk, and the urls are
+        stored in bulk. Only the urls that collided with existing ids are retried, with
+        new ids for them. Content-addressed generators are not batched (see shorten()).
+
+        Returns the list of results in the order of the urls: either an URL instance
+        as shorten() returns it, or an instance of the error for that very url.
+        """
+
+        results = [None] * len(urls)
+        pending = []
+        for index, url in enumerate(urls):
+            if not isinstance(url, basestring) or '://' not in url or len(url) > 8*1024:
+                results[index] = ShortenerBadUrlError("URL is not an URL?")
+            elif self.generator.addressable:
+                try:
+                    results[index] = self.shorten(url, retries=retries, remote_addr=remote_addr, remote_port=remote_port)
+                except (StorageExpectationError, DepletedError), e:
+                    results[index] = e
+            else:
+                pending.append(index)
+
+        # The urls shortened already are returned as is. The duplicates within the batch
+        # are shortened only once, and get the same result as their first occurence.
+        dedupe = self._dedupes(None)
+        firsts = {}
+        if dedupe:
+            for index, existing in zip(pending, self._find_indexed([urls[index] for index in pending])):
+                results[index] = existing
+            pending = [index for index in pending if results[index] is None]
+            for index in pending:
+                firsts.setdefault(self._index_key(urls[index]), index)
+            duplicates = [index for index in pending if firsts[self._index_key(urls[index])] != index]
+            pending = [index for index in pending if firsts[self._index_key(urls[index])] == index]
+
+        def make_factory(index, code):
+            def make_url():
                 return URL(
                     code = code,
-                    url = url,
+                    url = urls[index],
                     created_ts = int(time.time()),
                     remote_addr = remote_addr,
                     remote_port = remote_port,
                 )
-            shortened_url = self.storage.create(gen_data,
-                retries=retries if not id_wanted else 1,
+            return make_url
+
+        # Each round stores all the pending urls with new ids, and leaves only the collided ones.
+        # Note that the registries are notified one by one, as they have no batch interface.
+        for attempt in xrange(retries):
+            if not pending:
+                break
+            try:
+                codes = self.generator.generate_many(len(pending))
+            except DepletedError, e:
+                for index in pending:
+                    results[index] = e
+                break
+            outcomes = self.storage.mcreate([make_factory(index, code) for index, code in zip(pending, codes)])
+            for index, outcome in zip(pending, outcomes):
+                results[index] = outcome
+                if not isinstance(outcome, StorageExpectationError):
+                    self.registry.register(outcome)
+            pending = [index for index in pending if isinstance(results[index], StorageExpectationError)]
+
+        # Remember the codes for the next shortenings of the same urls.
+        if dedupe:
+            for index in duplicates:
+                results[index] = results[firsts[self._index_key(urls[index])]]
+            self.index.mstore([(self._index_key(url), {'code': result.code})
+                               for url, result in zip(urls, results) if isinstance(result, (URL, URLRecord))])
+
+        return results
+
+    def shorten(self, url, id_wanted=None, retries=10, remote_addr=None, remote_port=None):
+        """
+        Shortens the long url and saves it with the id requested or generated.
+
+        Returns an URL instance with all fields fulfilled as if it has been resolved.
+        """
+
+        #??? do we care? maybe that is a view's responsibility to validate the input?
+        if '://' not in url or len(url) > 8*1024:
+            raise ShortenerBadUrlError("URL is not an URL?")
+
+        # If the same url has been shortened already, return it as is (it is registered already).
+        dedupe = self._dedupes(id_wanted)
+        if dedupe:
+            existing = self._find_indexed([url])[0]
+            if existing is not None:
+                return existing
+
+        def make_url(code):
+            return URL(
+                code = code,
+                url = url,
+                created_ts = int(time.time()),
+                remote_addr = remote_addr,
+                remote_port = remote_port,
             )
-        except StorageExpectationError, e:
-            if id_wanted:
-                raise ShortenerIdExistsError("This id exists already, try another one.")
-            else:
-                raise
+
+        # Content-addressed generators give the same ids for the same url, so the url
+        # can be stored already under one of them; if so, it is returned as is.
+        if not id_wanted and self.generator.addressable:
+            shortened_url, created = self._shorten_addressed(url, make_url, retries)
+            if not created:
+                return shortened_url
+        else:
+            # Despite that generator guaranties unique ids within that generator,
+            # there could be other urls stored already with this id. For example,
+            # if the url was stored with the manually specified id earlier; or if
+            # there was another generator algorithm before. The only way to catch
+            # these conflicts is to try to store, and see if that was successful
+            # (note that the generators should not know the purpose of the id and
+            # cannot check for uniqueness by themselves; that would not help, btw).
+            try:
+                def gen_data():
+                    code = id_wanted or self.generator.generate()
+                    return make_url(code)
+                shortened_url = self.storage.create(gen_data,
+                    retries=retries if not id_wanted else 1,
+                )
+            except StorageExpectationError, e:
+                if id_wanted:
+                    raise ShortenerIdExistsError("This id exists already, try another one.")
+                else:
+                    raise
 
         # Notify the registries that a new url has been born. Let them torture it a bit.
         # Registries update the "last urls" and "top domains" structures, in particular.
@@ -90,5 +218,65 @@ class Shortener(object):
         # immediately (if that was an instance of analytics) or be delayed (a notifier).
         self.registry.register(shortened_url)
 
+        # Remember the code for the next shortenings of the same url.
+        if dedupe:
+            self.index.mstore([(self._index_key(url), {'code': shortened_url.code})])
+
         # Return shortened URL to the caller.
         return shortened_url
+
+    def _shorten_addressed(self, url, make_url, retries):
+        """
+        Tries the candidate ids of the content-addressed generator one by one, until
+        either the same url is found under one of them, or the id is free to store the url.
+        Returns the url instance and the flag if it was created now (or found stored).
+
+        If the id is taken, but the item is not visible yet (e.g., it is cached as absent,
+        or read from a lagging replica), the same id is tried again, within the same retries.
+        """
+        candidates = self.generator.candidates(url)
+        code = None
+        for attempt in xrange(retries):
+            code = code or next(candidates)
+            try:
+                existing = self.storage.fetch(code)
+            except StorageItemAbsentError, e:
+                try:
+                    return self.storage.create(lambda: make_url(code)), True
+                except StorageExpectationError, e:
+                    try:
+                        existing = self.storage.fetch(code) # someone has just stored something there.
+                    except StorageItemAbsentError, e:
+                        continue
+
+            if existing.get('url') == url:
+                return URLRecord(**existing), False
+            code = None
+        raise StorageExpectationError("All %s candidate ids are taken by other urls." % retries)
+
+    def _dedupes(self, id_wanted):
+        if self.index is None or self.dedupe == DEDUPE_NEVER:
+            return False
+        return self.dedupe == DEDUPE_ALWAYS or not id_wanted
+
+    def _index_key(self, url):
+        return hashlib.sha1(normalize_url(url).encode('utf-8')).hexdigest()
+
+    def _find_indexed(self, urls):
+        """
+        Looks up the urls in the index, and resolves the codes found for them.
+        Returns the list of URL instances stored already, or Nones for unknown urls.
+        The index is a hint only: the urls resolved are compared with the urls requested
+        (e.g., in case the index is stale), and the mismatching ones are treated as unknown.
+        """
+        keys = [self._index_key(url) for url in urls]
+        codes = dict((item.get('id'), item.get('code')) for item in self.index.mfetch(list(set(keys))) if item.get('code'))
+        resolved = dict((code, result) for code, result in zip(codes.values(), self.resolve_many(codes.values())))
+        results = []
+        for url, key in zip(urls, keys):
+            existing = resolved.get(codes.get(key))
+            if isinstance(existing, URLRecord) and normalize_url(existing.url) == normalize_url(url):
+                results.append(existing)
+            else:
+                results.append(None)
+        return results
@@ -1,5 +1,33 @@
 # coding: utf-8
-from .daal.item import Item
+from .daal.item import Item, Record
+import urlparse
+
+# Ports which are implied by the schemes, and are dropped from the normalized urls.
+DEFAULT_PORTS = {'http': 80, 'https': 443, 'ftp': 21}
+
+
+def normalize_url(url):
+    """
+    Normalizes the url for comparison of the urls with each other: the scheme and
+    the host are case-insensitive, the default port can be omitted, and the empty path
+    is the same as the root path. Everything else is kept as is, since it is up to the
+    target server to decide if the paths & queries are case-sensitive, etc.
+    """
+    parts = urlparse.urlsplit(url)
+    scheme = parts.scheme.lower()
+    netloc = parts.netloc
+    userinfo, at, hostport = netloc.rpartition('@')
+    hostport = hostport.lower()
+    try:
+        port = parts.port
+    except ValueError, e:
+        port = None # not a number (e.g., "host:abc"); such netloc is kept as is, it is not ours to validate.
+    if port is not None and DEFAULT_PORTS.get(scheme) == port:
+        hostport = hostport.rsplit(':', 1)[0]
+    netloc = userinfo + at + hostport
+    path = parts.path or '/'
+    return urlparse.urlunsplit((scheme, netloc, path, parts.query, parts.fragment))
+
 
 class URL(Item):
     """
@@ -31,3 +59,32 @@ class URL(Item):
     @property
     def shortcut(self):
         return 'http://%s/%s' % (self.host, self.code)
+
+
+class URLRecord(Record):
+    """
+    Compact read-only-mostly version of URL (see Record), with the same fields and behavior.
+    It is used for the urls which are only resolved and shown, never stored or queued.
+    """
+
+    __slots__ = ('id', 'host', 'code', 'url', 'created_ts', 'remote_addr', 'remote_port')
+    fields = __slots__
+
+    def __init__(self, id=None, host=None, code=None, url=None, created_ts=None, remote_addr=None, remote_port=None, **kwargs):
+        self.id = id or code #NB: can be altered by storage wrappers
+        self.host = host
+        self.code = code
+        self.url = url
+        self.created_ts = float(created_ts) if created_ts is not None else created_ts
+        self.remote_addr = remote_addr
+        self.remote_port = remote_port
+
+    def __str__(self):
+        return self.shortcut
+
+    def __unicode__(self):
+        return self.shortcut
+
+    @property
+    def shortcut(self):
+        return 'http://%s/%s' % (self.host, self.code)
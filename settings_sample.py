@@ -4,6 +4,9 @@ import os.path
 DEBUG = not __file__.startswith('/var/www/')
 TEMPLATE_DEBUG = DEBUG
 
+# The addresses allowed to see the service endpoints (e.g., stats.json) when not in DEBUG mode.
+INTERNAL_IPS = ('127.0.0.1',)
+
 ADMINS = (
     ('Sergey Vasilyev', 'nolar@nolar.info'),
 )
@@ -153,3 +156,81 @@ MYSQL_HOSTNAME = ''
 MYSQL_USERNAME = ''
 MYSQL_PASSWORD = ''
 MYSQL_DATABASE = ''
+
+# For v1/setup.py: the reads go to the replicas of MYSQL_HOSTNAME (hostnames, or dicts of the options which
+# differ), and the writes to it. Each of MYSQL_SHARDS can have its own list of 'replicas' in its options.
+# The reads of the items written within read_your_writes seconds go to the primary; the replicas lagging
+# behind for more than max_lag seconds (None means any lag) are skipped. Balancing is round-robin or latency.
+MYSQL_REPLICAS = [
+#    'db-replica1',
+]
+MYSQL_REPLICATION = {'balancing': 'round-robin', 'max_lag': 30, 'read_your_writes': 5}
+
+# For v1/setup.py & shortener_shards_rebalancer.py: spread the MySQL tables over few servers (shards), by
+# consistent hashing of the ids; then MYSQL_HOSTNAME & co above are not used. The names of the shards define
+# the layout, so they must be kept when the servers are changed. When the shards are added, list the names
+# of the previous layout, run the rebalancer, and then remove them (None means there is no previous layout).
+MYSQL_SHARDS = {
+#    'db1': {'hostname': '', 'username': '', 'password': '', 'database': '', 'replicas': []},
+#    'db2': {'hostname': '', 'username': '', 'password': '', 'database': ''},
+}
+MYSQL_SHARDS_PREVIOUS = None
+
+# For v1/setup.py: single-node deployments keep everything in a local SQLite file instead of MySQL.
+# The file is shared by all the processes of the node; None means MySQL is used.
+SQLITE_PATH = None
+
+# For v1/setup.py LocalGenerator (coordination-free ids); node must be unique per process.
+# Fewer bits and coarser resolution (in seconds) give shorter ids, but less ids per tick.
+TIME_GENERATOR = {'node': None, 'node_bits': 10, 'counter_bits': 12, 'resolution': 1.0}
+TIME_GENERATOR_HOSTS = {
+#    'yaws.ws': {'node_bits': 6, 'counter_bits': 6, 'resolution': 60.0},
+}
+
+# For v1/setup.py AddressedGenerator (ids from the urls' hashes; same url gets same id).
+# The ids start with min_length letters, and are longer only for the colliding urls.
+HASH_GENERATOR = {'min_length': 4}
+
+# For v1/setup.py shorteners: re-use the existing codes for the same urls (see lib/shortener.py).
+# One of: 'always', 'unwanted' (only when no specific id is requested), or 'never'.
+URL_DEDUPE = 'never'
+
+# For v1/setup.py shorteners & shortener_filters_builder.py: directory for the bloom filters of the existing
+# codes, one file per host. The lookups of the codes which definitely do not exist are then rejected with no
+# storage trip. Must be local to all the processes creating the urls (i.e., one machine); None disables them.
+# The filters are built by the builder for the hosts listed (checked every CODE_FILTER_INTERVAL seconds);
+# until the filter of the host is built, its lookups are passed through to the storage.
+CODE_FILTERS_DIR = None
+CODE_FILTER_HOSTS = []
+CODE_FILTER_INTERVAL = 60
+
+# For v1/setup.py shorteners: shared cache of the resolved urls for all the processes on all the nodes,
+# as the list of memcached servers ('hostname:port'); the keys are spread by consistent hashing.
+# The urls are write-once, so they can be cached for long (in seconds). Empty list disables the tier.
+MEMCACHED_SERVERS = []
+MEMCACHED_TTL = 86400
+
+# For v1/setup.py shorteners & shortener_snapshot_exporter.py: directory for the read-only snapshots
+# of the codes, one file per host. The codes in the snapshot are resolved with no storage trip (and
+# even when the storage is down); newer codes are fetched from the storage. None disables snapshots.
+# The exporter re-exports the hosts listed every SNAPSHOT_INTERVAL seconds.
+SNAPSHOTS_DIR = None
+SNAPSHOT_HOSTS = []
+SNAPSHOT_INTERVAL = 600
+
+# For v1/setup.py analytics: accumulate the increments of the popular domains' counters in memory,
+# and write them as aggregated deltas when there are max_pending counters changed, or every max_delay
+# seconds (so this is how many seconds of the counts are lost if the process is killed). None disables it.
+ANALYTICS_WRITE_BEHIND = {'max_pending': 1000, 'max_delay': 1.0}
+
+# For v1/setup.py: record the metrics of all the storage operations, per table (calls, latency histograms,
+# retries, payload sizes), reported in stats.json, in the profiles of the requests, and by the daemon.
+# The operations slower than the threshold (in seconds; None disables this) are logged with their ids.
+STORAGE_INSTRUMENTATION = False
+STORAGE_SLOW_THRESHOLD = 0.5
+
+# For shortener_analytics_updater.py: report the storage metrics every that many seconds (None disables this).
+METRICS_REPORT_INTERVAL = 300
+
+# For shortener_analytics_updater.py: refill the pools of ids of v1/setup.py PoolGenerators when idle.
+REFILL_CODE_POOLS = False
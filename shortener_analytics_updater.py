@@ -4,27 +4,62 @@ import time
 import settings
 from lib.daal.queues import SQSQueue
 from lib.url import URL
-from v1.setup import AWSAnalytics, AWSShortener
+from v1.setup import AWSAnalytics, AWSShortener, AWSPoolGenerator, get_component, STORAGE_METRICS
 import traceback
 
 
+POOL_REFILL_INTERVAL = 60 # seconds between the refills of the same host's pool.
+
+
+def refill_pools(hosts):
+    # refill the pools of pre-generated ids for the hosts seen recently, if it is time to.
+    for host, refilled_ts in hosts.items():
+        if time.time() - refilled_ts >= POOL_REFILL_INTERVAL:
+            pool = get_component(AWSPoolGenerator, host,
+                                    access_key = settings.AWS_ACCESS_KEY,
+                                    secret_key = settings.AWS_SECRET_KEY,
+                                    )
+            free = pool.refill()
+            print(host, 'pool refilled', free, 'of', pool.size, 'slots were free')
+            hosts[host] = time.time()
+
+
+def report_metrics():
+    # print the metrics of the storage operations made by this daemon, one line per table & operation.
+    for table, operations in sorted(STORAGE_METRICS.tables().items()):
+        for operation, metrics in sorted(operations.items()):
+            print(table, operation, metrics['calls'], 'calls', metrics['errors'], 'errors', metrics['repeats'], 'repeats',
+                  'avg=%.4fs p50=%.4fs p99=%.4fs max=%.4fs' % (metrics['avg'], metrics['p50'], metrics['p99'], metrics['max']))
+
+
 def main():
     # attach to the queue, handle each message in cycle:
     queue = SQSQueue(settings.AWS_ACCESS_KEY, settings.AWS_SECRET_KEY, name='urls')
+    hosts = {}
+    reported_ts = time.time()
     while True:
         try:
+            interval = getattr(settings, 'METRICS_REPORT_INTERVAL', None)
+            if interval and time.time() - reported_ts >= interval:
+                report_metrics()
+                reported_ts = time.time()
+
             # extract host & id from the message, restore the instance
             item = queue.pull(factory=lambda data: URL(**data))
             if item is None:
+                # use the idle time to refill the pools of ids, if they are used.
+                if getattr(settings, 'REFILL_CODE_POOLS', False):
+                    refill_pools(hosts)
                 time.sleep(1)
                 continue
+            hosts.setdefault(item.host, 0)
 
             print(item.host, item.id)
-            analytics = AWSAnalytics(host = item.host,
+            analytics = get_component(AWSAnalytics, item.host,
                                     access_key = settings.AWS_ACCESS_KEY,
                                     secret_key = settings.AWS_SECRET_KEY,
                                     )
-            analytics.update(item)
+            analytics.register(item)
 
             # delete the message from the queue
             queue.delete(item)
@@ -0,0 +1,49 @@
+#!/usr/bin/python
+import os
+import sys
+import time
+import settings
+from lib.daal.storages import GuardedStorage
+from v1.setup import get_shortener
+import traceback
+
+
+def find_guard(storage):
+    # the guard is somewhere in the chain of the shortener's storages (see v1/setup.py), if enabled.
+    while storage is not None and not isinstance(storage, GuardedStorage):
+        storage = getattr(storage, 'storage', None)
+    return storage
+
+
+def build(host, force=False):
+    # the filters are built only if they are missing or overfilled; the processes pass the lookups through till then.
+    guard = find_guard(get_shortener(host).storage)
+    if guard is None:
+        print(host, 'is not guarded (see CODE_FILTERS_DIR)')
+        return
+    if not force and os.path.exists(guard.path) and not guard.overfilled():
+        return
+    ts = time.time()
+    guard.rebuild()
+    print(host, 'built the filter of', guard.stats()['keys'], 'codes in', '%.1fs' % (time.time() - ts))
+
+
+def main():
+    # check all the hosts once (with --once), or periodically; --rebuild rebuilds all of them anyway.
+    once = '--once' in sys.argv[1:]
+    force = '--rebuild' in sys.argv[1:]
+    while True:
+        for host in settings.CODE_FILTER_HOSTS:
+            try:
+                build(host, force=force)
+            except Exception, e:
+                print('=' * 80)
+                traceback.print_exc()
+        if once:
+            break
+        force = False
+        time.sleep(getattr(settings, 'CODE_FILTER_INTERVAL', 60))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,34 @@
+#!/usr/bin/python
+import sys
+import time
+import settings
+from lib.daal.storages import ShardedStorage, rebalance
+from v1.setup import mysql_storage
+import traceback
+
+
+# All the MySQL tables of v1/setup.py; the analytics ones must not be written while being rebalanced.
+TABLES = ['urls', 'url_index', 'sequences', 'counters', 'code_pool', 'last_urls',
+          'popular_domain_counters', 'popular_grid_level_counters', 'popular_grid_level_domains']
+
+
+def main():
+    # copy the items which have moved to the new shards, for the tables specified or for all of them.
+    tables = sys.argv[1:] or TABLES
+    for table in tables:
+        try:
+            storage = mysql_storage(settings.MYSQL_HOSTNAME, settings.MYSQL_USERNAME, settings.MYSQL_PASSWORD, settings.MYSQL_DATABASE, table)
+            if not isinstance(storage, ShardedStorage):
+                print(table, 'is not sharded (see MYSQL_SHARDS)')
+                continue
+            ts = time.time()
+            counters = rebalance(storage)
+            print(table, 'scanned', counters['scanned'], 'moved', counters['moved'], 'conflicts', counters['conflicts'],
+                  'unknown', counters['unknown'], 'in', '%.1fs' % (time.time() - ts))
+        except Exception, e:
+            print('=' * 80)
+            traceback.print_exc()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,37 @@
+#!/usr/bin/python
+import sys
+import time
+import settings
+from lib.daal.storages import export_snapshot
+from lib.url import URLRecord
+from v1.setup import get_shortener, snapshot_path
+import traceback
+
+
+def export(host):
+    # the snapshot is exported from the same storage the shortener uses (select goes to the live one).
+    # url goes first, since it is what the redirects need; others are for the resolve api.
+    shortener = get_shortener(host)
+    fields = ['url'] + [field for field in URLRecord.fields if field != 'url']
+    ts = time.time()
+    count = export_snapshot(shortener.storage, snapshot_path(host), field='code', fields=fields)
+    print(host, 'exported', count, 'codes in', '%.1fs' % (time.time() - ts))
+
+
+def main():
+    # export all the hosts once (with --once), or periodically.
+    once = '--once' in sys.argv[1:]
+    while True:
+        for host in settings.SNAPSHOT_HOSTS:
+            try:
+                export(host)
+            except Exception, e:
+                print('=' * 80)
+                traceback.print_exc()
+        if once:
+            break
+        time.sleep(getattr(settings, 'SNAPSHOT_INTERVAL', 600))
+
+
+if __name__ == '__main__':
+    main()
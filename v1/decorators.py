@@ -1,21 +1,38 @@
 import functools
 import json
 import time
-from django.http import HttpResponse, HttpResponseRedirect
+from django.http import HttpResponse, HttpResponseRedirect, HttpResponseForbidden
 from django.shortcuts import render_to_response
 from django.conf import settings
+from lib.daal.storages import traced
+
+def to_json(obj):
+    # Hint for JSON encoder on the non-dict items (e.g., records): they are dumped as dicts.
+    return dict(obj.items()) if hasattr(obj, 'items') else dict(obj)
 
 def with_profile(fn):
         @functools.wraps(fn)
         def decorated(request, *args, **kwargs):
             ts_start = time.time()
-            result = fn(request, *args, **kwargs)
+            with traced() as trace:
+                result = fn(request, *args, **kwargs)
             ts_end = time.time()
             duration = ts_end - ts_start
             result['profile'] = {'duration': duration}
+            if trace:
+                result['profile']['storage'] = trace # only if the storages are instrumented.
             return result
         return decorated
 
+def internal_only(fn):
+        # The service endpoints expose the internals (ids, hostnames), so only INTERNAL_IPS can see them.
+        @functools.wraps(fn)
+        def decorated(request, *args, **kwargs):
+            if not settings.DEBUG and request.META.get('REMOTE_ADDR') not in getattr(settings, 'INTERNAL_IPS', ()):
+                return HttpResponseForbidden()
+            return fn(request, *args, **kwargs)
+        return decorated
+
 def as_json(fn, catch=[Exception]):
         @functools.wraps(fn)
         def decorated(request, *args, **kwargs):
@@ -24,7 +41,7 @@ def as_json(fn, catch=[Exception]):
                 if isinstance(result, HttpResponse):
                     return result
                 elif request.path.endswith('.json'):
-                    content = json.dumps(result, indent=4)
+                    content = json.dumps(result, indent=4, default=to_json)
                     return HttpResponse(content, mimetype='text/plain')#!!! mimetype is for manual debugging
                 else:
                     return result
@@ -33,7 +50,7 @@ def as_json(fn, catch=[Exception]):
                     result = {
                         'exception': unicode(e),
                     }
-                    content = json.dumps(result, indent=4)
+                    content = json.dumps(result, indent=4, default=to_json)
                     return HttpResponse(content, mimetype='text/plain')#!!! mimetype is for manual debugging
                 else:
                     raise
@@ -6,38 +6,201 @@ All views and daemons should use only these pre-configured classes/factories.
 No other classes/factories except these ones - to keep the system consistent!
 """
 from lib.shortener import Shortener
-from lib.generators import CentralizedGenerator
+from lib.generators import CentralizedGenerator, CounterGenerator, HashGenerator, PoolGenerator, TimeGenerator, Lease
 from lib.registries import Analytics, Blackhole, Notifier
 from lib.dimensions import RecentTargetsDimension, PopularDomainsDimension
-from lib.daal.storages import SDBStorage, MysqlStorage, WrappedStorage
+from lib.dimensions.popular_domains import DomainCounterID, GridLevelID
+from lib.daal.storages import SDBStorage, MysqlStorage, SQLiteStorage, WrappedStorage, CachedStorage, GuardedStorage, SnapshotStorage, WriteBehindStorage, InstrumentedStorage, StorageMetrics, ShardedStorage, LRUCache, MemcachedCache
+from lib.daal.storages.wrapped import WrappedID
 from lib.daal.queues import SQSQueue
 from django.conf import settings
+import os
+import re
+import threading
+
+
+# Process-wide cache of resolved urls, shared by all the shorteners of all the hosts.
+# Storages are created per request, so the cache must outlive them to be of any use.
+# Keys are host-wrapped ids, since the cache is placed under the WrappedStorage.
+URLS_CACHE = LRUCache(size=100000)
+
+# Process-wide leases of the generators' sequences, one per host (see Lease for details).
+# They are kept in LRU cache to avoid memory leaks with the long tail of rarely used hosts.
+# If the lease is evicted, its unused ids are lost, and this is fine (gaps are accepted).
+GENERATOR_LEASES = LRUCache(size=10000)
+
+def get_lease(host):
+    lease = GENERATOR_LEASES.get(host)
+    if lease is None:
+        lease = Lease(size=10, max_size=1000, period=10)
+        GENERATOR_LEASES.put(host, lease)
+    return lease
+
+# Process-wide registry of the components (shorteners, analytics, etc) built for the hosts.
+# The components are stateless except for their storages, and the storages are thread-safe
+# (MySQL & SQLite ones borrow the connections per operation, SDB ones keep them per thread),
+# so one component serves all requests of a host. Note that SQS queues are not thread-safe,
+# so the components with the notifiers (see AWSNotifier) must not be shared this way.
+# The long tail of rarely used hosts is evicted; the components are just rebuilt for them.
+COMPONENTS = LRUCache(size=1000)
+COMPONENTS_LOCK = threading.Lock()
+
+def get_component(factory, host, **kwargs):
+    """
+    Returns the component built by the factory for the host, building it if necessary.
+    The kwargs are not a part of the key: they are expected to be the same for all calls
+    with the same factory (i.e., the credentials & hostnames from the settings).
+    """
+    key = (factory, host)
+    component = COMPONENTS.get(key)
+    if component is None:
+        with COMPONENTS_LOCK:
+            # Double-check: other thread could build it while we were waiting for the lock.
+            component = COMPONENTS.get(key)
+            if component is None:
+                component = factory(host=host, **kwargs)
+                COMPONENTS.put(key, component)
+    return component
+
+# Process-wide client of the shared cache servers, if they are configured (see shared()).
+# It keeps the connections per thread, so it must outlive the storages, as the caches do.
+SHARED_CACHE = None
+SHARED_CACHE_LOCK = threading.Lock()
+
+def shared(storage):
+    """
+    Puts the shared cache tier (the memcached servers) over the urls storage, if it is enabled
+    in the settings. It is placed under the process-local cache, and is keyed the same way.
+    """
+    global SHARED_CACHE
+    servers = getattr(settings, 'MEMCACHED_SERVERS', None)
+    if not servers:
+        return storage
+    with SHARED_CACHE_LOCK:
+        if SHARED_CACHE is None:
+            SHARED_CACHE = MemcachedCache(servers, prefix='urls:')
+    return CachedStorage(storage, cache=SHARED_CACHE, ttl=getattr(settings, 'MEMCACHED_TTL', 86400))
+
+def write_behind(storage):
+    """
+    Puts the write-behind layer over the analytics counters, if it is enabled in the settings,
+    so the increments of the hot counters are written as aggregated deltas (see WriteBehindStorage).
+    """
+    options = getattr(settings, 'ANALYTICS_WRITE_BEHIND', None)
+    if not options:
+        return storage
+    return WriteBehindStorage(storage, **options)
+
+
+# Process-wide metrics of the storage operations, per table (see instrumented()).
+# They are aggregated over all the hosts, since the tables are shared by all the hosts.
+STORAGE_METRICS = StorageMetrics()
+
+def instrumented(storage, table=None):
+    """
+    Puts the instrumentation over the backend storage, if it is enabled in the settings, so that
+    the metrics of its operations are recorded to STORAGE_METRICS (see InstrumentedStorage).
+    """
+    if not getattr(settings, 'STORAGE_INSTRUMENTATION', False):
+        return storage
+    return InstrumentedStorage(storage, metrics=STORAGE_METRICS, table=table, slow_threshold=getattr(settings, 'STORAGE_SLOW_THRESHOLD', None))
+
+def mysql_storage(hostname, username, password, database, name):
+    """
+    Builds the MySQL table's storage: either on the server specified, or sharded over the servers
+    of MYSQL_SHARDS, if they are set in the settings (then the server specified is not used).
+    The reads go to the replicas of the server (MYSQL_REPLICAS) or of each shard, if any.
+    """
+    replication = getattr(settings, 'MYSQL_REPLICATION', {})
+    shards = getattr(settings, 'MYSQL_SHARDS', None)
+    if not shards:
+        replicas = getattr(settings, 'MYSQL_REPLICAS', None)
+        return instrumented(MysqlStorage(hostname, username, password, database, name, replicas=replicas, **replication))
+    return ShardedStorage(
+        shards = dict([(shard, instrumented(MysqlStorage(name=name, **dict(replication, **options)), table='%s@%s' % (name, shard))) for shard, options in shards.items()]),
+        previous = getattr(settings, 'MYSQL_SHARDS_PREVIOUS', None),
+        key = stored_id,
+    )
+
+def stored_id(item):
+    """
+    Rebuilds the id the item is stored with, for the sharded storages (see ShardedStorage):
+    all the tables are wrapped per host, and the popular domains dimension has compound ids.
+    """
+    if 'id' in item:
+        id = item['id']
+    elif 'domain' in item:
+        id = DomainCounterID(time_shard=item['time_shard'], domain=item['domain'])
+    elif 'grid_level' in item:
+        id = GridLevelID(time_shard=item['time_shard'], grid_level=item['grid_level'])
+    else:
+        raise KeyError('id')
+    return WrappedID(id, host=item['host'])
+
+
+def host_filename(host, extension):
+    return re.sub(r'[^a-z0-9.-]', '_', host) + extension
+
+def guarded(storage, host):
+    """
+    Puts the existence guard (bloom filter of the codes) over the host's urls storage,
+    if it is enabled in the settings. The filters are kept in files, one per host.
+    """
+    directory = getattr(settings, 'CODE_FILTERS_DIR', None)
+    if not directory:
+        return storage
+    return GuardedStorage(storage, path=os.path.join(directory, host_filename(host, '.bloom')), field='code')
+
+def snapshotted(storage, host):
+    """
+    Puts the read-only snapshot of the codes over the host's urls storage, if it is enabled
+    in the settings. The snapshots are exported by shortener_snapshot_exporter.py, one per host.
+    """
+    directory = getattr(settings, 'SNAPSHOTS_DIR', None)
+    if not directory:
+        return storage
+    return SnapshotStorage(storage, path=snapshot_path(host))
+
+def snapshot_path(host):
+    return os.path.join(settings.SNAPSHOTS_DIR, host_filename(host, '.cdb'))
 
 
 class AWSShortener(Shortener):
     def __init__(self, access_key, secret_key, host):
         super(AWSShortener, self).__init__(
-            storage   = WrappedStorage(SDBStorage(access_key, secret_key, 'urls'), host=host),
+            storage   = snapshotted(guarded(WrappedStorage(CachedStorage(shared(instrumented(SDBStorage(access_key, secret_key, 'urls'))), cache=URLS_CACHE), host=host), host), host),
             registry  = AWSAnalytics(access_key, secret_key, host),
 #            registry  = Blackhole(),
             generator = AWSGenerator(access_key, secret_key, host),
+#            generator = AWSPoolGenerator(access_key, secret_key, host),
+            index     = WrappedStorage(instrumented(SDBStorage(access_key, secret_key, 'url_index')), host=host),
+            dedupe    = getattr(settings, 'URL_DEDUPE', 'never'),
             )
 
 class AWSGenerator(CentralizedGenerator):
     def __init__(self, access_key, secret_key, host):
         super(AWSGenerator, self).__init__(
-            storage = WrappedStorage(SDBStorage(access_key, secret_key, 'sequences'), host=host),
+            storage = WrappedStorage(instrumented(SDBStorage(access_key, secret_key, 'sequences')), host=host),
             prohibit=r'(^v\d+/) | (^/) | (//)',
+            lease=get_lease(host),
+        )
+
+class AWSPoolGenerator(PoolGenerator):
+    def __init__(self, access_key, secret_key, host):
+        super(AWSPoolGenerator, self).__init__(
+            storage = WrappedStorage(instrumented(SDBStorage(access_key, secret_key, 'code_pool')), host=host),
+            generator = AWSGenerator(access_key, secret_key, host),
+            size = 1000,
         )
 
 class AWSAnalytics(Analytics):
     def __init__(self, access_key, secret_key, host):
         super(AWSAnalytics, self).__init__(
-            recent_targets  =  RecentTargetsDimension(WrappedStorage(SDBStorage(access_key, secret_key, 'last_urls'  ), host=host)),
+            recent_targets  =  RecentTargetsDimension(WrappedStorage(instrumented(SDBStorage(access_key, secret_key, 'last_urls'  )), host=host)),
             popular_domains = PopularDomainsDimension(
-                url_domain_counter_storage = WrappedStorage(SDBStorage(access_key, secret_key, 'popular2counter6'), host=host),
-                grid_level_counter_storage = WrappedStorage(SDBStorage(access_key, secret_key, 'popular2gridcnt6'), host=host),
-                grid_level_domains_storage = WrappedStorage(SDBStorage(access_key, secret_key, 'popular2griddom6'), host=host),
+                url_domain_counter_storage = write_behind(WrappedStorage(instrumented(SDBStorage(access_key, secret_key, 'popular2counter6')), host=host)),
+                grid_level_counter_storage = WrappedStorage(instrumented(SDBStorage(access_key, secret_key, 'popular2gridcnt6')), host=host),
+                grid_level_domains_storage = WrappedStorage(instrumented(SDBStorage(access_key, secret_key, 'popular2griddom6')), host=host),
             ),
         )
 
@@ -52,33 +215,116 @@ class AWSNotifier(Notifier):
 class MysqlShortener(Shortener):
     def __init__(self, hostname, username, password, database, host):
         super(MysqlShortener, self).__init__(
-            storage   = WrappedStorage(MysqlStorage(hostname, username, password, database, 'urls'), host=host),
+            storage   = snapshotted(guarded(WrappedStorage(CachedStorage(shared(mysql_storage(hostname, username, password, database, 'urls')), cache=URLS_CACHE), host=host), host), host),
             registry  = MysqlAnalytics(hostname, username, password, database, host),
 #            registry  = Blackhole(),
             generator = MysqlGenerator(hostname, username, password, database, host),
+#            generator = MysqlCounterGenerator(hostname, username, password, database, host),
+#            generator = MysqlPoolGenerator(hostname, username, password, database, host),
+#            generator = LocalGenerator(host),
+#            generator = AddressedGenerator(host),
+            index     = WrappedStorage(mysql_storage(hostname, username, password, database, 'url_index'), host=host),
+            dedupe    = getattr(settings, 'URL_DEDUPE', 'never'),
             )
 
 class MysqlGenerator(CentralizedGenerator):
     def __init__(self, hostname, username, password, database, host):
         super(MysqlGenerator, self).__init__(
-            storage = WrappedStorage(MysqlStorage(hostname, username, password, database, 'sequences'), host=host),
+            storage = WrappedStorage(mysql_storage(hostname, username, password, database, 'sequences'), host=host),
+            prohibit=r'(^v\d+/) | (^/) | (//)',
+            lease=get_lease(host),
+        )
+
+class MysqlCounterGenerator(CounterGenerator):
+    def __init__(self, hostname, username, password, database, host):
+        super(MysqlCounterGenerator, self).__init__(
+            storage = WrappedStorage(mysql_storage(hostname, username, password, database, 'counters'), host=host),
             prohibit=r'(^v\d+/) | (^/) | (//)',
         )
 
+class MysqlPoolGenerator(PoolGenerator):
+    def __init__(self, hostname, username, password, database, host):
+        super(MysqlPoolGenerator, self).__init__(
+            storage = WrappedStorage(mysql_storage(hostname, username, password, database, 'code_pool'), host=host),
+            generator = MysqlGenerator(hostname, username, password, database, host),
+            size = 1000,
+        )
+
 class MysqlAnalytics(Analytics):
     def __init__(self, hostname, username, password, database, host):
         super(MysqlAnalytics, self).__init__(
             recent_targets = RecentTargetsDimension(
-                storage = WrappedStorage(MysqlStorage(hostname, username, password, database, 'last_urls'), host=host),
+                storage = WrappedStorage(mysql_storage(hostname, username, password, database, 'last_urls'), host=host),
             ),
             popular_domains = PopularDomainsDimension(
-                url_domain_counter_storage = WrappedStorage(MysqlStorage(hostname, username, password, database, 'popular_domain_counters'    ), host=host),
-                grid_level_counter_storage = WrappedStorage(MysqlStorage(hostname, username, password, database, 'popular_grid_level_counters'), host=host),
-                grid_level_domains_storage = WrappedStorage(MysqlStorage(hostname, username, password, database, 'popular_grid_level_domains' ), host=host),
+                url_domain_counter_storage = write_behind(WrappedStorage(mysql_storage(hostname, username, password, database, 'popular_domain_counters'    ), host=host)),
+                grid_level_counter_storage = WrappedStorage(mysql_storage(hostname, username, password, database, 'popular_grid_level_counters'), host=host),
+                grid_level_domains_storage = WrappedStorage(mysql_storage(hostname, username, password, database, 'popular_grid_level_domains' ), host=host),
             ),
         )
 
 
+
+class SQLiteShortener(Shortener):
+    def __init__(self, path, host):
+        super(SQLiteShortener, self).__init__(
+            storage   = snapshotted(guarded(WrappedStorage(CachedStorage(shared(instrumented(SQLiteStorage(path, 'urls'))), cache=URLS_CACHE), host=host), host), host),
+            registry  = SQLiteAnalytics(path, host),
+#            registry  = Blackhole(),
+            generator = SQLiteGenerator(path, host),
+            index     = WrappedStorage(instrumented(SQLiteStorage(path, 'url_index')), host=host),
+            dedupe    = getattr(settings, 'URL_DEDUPE', 'never'),
+            )
+
+class SQLiteGenerator(CentralizedGenerator):
+    def __init__(self, path, host):
+        super(SQLiteGenerator, self).__init__(
+            storage = WrappedStorage(instrumented(SQLiteStorage(path, 'sequences')), host=host),
+            prohibit=r'(^v\d+/) | (^/) | (//)',
+            lease=get_lease(host),
+        )
+
+class SQLiteAnalytics(Analytics):
+    def __init__(self, path, host):
+        super(SQLiteAnalytics, self).__init__(
+            recent_targets = RecentTargetsDimension(
+                storage = WrappedStorage(instrumented(SQLiteStorage(path, 'last_urls')), host=host),
+            ),
+            popular_domains = PopularDomainsDimension(
+                url_domain_counter_storage = write_behind(WrappedStorage(instrumented(SQLiteStorage(path, 'popular_domain_counters'    )), host=host)),
+                grid_level_counter_storage = WrappedStorage(instrumented(SQLiteStorage(path, 'popular_grid_level_counters')), host=host),
+                grid_level_domains_storage = WrappedStorage(instrumented(SQLiteStorage(path, 'popular_grid_level_domains' )), host=host),
+            ),
+        )
+
+
+class LocalGenerator(TimeGenerator):
+    """
+    Storage-less generator for any backend. The node id must be unique per process,
+    and the code length vs. capacity trade-off can be configured per host in settings.
+    """
+    def __init__(self, host):
+        options = dict(getattr(settings, 'TIME_GENERATOR', {}))
+        options.update(getattr(settings, 'TIME_GENERATOR_HOSTS', {}).get(host, {}))
+        super(LocalGenerator, self).__init__(
+            prohibit=r'(^v\d+/) | (^/) | (//)',
+            **options
+        )
+
+
+class AddressedGenerator(HashGenerator):
+    """
+    Storage-less generator for any backend, which gives the same ids for the same urls.
+    The hashes are salted with the host, so the hosts get different ids for the same url.
+    """
+    def __init__(self, host):
+        super(AddressedGenerator, self).__init__(
+            salt=host,
+            prohibit=r'(^v\d+/) | (^/) | (//)',
+            **getattr(settings, 'HASH_GENERATOR', {})
+        )
+
+
 def get_host(request):
     host = request.META.get('HTTP_HOST') #!!! or DEFAULT_HOST?
     host = host.lower()
@@ -87,19 +333,24 @@ def get_host(request):
     return host
 
 #def make_shortener(request):
-#    return AWSShortener(host=get_host(request),
+#    return get_component(AWSShortener, get_host(request),
 #                        access_key = settings.AWS_ACCESS_KEY,
 #                        secret_key = settings.AWS_SECRET_KEY,
 #                        )
 #
 #def make_analytics(request):
-#    return AWSAnalytics(host=get_host(request),
+#    return get_component(AWSAnalytics, get_host(request),
 #                        access_key = settings.AWS_ACCESS_KEY,
 #                        secret_key = settings.AWS_SECRET_KEY,
 #                        )
 
 def make_shortener(request):
-    return MysqlShortener(host=get_host(request),
+    return get_shortener(get_host(request))
+
+def get_shortener(host):
+    if getattr(settings, 'SQLITE_PATH', None):
+        return get_component(SQLiteShortener, host, path=settings.SQLITE_PATH)
+    return get_component(MysqlShortener, host,
                           hostname=settings.MYSQL_HOSTNAME,
                           username=settings.MYSQL_USERNAME,
                           password=settings.MYSQL_PASSWORD,
@@ -107,7 +358,9 @@ def make_shortener(request):
     )
 
 def make_analytics(request):
-    return MysqlAnalytics(host=get_host(request),
+    if getattr(settings, 'SQLITE_PATH', None):
+        return get_component(SQLiteAnalytics, get_host(request), path=settings.SQLITE_PATH)
+    return get_component(MysqlAnalytics, get_host(request),
                           hostname=settings.MYSQL_HOSTNAME,
                           username=settings.MYSQL_USERNAME,
                           password=settings.MYSQL_PASSWORD,
@@ -1,11 +1,40 @@
 """
-This file demonstrates writing tests using the unittest module. These will pass
-when you run "manage.py test".
+Tests for the shortener. These will pass when you run "manage.py test".
 
-Replace this with more appropriate tests for your application.
+The storage conformance suite checks that every storage backend obeys the storage protocol
+(see lib/daal/storages/_base.py), so the components can be moved from one backend to another.
+SQLite storages are always tested; MySQL is tested only when TEST_MYSQL_DATABASE is set in the
+settings (the tables are re-created there), and SimpleDB only when TEST_SDB_PREFIX is set
+(the domains are created with that prefix, and are not deleted, since it takes time).
 """
 
 from django.test import TestCase
+from django.conf import settings
+from lib.daal.storages import SQLiteStorage, MysqlStorage, SDBStorage, WrappedStorage, CachedStorage, MemcachedCache, LRUCache
+from lib.daal.storages import SnapshotStorage, WriteBehindStorage, InstrumentedStorage, StorageMetrics, export_snapshot, traced
+from lib.daal.storages import ShardedStorage, GuardedStorage, rebalance
+from lib.daal.bloom import BloomFilter
+from lib.daal.storages import MysqlPool, MysqlReplica
+from lib.daal.storages.wrapped import WrappedID
+from lib.daal.hashring import HashRing
+from lib.daal.cdb import CDB, CDBWriter
+from lib.daal.storages import StorageExpectationError, StorageItemAbsentError
+from lib.daal.memcached import MemcachedServer
+from lib.dimensions.popular_domains import DomainCounterID, PopularDomainsDimension
+from lib.generators import CentralizedGenerator, DistributedGenerator, TimeGenerator, HashGenerator, CounterGenerator, PoolGenerator, Lease, Codec, Sequence, DepletedError
+from lib.registries import Registry
+from lib.shortener import Shortener, ShortenerBadUrlError, ShortenerIdAbsentError
+from lib.url import URL, URLRecord, normalize_url
+import collections
+import datetime
+import itertools
+import os
+import time
+import shutil
+import tempfile
+import threading
+import unittest
+import uuid
 
 
 class SimpleTest(TestCase):
@@ -14,3 +43,893 @@ class SimpleTest(TestCase):
         Tests that 1 + 1 always equals 2.
         """
         self.assertEqual(1 + 1, 2)
+
+
+class StorageAssertions(object):
+    def assertFields(self, item, **fields):
+        for field, value in fields.items():
+            self.assertEqual(unicode(item.get(field)), unicode(value), "Field %s is %r, not %r." % (field, item.get(field), value))
+
+
+class StorageConformance(StorageAssertions):
+    """
+    The protocol every storage backend must obey. Descendants provide the storages
+    of four kinds: "items" (any fields), "counters" (integer values), "lists" (text values),
+    and "domains" (integer values with compound ids, as in the popular domains dimension).
+
+    The values are compared as unicode, since some backends keep all the values as strings.
+    The items can have more fields than stored (e.g., the fields of the ids); these are ignored.
+    """
+
+    conditional_store = True # whether the backend supports store() with expect/unique.
+
+    def make_storage(self, kind):
+        raise NotImplementedError()
+
+    def setUp(self):
+        self.items = self.make_storage('items')
+        self.counters = self.make_storage('counters')
+        self.lists = self.make_storage('lists')
+        self.domains = self.make_storage('domains')
+
+    def test_fetch_absent(self):
+        self.assertRaises(StorageItemAbsentError, self.items.fetch, 'absent')
+
+    def test_create_and_fetch(self):
+        self.items.create(lambda: {'id': 'a1', 'name': 'first', 'score': 1})
+        self.assertFields(self.items.fetch('a1'), id='a1', name='first', score=1)
+
+    def test_create_collision(self):
+        self.items.create(lambda: {'id': 'a1', 'name': 'first'})
+        self.assertRaises(StorageExpectationError, self.items.create, lambda: {'id': 'a1', 'name': 'second'})
+        self.assertFields(self.items.fetch('a1'), name='first')
+
+    def test_create_retries_with_new_ids(self):
+        self.items.create(lambda: {'id': 'a1', 'name': 'first'})
+        ids = iter(['a1', 'a2'])
+        item = self.items.create(lambda: {'id': next(ids), 'name': 'second'}, retries=2)
+        self.assertFields(item, id='a2')
+        self.assertFields(self.items.fetch('a2'), name='second')
+
+    def test_mfetch_skips_absent(self):
+        self.items.create(lambda: {'id': 'a1', 'name': 'first'})
+        self.items.create(lambda: {'id': 'a2', 'name': 'second'})
+        items = self.items.mfetch(['a1', 'a2', 'absent'])
+        self.assertEqual(sorted([unicode(item['name']) for item in items]), [u'first', u'second'])
+        self.assertEqual(self.items.mfetch([]), [])
+
+    def test_select(self):
+        for index, name in enumerate(['x', 'y', 'x', 'x']):
+            self.items.create(lambda: {'id': 'a%d' % index, 'name': name, 'score': index})
+        items = self.items.select(filters={'name': 'x'}, sorters=[('score', True)], limit=2)
+        self.assertEqual([unicode(item['id']) for item in items], [u'a3', u'a2'])
+
+    def test_update_creates_and_merges(self):
+        self.items.update('a1', lambda item: {'name': 'first'})
+        self.items.update('a1', lambda item: {'score': 2})
+        self.assertFields(self.items.fetch('a1'), name='first', score=2)
+
+    def test_update_sees_current_values(self):
+        self.items.update('a1', lambda item: {'name': 'first'})
+        self.items.update('a1', lambda item: {'name': item['name'] + '!'})
+        self.assertFields(self.items.fetch('a1'), name='first!')
+
+    def test_replace_absent(self):
+        self.assertRaises(StorageItemAbsentError, self.items.replace, 'absent', lambda item: {'name': 'none'})
+
+    def test_replace_existing(self):
+        self.items.create(lambda: {'id': 'a1', 'name': 'first', 'score': 1})
+        self.items.replace('a1', lambda item: {'name': 'second'}, field='name')
+        self.assertFields(self.items.fetch('a1'), name='second', score=1)
+
+    def test_store_conditional(self):
+        if not self.conditional_store:
+            return
+        self.items.store('a1', {'name': 'first'}, unique=True)
+        self.assertRaises(StorageExpectationError, self.items.store, 'a1', {'name': 'again'}, unique=True)
+        self.assertRaises(StorageExpectationError, self.items.store, 'a1', {'name': 'third'}, expect={'name': 'second'})
+        self.items.store('a1', {'name': 'second'}, expect={'name': 'first'})
+        self.assertFields(self.items.fetch('a1'), name='second')
+
+    def test_increment_and_decrement(self):
+        self.assertEqual(int(self.counters.increment('c1', 5)), 5)
+        self.assertEqual(int(self.counters.increment('c1', 2)), 7)
+        self.assertEqual(int(self.counters.decrement('c1', 3)), 4)
+        self.assertFields(self.counters.fetch('c1'), value=4)
+
+    def test_append(self):
+        self.assertEqual(unicode(self.lists.append('l1', ':::a')), u':::a')
+        self.assertEqual(unicode(self.lists.append('l1', ':::b')), u':::a:::b')
+        self.assertFields(self.lists.fetch('l1'), value=':::a:::b')
+
+    def test_compound_ids(self):
+        self.domains.increment(DomainCounterID(time_shard=1, domain='example.com'), 1)
+        self.domains.increment(DomainCounterID(time_shard=1, domain='example.com'), 1)
+        self.domains.increment(DomainCounterID(time_shard=2, domain='example.com'), 1)
+        self.assertFields(self.domains.fetch(DomainCounterID(time_shard=1, domain='example.com')), time_shard=1, domain='example.com', value=2)
+        items = self.domains.mfetch([DomainCounterID(time_shard=shard, domain='example.com') for shard in [1, 2, 3]])
+        self.assertEqual(sorted([(int(item['time_shard']), int(item['value'])) for item in items]), [(1, 2), (2, 1)])
+
+    def test_mcreate_reports_collisions(self):
+        self.items.create(lambda: {'id': 'a2', 'name': 'existing'})
+        results = self.items.mcreate([lambda id=id: {'id': id, 'name': 'new'} for id in ['a1', 'a2', 'a3']])
+        self.assertEqual([isinstance(result, StorageExpectationError) for result in results], [False, True, False])
+        self.assertFields(self.items.fetch('a2'), name='existing')
+        self.assertFields(self.items.fetch('a3'), name='new')
+
+    def test_mcreate_retries_failed_only(self):
+        self.items.create(lambda: {'id': 'a1', 'name': 'existing'})
+        ids = iter(['a1', 'a2', 'a3'])
+        results = self.items.mcreate([lambda: {'id': next(ids), 'name': 'new'}], retries=2)
+        self.assertFields(results[0], id='a2')
+        self.assertRaises(StorageItemAbsentError, self.items.fetch, 'a3')
+
+    def test_mstore(self):
+        self.items.create(lambda: {'id': 'a1', 'name': 'first', 'score': 1})
+        self.items.mstore([('a1', {'name': 'changed'}), ('a2', {'name': 'new'})])
+        self.assertFields(self.items.fetch('a1'), name='changed', score=1)
+        self.assertFields(self.items.fetch('a2'), name='new')
+
+    def test_mincrement(self):
+        self.counters.increment('c1', 10)
+        self.assertEqual([int(value) for value in self.counters.mincrement([('c1', 1), ('c2', 5)])], [11, 5])
+
+
+class SQLiteStorageTest(StorageConformance, unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        super(SQLiteStorageTest, self).setUp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def make_storage(self, kind):
+        # A new file per test, so the storages see no data (and no columns) of other tests.
+        return SQLiteStorage('%s/storage.sqlite' % self.directory, kind)
+
+
+class WrappedSQLiteStorageTest(SQLiteStorageTest):
+    def make_storage(self, kind):
+        return WrappedStorage(super(WrappedSQLiteStorageTest, self).make_storage(kind), host='example.com')
+
+
+class InstrumentedSQLiteStorageTest(SQLiteStorageTest):
+    """
+    The instrumentation must not change the semantics of the storage it is placed over.
+    """
+
+    def setUp(self):
+        self.metrics = StorageMetrics()
+        super(InstrumentedSQLiteStorageTest, self).setUp()
+
+    def make_storage(self, kind):
+        return InstrumentedStorage(super(InstrumentedSQLiteStorageTest, self).make_storage(kind), metrics=self.metrics)
+
+    def test_metrics(self):
+        self.items.create(lambda: {'id': 'a1', 'name': 'first'})
+        self.assertRaises(StorageItemAbsentError, self.items.fetch, 'a2')
+        self.items.mfetch(['a1', 'a2', 'a3'])
+        ids = iter(['a1', 'a1', 'a2'])
+        self.items.create(lambda: {'id': ids.next(), 'name': 'second'}, retries=3)
+        metrics = self.metrics.tables('items')
+        self.assertEqual((metrics['fetch']['calls'], metrics['fetch']['errors']), (1, 0))
+        self.assertEqual((metrics['mfetch']['items'], metrics['mfetch']['bytes']), (3, len('ida1namefirst')))
+        self.assertEqual((metrics['create']['calls'], metrics['create']['repeats']), (2, 2))
+        self.assertEqual(sum(metrics['create']['histogram'].values()), 2)
+        self.assertTrue(metrics['create']['p50'] <= metrics['create']['p99'] <= metrics['create']['max'])
+
+    def test_slow_log_and_trace(self):
+        self.counters.slow_threshold = 0
+        with traced() as trace:
+            self.counters.mincrement([('c%d' % index, 1) for index in xrange(15)])
+            self.counters.increment('c1', 1)
+        self.assertEqual(trace, {'counters.mincrement': {'calls': 1, 'duration': trace['counters.mincrement']['duration']},
+                                 'counters.increment': {'calls': 1, 'duration': trace['counters.increment']['duration']}})
+        slow = self.metrics.snapshot()['slow']
+        self.assertEqual([entry['operation'] for entry in slow], ['mincrement', 'increment'])
+        self.assertEqual(slow[0]['ids'], ['c%d' % index for index in xrange(10)] + ['... 5 more'])
+
+
+class ShardedSQLiteStorageTest(SQLiteStorageTest):
+    def make_storage(self, kind):
+        return ShardedStorage(dict([(shard, SQLiteStorage('%s/%s.sqlite' % (self.directory, shard), kind)) for shard in ['s1', 's2', 's3']]))
+
+    def test_items_are_spread(self):
+        self.counters.mincrement([('c%d' % index, 1) for index in xrange(100)])
+        counts = [len(storage.select()) for name, storage in sorted(self.counters.shards.items())]
+        self.assertEqual(sum(counts), 100)
+        self.assertTrue(min(counts) > 15, counts)
+
+
+class ShardedStorageTest(StorageAssertions, unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.shards = dict([(shard, SQLiteStorage('%s/%s.sqlite' % (self.directory, shard), 'urls')) for shard in ['s1', 's2', 's3']])
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def make_storage(self, shards, previous=None):
+        sharded = ShardedStorage(dict([(shard, self.shards[shard]) for shard in shards]), previous=previous, key=lambda item: WrappedID(item['id'], host=item['host']))
+        return sharded, WrappedStorage(sharded, host='example.com')
+
+    def test_ring_moves_one_of_n(self):
+        ring = HashRing(['s1', 's2', 's3'])
+        before = dict([(key, ring.get(key)) for key in ['key%d' % index for index in xrange(10000)]])
+        ring.add('s4')
+        moved = [key for key, node in before.items() if ring.get(key) != node]
+        self.assertTrue(1500 < len(moved) < 3500, len(moved))
+        self.assertEqual(set([ring.get(key) for key in moved]), set(['s4']))
+
+    def test_rebalance(self):
+        old, storage = self.make_storage(['s1', 's2'])
+        storage.mcreate([lambda index=index: {'id': 'a%d' % index, 'code': 'a%d' % index} for index in xrange(300)])
+
+        sharded, storage = self.make_storage(['s1', 's2', 's3'], previous=['s1', 's2'])
+        self.assertEqual(len(storage.mfetch(['a%d' % index for index in xrange(300)])), 300) # from the old shards.
+        self.assertFields(storage.fetch('a7'), code='a7')
+        self.assertEqual(len(storage.select()), 300)
+
+        counters = rebalance(sharded)
+        self.assertTrue(50 < counters['moved'] < 150, counters)
+        self.assertEqual((counters['scanned'], counters['conflicts']), (300, 0))
+        self.assertEqual(rebalance(sharded)['conflicts'], counters['moved'])
+
+        sharded, storage = self.make_storage(['s1', 's2', 's3'])
+        self.assertEqual(len(storage.mfetch(['a%d' % index for index in xrange(300)])), 300) # from the new shards only.
+        self.assertEqual(len(storage.select()), 300)
+        self.assertEqual(sharded.stats()['stale'], counters['moved'])
+
+
+class GuardedSQLiteStorageTest(SQLiteStorageTest):
+    """
+    The existence guard must not change the semantics of the storage it is placed over.
+    """
+
+    def make_storage(self, kind):
+        storage = GuardedStorage(super(GuardedSQLiteStorageTest, self).make_storage(kind), path='%s/%s.bloom' % (self.directory, kind), check_interval=0)
+        storage.rebuild()
+        return storage
+
+    def test_bloom(self):
+        bloom = BloomFilter(capacity=1000, error_rate=0.01)
+        for index in xrange(1000):
+            bloom.add(u'key%d' % index)
+        self.assertTrue(all(u'key%d' % index in bloom for index in xrange(1000)))
+        false_positives = len([index for index in xrange(1000, 11000) if u'key%d' % index in bloom])
+        self.assertTrue(false_positives < 200, "%d false positives of 10000." % false_positives) # ~1%.
+        bloom.save('%s/test.bloom' % self.directory)
+        loaded = BloomFilter.load('%s/test.bloom' % self.directory)
+        self.assertEqual((loaded.count, loaded.bits), (bloom.count, bloom.bits))
+
+    def test_absent_ids_are_rejected(self):
+        self.items.create(lambda: {'id': 'a1', 'name': 'first'})
+        self.assertRaises(StorageItemAbsentError, self.items.fetch, 'a2')
+        self.assertEqual(len(self.items.mfetch(['a1', 'a2'])), 1)
+        self.assertEqual(self.items.stats()['rejected'], 2)
+
+    def test_ids_of_other_processes(self):
+        other = GuardedStorage(self.items.storage, path=self.items.path)
+        other.create(lambda: {'id': 'a1', 'name': 'first'})
+        self.assertFields(self.items.fetch('a1'), name='first') # from the journal.
+        other.compact()
+        self.items.create(lambda: {'id': 'a2', 'name': 'second'}) # re-loads the filter, since the journal is restarted.
+        self.assertFields(other.fetch('a2'), name='second')
+        self.assertEqual(self.items.stats()['rejected'] + other.stats()['rejected'], 0)
+
+    def test_passes_through_until_built(self):
+        path = '%s/unbuilt.bloom' % self.directory
+        storage = self.items.storage
+        guard = GuardedStorage(storage, path=path, check_interval=0)
+        self.assertRaises(StorageItemAbsentError, guard.fetch, 'a0')
+        guard.create(lambda: {'id': 'a1', 'name': 'first'})
+        self.assertEqual(guard.stats()['unguarded'], 1)
+        self.assertFalse(os.path.exists(path))
+
+        # The builder's scan has missed the id created meanwhile, but the journal has it.
+        builder = GuardedStorage(SQLiteStorage('%s/empty.sqlite' % self.directory, 'items'), path=path)
+        builder.rebuild()
+        self.assertFields(guard.fetch('a1'), name='first')
+        self.assertRaises(StorageItemAbsentError, guard.fetch, 'a0')
+        self.assertEqual(guard.stats()['rejected'], 1)
+
+
+class CachedSQLiteStorageTest(SQLiteStorageTest):
+    """
+    The process-local cache must not change the semantics of the storage it is placed over,
+    except for the absent items, which stay absent for absent_ttl seconds after the lookup.
+    """
+
+    def make_storage(self, kind):
+        return CachedStorage(super(CachedSQLiteStorageTest, self).make_storage(kind), absent_ttl=0.2)
+
+    def test_absent_items_are_cached(self):
+        self.assertRaises(StorageItemAbsentError, self.items.fetch, 'a1')
+        self.items.storage.create(lambda: {'id': 'a1', 'name': 'behind'}) # not through the cache.
+        self.assertRaises(StorageItemAbsentError, self.items.fetch, 'a1')
+        time.sleep(0.2)
+        self.assertFields(self.items.fetch('a1'), name='behind')
+
+    def test_collided_items_are_not_absent(self):
+        self.assertRaises(StorageItemAbsentError, self.items.fetch, 'a1')
+        self.items.storage.create(lambda: {'id': 'a1', 'name': 'behind'}) # not through the cache.
+        self.assertRaises(StorageExpectationError, self.items.create, lambda: {'id': 'a1', 'name': 'first'})
+        self.assertFields(self.items.fetch('a1'), name='behind')
+
+        self.assertRaises(StorageItemAbsentError, self.items.fetch, 'a2')
+        self.items.storage.create(lambda: {'id': 'a2', 'name': 'behind'})
+        ids = iter(['a2', 'a3'])
+        self.assertFields(self.items.create(lambda: {'id': next(ids), 'name': 'retried'}, retries=2), name='retried')
+        self.assertFields(self.items.fetch('a2'), name='behind')
+
+        self.assertRaises(StorageItemAbsentError, self.items.fetch, 'a4')
+        self.items.storage.create(lambda: {'id': 'a4', 'name': 'behind'})
+        self.assertTrue(isinstance(self.items.mcreate([lambda: {'id': 'a4', 'name': 'first'}])[0], StorageExpectationError))
+        self.assertFields(self.items.fetch('a4'), name='behind')
+
+    def test_created_items_are_cached(self):
+        self.items.create(lambda: {'id': 'a1', 'name': 'first'})
+        self.items.storage.update('a1', lambda item: {'name': 'behind'})
+        self.assertFields(self.items.fetch('a1'), name='first')
+        self.assertEqual([item['name'] for item in self.items.mfetch(['a1'])], ['first'])
+        self.items.update('a1', lambda item: {'score': 1}) # drops it from the cache.
+        self.assertFields(self.items.fetch('a1'), name='behind', score=1)
+
+    def test_mfetch_fetches_missing_only(self):
+        self.items.create(lambda: {'id': 'a1', 'name': 'first'})
+        self.items.storage.create(lambda: {'id': 'a2', 'name': 'second'})
+        self.assertEqual(sorted([item['name'] for item in self.items.mfetch(['a1', 'a2', 'a3'])]), ['first', 'second'])
+        self.assertEqual(self.items.stats()['hits'], 1)
+        self.assertFields(self.items.fetch('a2'), name='second')
+        self.assertEqual(self.items.stats()['hits'], 2)
+
+    def test_lru_cache(self):
+        cache = LRUCache(size=2)
+        cache.put('a', 1)
+        cache.put('b', 2)
+        cache.get('a')
+        cache.put('c', 3) # evicts "b", since "a" was used recently.
+        self.assertEqual(cache.get_many(['a', 'b', 'c']), {'a': 1, 'c': 3})
+        cache.put('d', 4, ttl=0) # evicts "a", and expires at once.
+        self.assertEqual(cache.get('d'), None)
+        self.assertEqual(cache.stats()['evictions'], 2)
+        self.assertEqual(cache.stats()['expirations'], 1)
+
+
+class MemcachedSQLiteStorageTest(SQLiteStorageTest):
+    """
+    The shared cache tier must not change the semantics of the storage it is placed over.
+    Two stand-in servers are used, so the multi-key operations are spread over both of them.
+    """
+
+    def setUp(self):
+        self.servers = [MemcachedServer().start() for i in xrange(2)]
+        self.cache = MemcachedCache([server.address for server in self.servers], prefix='test:')
+        super(MemcachedSQLiteStorageTest, self).setUp()
+
+    def tearDown(self):
+        for server in self.servers:
+            server.stop()
+        super(MemcachedSQLiteStorageTest, self).tearDown()
+
+    def make_storage(self, kind):
+        return CachedStorage(super(MemcachedSQLiteStorageTest, self).make_storage(kind), cache=self.cache)
+
+    def test_items_are_shared(self):
+        self.items.create(lambda: {'id': 'a1', 'name': 'first'})
+        self.items.mfetch(['a1', 'a2'])
+        other = CachedStorage(SQLiteStorage('%s/other.sqlite' % self.directory, 'items'), cache=self.cache)
+        self.assertFields(other.fetch('a1'), name='first') # from the cache, since the other storage is empty.
+        self.assertEqual(other.mfetch(['a1', 'a2']), [{'id': 'a1', 'name': 'first'}])
+
+
+class MemcachedCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.servers = [MemcachedServer().start() for i in xrange(3)]
+        self.cache = MemcachedCache([server.address for server in self.servers], prefix='test:')
+
+    def tearDown(self):
+        for server in self.servers:
+            server.stop()
+
+    def test_get_many_over_servers(self):
+        self.cache.put_many([('key%d' % index, {'value': index}) for index in xrange(100)])
+        self.assertEqual(len([server for server in self.servers if server.entries]), 3)
+        values = self.cache.get_many(['key%d' % index for index in xrange(110)])
+        self.assertEqual(values, dict(('key%d' % index, {'value': index}) for index in xrange(100)))
+
+    def test_ttl(self):
+        self.cache.put('key', 'value', ttl=1)
+        self.assertEqual(self.cache.get('key'), 'value')
+        time.sleep(1.1)
+        self.assertEqual(self.cache.get('key'), None)
+
+    def test_unsafe_keys(self):
+        for key in [u'with space', u'\u044e\u043d\u0438\u043a\u043e\u0434', 'x' * 300]:
+            self.cache.put(key, key)
+            self.assertEqual(self.cache.get(key), key)
+
+    def test_dead_server_is_miss(self):
+        self.cache.put_many([('key%d' % index, index) for index in xrange(30)])
+        self.servers[0].stop()
+        values = self.cache.get_many(['key%d' % index for index in xrange(30)])
+        self.assertTrue(0 < len(values) < 30)
+        self.assertEqual(self.cache.stats()['dead'], 1)
+
+
+class SnapshotStorageTest(StorageAssertions, unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = '%s/urls.cdb' % self.directory
+        self.live = WrappedStorage(SQLiteStorage('%s/storage.sqlite' % self.directory, 'urls'), host='example.com')
+        self.storage = SnapshotStorage(self.live, self.path, check_interval=0)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def create(self, code, url):
+        self.storage.create(lambda: {'id': code, 'code': code, 'url': url, 'created_ts': 1000})
+
+    def test_cdb(self):
+        writer = CDBWriter(self.path)
+        for index in xrange(10000):
+            writer.add('key%d' % index, 'value%d' % index)
+        writer.finish()
+        reader = CDB(self.path)
+        self.assertEqual(len(reader), 10000)
+        self.assertEqual([reader.get('key%d' % index) for index in xrange(0, 10000, 997)], ['value%d' % index for index in xrange(0, 10000, 997)])
+        self.assertEqual(reader.get('absent'), None)
+
+    def test_fallback_to_live(self):
+        self.create('a1', u'http://example.com/\u044e')
+        self.assertEqual(export_snapshot(self.live, self.path, field='code', fields=['url', 'code', 'created_ts']), 1)
+        self.create('a2', 'http://example.com/2')
+        self.assertFields(self.storage.fetch('a1'), url=u'http://example.com/\u044e', code='a1', created_ts=1000)
+        self.assertFields(self.storage.fetch('a2'), url='http://example.com/2')
+        self.assertEqual(sorted([item['code'] for item in self.storage.mfetch(['a1', 'a2', 'a3'])]), [u'a1', u'a2'])
+        self.assertEqual(self.storage.stats()['hits'], 2)
+
+    def test_types_match_live(self):
+        self.storage.create(lambda: {'id': 'a1', 'code': 'a1', 'url': 'http://example.com/1', 'remote_port': 12345, 'created_ts': 1000.25, 'comment': '42'})
+        self.storage.create(lambda: {'id': 'a2', 'code': 'a2', 'url': 'http://example.com/2', 'remote_port': 80, 'created_ts': 1234567890.123456})
+        export_snapshot(self.live, self.path, field='code')
+        for code in ['a1', 'a2']:
+            live = self.live.fetch(code)
+            item = self.storage.fetch(code)
+            self.assertEqual(self.storage.stats()['misses'], 0)
+            self.assertEqual(dict([(name, value) for name, value in dict(live).items() if name in item]), item)
+            self.assertEqual([type(item[name]) for name in sorted(item)], [type(live[name]) for name in sorted(item)])
+        self.assertEqual(self.storage.fetch('a1')['comment'], u'42')
+
+    def test_reads_untyped_snapshots(self):
+        writer = CDBWriter(self.path)
+        writer.add('\x00fields', '\x00'.join(['code', 'remote_port']))
+        writer.add('a1', '\x00'.join(['a1', '12345']))
+        writer.finish()
+        self.assertEqual(self.storage.fetch('a1'), {'code': u'a1', 'remote_port': u'12345'})
+
+    def test_survives_storage_outage(self):
+        self.create('a1', 'http://example.com/1')
+        export_snapshot(self.live, self.path, field='code')
+        self.storage.storage = None # any call to the live storage fails now.
+        self.assertFields(self.storage.fetch('a1'), url='http://example.com/1')
+
+    def test_reloads_new_snapshots(self):
+        self.create('a1', 'http://example.com/1')
+        export_snapshot(self.live, self.path, field='code')
+        self.storage.fetch('a1')
+        self.create('a2', 'http://example.com/2')
+        export_snapshot(self.live, self.path, field='code')
+        self.storage.fetch('a2')
+        self.assertEqual(self.storage.stats()['hits'], 2)
+        self.assertEqual(self.storage.stats()['reloads'], 2)
+
+
+class WriteBehindStorageTest(StorageAssertions, unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.counters = SQLiteStorage('%s/storage.sqlite' % self.directory, 'counters')
+        self.storage = WriteBehindStorage(self.counters, max_pending=100, max_delay=None)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_increments_are_coalesced(self):
+        self.assertEqual([int(self.storage.increment('c1', 1)) for index in xrange(5)], [1, 2, 3, 4, 5])
+        self.assertFields(self.counters.fetch('c1'), value=1) # the first one is written through.
+        self.storage.flush()
+        self.assertFields(self.counters.fetch('c1'), value=5)
+        self.assertEqual(self.storage.stats()['flushed_increments'], 1)
+
+    def test_other_processes_appear_after_flush(self):
+        other = WriteBehindStorage(self.counters, max_pending=100, max_delay=None)
+        self.assertEqual(self.storage.increment('c1', 1), 1)
+        self.assertEqual(other.increment('c1', 1), 2)
+        self.assertEqual(self.storage.increment('c1', 1), 2)
+        self.assertEqual(other.increment('c1', 1), 3)
+        self.storage.flush()
+        other.flush()
+        self.assertEqual(self.storage.increment('c1', 1), 4)
+        self.storage.flush()
+        self.assertFields(self.counters.fetch('c1'), value=5)
+
+    def test_reads_see_pending_writes(self):
+        self.storage.increment('c1', 1)
+        self.storage.increment('c1', 2)
+        self.storage.append('l1', ':::a')
+        self.storage.append('l1', ':::b')
+        self.assertFields(self.storage.fetch('c1'), value=3)
+        self.assertEqual([item['value'] for item in self.storage.mfetch(['l1'])], [':::a:::b'])
+
+    def test_flush_on_size(self):
+        self.storage.max_pending = 3
+        for id in ['c1', 'c2', 'c3', 'c1', 'c2', 'c3']:
+            self.storage.increment(id, 1)
+        self.assertEqual(sorted([(item['id'], int(item['value'])) for item in self.counters.select()]), [('c1', 2), ('c2', 2), ('c3', 2)])
+
+    def test_failed_flush_keeps_writes(self):
+        self.storage.increment('c1', 1)
+        self.storage.increment('c1', 1)
+        self.storage.append('l1', ':::a')
+        self.storage.storage = None # any call to the storage fails now.
+        self.assertRaises(AttributeError, self.storage.flush)
+        self.storage.append('l1', ':::b')
+        self.assertEqual(self.storage.increment('c1', 1), 3)
+        self.storage.storage = self.counters
+        self.storage.flush()
+        self.assertFields(self.counters.fetch('c1'), value=3)
+        self.assertFields(self.counters.fetch('l1'), value=':::a:::b')
+        self.assertEqual(self.storage.stats()['errors'], 1)
+
+    def test_popular_domains(self):
+        counters = WriteBehindStorage(SQLiteStorage('%s/storage.sqlite' % self.directory, 'domains'), max_pending=100, max_delay=None)
+        dimension = PopularDomainsDimension(
+            url_domain_counter_storage = counters,
+            grid_level_counter_storage = SQLiteStorage('%s/storage.sqlite' % self.directory, 'grid_counters'),
+            grid_level_domains_storage = SQLiteStorage('%s/storage.sqlite' % self.directory, 'grid_domains'),
+            grid_level_thresholds = [1, 3, 5],
+        )
+        for domain, count in [('a.com', 6), ('b.com', 3), ('c.com', 1)]:
+            for index in xrange(count):
+                dimension.register(URL(url='http://www.%s/%d' % (domain, index), created_ts=time.time()))
+        self.assertEqual(counters.stats()['written_through'], 3)
+        self.assertEqual(dimension.retrieve(2, datetime.timedelta(days=1)), [{'domain': 'a.com', 'count': 6}, {'domain': 'b.com', 'count': 3}])
+
+
+@unittest.skipIf(not getattr(settings, 'TEST_MYSQL_DATABASE', None), "TEST_MYSQL_DATABASE is not set.")
+class MysqlStorageTest(StorageConformance, unittest.TestCase):
+
+    conditional_store = False
+
+    SCHEMAS = {
+        'items':    "id varchar(100) not null, name varchar(100) default null, score integer default null, primary key (id)",
+        'counters': "id varchar(100) not null, value bigint unsigned not null default 0, primary key (id)",
+        'lists':    "id varchar(100) not null, value varchar(1000) not null default '', primary key (id)",
+        'domains':  "time_shard integer not null, domain varchar(255) not null, value bigint unsigned not null default 0, primary key (time_shard, domain)",
+    }
+
+    def setUp(self):
+        import MySQLdb
+        self.connection = MySQLdb.connect(host=settings.MYSQL_HOSTNAME, user=settings.MYSQL_USERNAME, passwd=settings.MYSQL_PASSWORD, db=settings.TEST_MYSQL_DATABASE)
+        cursor = self.connection.cursor()
+        for kind, schema in self.SCHEMAS.items():
+            cursor.execute("DROP TABLE IF EXISTS conformance_%s" % kind)
+            cursor.execute("CREATE TABLE conformance_%s (%s) engine=innodb" % (kind, schema))
+        self.connection.commit()
+        super(MysqlStorageTest, self).setUp()
+
+    def tearDown(self):
+        cursor = self.connection.cursor()
+        for kind in self.SCHEMAS:
+            cursor.execute("DROP TABLE IF EXISTS conformance_%s" % kind)
+        self.connection.close()
+
+    def make_storage(self, kind):
+        return MysqlStorage(settings.MYSQL_HOSTNAME, settings.MYSQL_USERNAME, settings.MYSQL_PASSWORD, settings.TEST_MYSQL_DATABASE, 'conformance_%s' % kind)
+
+
+class MysqlReplicatedStorageTest(MysqlStorageTest):
+    # The server is its own replica here, so the reads are routed, but see the same data.
+    def make_storage(self, kind):
+        return MysqlStorage(settings.MYSQL_HOSTNAME, settings.MYSQL_USERNAME, settings.MYSQL_PASSWORD, settings.TEST_MYSQL_DATABASE, 'conformance_%s' % kind,
+                            replicas=[settings.MYSQL_HOSTNAME], read_your_writes=0)
+
+
+class MysqlReplicaRoutingTest(unittest.TestCase):
+    # The routing only; nothing is connected to, since the lag checks are disabled.
+    def setUp(self):
+        self.storage = MysqlStorage('primary', 'user', 'password', 'database', 'urls', read_your_writes=5)
+        self.storage.replicas = [MysqlReplica(MysqlPool(hostname, 'user', 'password', 'database'), lag_interval=None) for hostname in ['replica1', 'replica2']]
+
+    def test_round_robin(self):
+        hostnames = [self.storage._replica(['x']).hostname for index in xrange(4)]
+        self.assertEqual(sorted(hostnames), ['replica1', 'replica1', 'replica2', 'replica2'])
+        self.assertNotEqual(hostnames[0], hostnames[1])
+
+    def test_latency(self):
+        self.storage.balancing = 'latency'
+        self.storage.replicas[0].succeeded(0.010)
+        self.storage.replicas[1].succeeded(0.002)
+        self.assertEqual(self.storage._replica(['x']).hostname, 'replica2')
+
+    def test_read_your_writes(self):
+        self.storage._written(['x'])
+        self.assertIsNone(self.storage._replica(['x']))
+        self.assertIsNone(self.storage._replica(None))
+        self.assertIsNotNone(self.storage._replica(['y']))
+        self.storage.recent[self.storage._pk_key('x')] = self.storage.written_ts = time.time() - 10
+        self.assertIsNotNone(self.storage._replica(['x']))
+
+    def test_failover(self):
+        self.storage.replicas[0].failed()
+        self.assertEqual(set([self.storage._replica(['x']).hostname for index in xrange(4)]), set(['replica2']))
+        self.storage.replicas[1].lag = 60
+        self.assertEqual(self.storage._replica(['x']).hostname, 'replica2') # any lag is fine by default.
+        self.storage.max_lag = 30
+        self.assertIsNone(self.storage._replica(['x']))
+        self.assertEqual(self.storage.stats()['unavailable'], 1)
+
+
+@unittest.skipIf(not getattr(settings, 'TEST_SDB_PREFIX', None), "TEST_SDB_PREFIX is not set.")
+class SDBStorageTest(StorageConformance, unittest.TestCase):
+    def setUp(self):
+        # The domains are shared by the tests, so the ids are made unique per test instead.
+        self.host = uuid.uuid4().hex
+        super(SDBStorageTest, self).setUp()
+
+    def make_storage(self, kind):
+        storage = SDBStorage(settings.AWS_ACCESS_KEY, settings.AWS_SECRET_KEY, '%s_%s' % (settings.TEST_SDB_PREFIX, kind))
+        return WrappedStorage(storage, host=self.host)
+
+    def test_connections_per_thread(self):
+        self.items.create(lambda: {'id': 'a1', 'name': 'first'})
+        connections = [self.items.storage.connection]
+        def fetch():
+            self.assertFields(self.items.fetch('a1'), name='first')
+            connections.append(self.items.storage.connection)
+        thread = threading.Thread(target=fetch)
+        thread.start()
+        thread.join()
+        self.assertEqual(len(set(map(id, connections))), 2)
+
+
+class GeneratorsTest(unittest.TestCase):
+    # The persistent generators keep their state in the SQLite storage, one file per test.
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.storage = SQLiteStorage('%s/storage.sqlite' % self.directory, 'generators')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_centralized(self):
+        generator = CentralizedGenerator(self.storage)
+        self.assertEqual([generator.generate() for index in xrange(3)], ['a', 'b', 'c'])
+        self.assertEqual(generator.generate_many(2), ['d', 'e'])
+        self.assertEqual(self.storage.fetch('centralized')['value'], 'e')
+
+    def test_lease_reserves_blocks(self):
+        lease = Lease(size=10)
+        generator = CentralizedGenerator(self.storage, lease=lease)
+        self.assertEqual([generator.generate() for index in xrange(3)], ['a', 'b', 'c'])
+        self.assertEqual(self.storage.fetch('centralized')['value'], 'j') # the whole block is reserved at once.
+
+        # Another process has its own lease, so it gets the next block.
+        other = CentralizedGenerator(self.storage, lease=Lease(size=10))
+        self.assertEqual(other.generate(), 'k')
+        ids = [generator.generate() for index in xrange(20)] + [other.generate() for index in xrange(20)]
+        self.assertEqual(len(set(ids)), 40)
+
+    def test_lease_adapts_to_rate(self):
+        lease = Lease(size=10, max_size=15, period=10)
+        generator = CentralizedGenerator(self.storage, lease=lease)
+        for index in xrange(11):
+            generator.generate()
+        self.assertEqual(lease.size, 15) # used up at once, so it grows, but within the limits.
+
+    def test_distributed(self):
+        generator = DistributedGenerator(self.storage, letters='ab', pool_size=2, part_length=1)
+        ids = [generator.generate() for index in xrange(30)]
+        self.assertEqual(len(set(ids)), 30) # the children are depleted after two ids each, and replaced.
+        self.assertEqual(len(self.storage.fetch('distributed')['value'].split()), 2)
+        for id in ids:
+            prefix = id[:-1]
+            self.assertTrue(self.storage.fetch('distributed/%s' % prefix)['value'] in 'ab')
+
+    def test_codec(self):
+        codec = Codec(letters='abc', min_length=2, max_length=3)
+        self.assertEqual([codec.encode(number) for number in [0, 1, 3, 9, 26]], ['aa', 'ab', 'ba', 'baa', 'ccc'])
+        self.assertEqual([codec.decode(codec.encode(number)) for number in xrange(27)], range(27))
+        self.assertEqual(codec.decode('a?'), 2) # unknown letters are the last ones.
+        self.assertRaises(DepletedError, codec.encode, 27)
+
+    def test_codec_skips_prohibited_ranges(self):
+        codec = Codec(letters='abc', min_length=2, prohibit=r'^b | c$')
+        self.assertEqual(codec.skip(0), 0)
+        self.assertEqual(codec.skip(2), 6) # "ac" (suffix), "ba"-"bc" (prefix, at once), then "ca".
+        self.assertEqual(codec.encode(codec.skip(8)), 'caa') # "cc", then "baa"-"bcc" at once.
+        sequence = Sequence(self.storage, 'sequence', letters='abc', min_length=2, prohibit=r'^b | c$')
+        self.assertEqual(sequence.reserve(4), ['aa', 'ab', 'ca', 'cb'])
+        self.assertEqual(sequence.generate(), 'caa')
+
+    def test_time(self):
+        # Four ids per tick per node, so the generator has to wait for the next ticks.
+        generators = [TimeGenerator(node=node, node_bits=2, counter_bits=2, resolution=0.01, epoch=time.time()) for node in [1, 2]]
+        ids = [[generator.generate() for index in xrange(20)] for generator in generators]
+        numbers = [generators[0].codec.decode(id) for id in ids[0]]
+        self.assertEqual(numbers, sorted(set(numbers)))
+        self.assertEqual(len(set(ids[0] + ids[1])), 40)
+        self.assertEqual(set([number >> 2 & 3 for number in numbers]), set([1]))
+
+    def test_time_configurations(self):
+        # Same node with the fine and the coarse ticks: the coarse one must not wait for the fine ticks.
+        now = time.time()
+        fine = TimeGenerator(node=3, node_bits=2, counter_bits=2, resolution=0.001, epoch=now - 100)
+        coarse = TimeGenerator(node=3, node_bits=2, counter_bits=2, resolution=10, epoch=now)
+        fine.generate()
+        ids = []
+        thread = threading.Thread(target=lambda: ids.extend([coarse.generate() for index in xrange(4)]))
+        thread.daemon = True
+        thread.start()
+        thread.join(5)
+        self.assertFalse(thread.is_alive(), "The coarse generator waits for the ticks of the fine one.")
+        self.assertEqual([coarse.codec.decode(id) >> 4 for id in ids], [0, 0, 0, 0])
+
+    def test_hash_candidates(self):
+        generator = HashGenerator(min_length=3, max_length=5, salt='example.com')
+        iterator = generator.candidates('http://example.com/')
+        candidates = list(itertools.islice(iterator, 3))
+        self.assertEqual(map(len, candidates), [3, 4, 5])
+        self.assertRaises(DepletedError, next, iterator)
+        self.assertEqual(list(itertools.islice(generator.candidates('http://example.com/'), 3)), candidates)
+        self.assertNotEqual(next(HashGenerator(min_length=3).candidates('http://example.com/')), candidates[0])
+
+    def test_hash_distribution(self):
+        # Every position of the codes must be uniform, or the short codes collide more often than they should.
+        generator = HashGenerator(min_length=4)
+        codes = [next(generator.candidates('http://example.com/%d' % index)) for index in xrange(7300)]
+        for position in xrange(4):
+            counts = collections.Counter([code[position] for code in codes])
+            self.assertEqual(len(counts), 73)
+            self.assertTrue(max(counts.values()) < 200, "Letter %r is used %d times of ~100 at position %d." % (counts.most_common(1)[0] + (position,)))
+
+    def test_counter(self):
+        generator = CounterGenerator(self.storage, letters='abc', min_length=2, prohibit=r'^b')
+        self.assertEqual([generator.generate() for index in xrange(3)], ['ab', 'ac', 'ca']) # "ba"-"bc" at once.
+        self.assertEqual(generator.generate_many(4), ['cb', 'cc', 'caa', 'cab']) # "baa"-"bcc" beyond the batch.
+        self.assertEqual(generator.generate_many(2), ['cac', 'cba'])
+        self.assertEqual(int(self.storage.fetch('counter')['value']), 21)
+
+    def test_pool(self):
+        source = CentralizedGenerator(self.storage, id='source')
+        generator = PoolGenerator(self.storage, source, size=5, probes=100, chunk=2, low_water=0)
+        self.assertEqual(generator.refill(), 0)
+        self.assertEqual(generator.refill(), 5)
+        ids = [generator.generate() for index in xrange(5)]
+        self.assertEqual(sorted(ids), ['a', 'b', 'c', 'd', 'e'])
+        self.assertEqual(generator.generate(), 'f') # the pool is empty, so the source is used directly.
+        self.assertEqual(generator.stats()['claims'], 5)
+        self.assertEqual(generator.stats()['fallbacks'], 1)
+        self.assertEqual(generator.refill(), 0)
+        self.assertEqual(sorted([generator.generate() for index in xrange(5)]), ['g', 'h', 'i', 'j', 'k'])
+
+    def test_pool_refills_in_bulk(self):
+        metrics = StorageMetrics()
+        pool = InstrumentedStorage(SQLiteStorage('%s/storage.sqlite' % self.directory, 'pool'), metrics=metrics)
+        source = CentralizedGenerator(InstrumentedStorage(self.storage, metrics=metrics), id='source')
+        generator = PoolGenerator(pool, source, size=5, probes=100, chunk=2, low_water=0)
+        for expected in [['a', 'b', 'c', 'd', 'e'], ['f', 'g', 'h', 'i', 'j']]:
+            self.assertEqual(generator.refill(), 0)
+            self.assertEqual(sorted([generator.generate() for index in xrange(5)]), expected)
+        tables = metrics.tables()
+        self.assertEqual(tables['pool']['mstore']['calls'], 6) # one per chunk, three chunks per refill.
+        self.assertEqual(tables['generators']['update']['calls'], 6) # one reservation per chunk.
+        self.assertEqual(sorted(tables['pool']), ['mfetch', 'mstore', 'replace'])
+
+
+class RecordingRegistry(Registry):
+    def __init__(self):
+        super(RecordingRegistry, self).__init__()
+        self.urls = []
+
+    def register(self, url):
+        self.urls.append(url)
+
+
+class LaggingStorage(SQLiteStorage):
+    """
+    Does not see the items created behind it for the first few fetches, as a lagging replica does.
+    """
+    def __init__(self, path, name, lag):
+        super(LaggingStorage, self).__init__(path, name)
+        self.lag = lag
+
+    def fetch(self, id):
+        if self.lag > 0:
+            self.lag -= 1
+            raise StorageItemAbsentError("The item is not replicated yet.")
+        return super(LaggingStorage, self).fetch(id)
+
+
+class ShortenerTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = '%s/storage.sqlite' % self.directory
+        self.storage = WrappedStorage(SQLiteStorage(self.path, 'urls'), host='example.com')
+        self.registry = RecordingRegistry()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def make_shortener(self, **kwargs):
+        generator = CentralizedGenerator(WrappedStorage(SQLiteStorage(self.path, 'sequences'), host='example.com'))
+        return Shortener(self.storage, self.registry, generator, **kwargs)
+
+    def test_shorten_many_and_resolve_many(self):
+        shortener = self.make_shortener()
+        shortener.shorten('http://example.com/first', id_wanted='b') # the generated "b" collides with it.
+        results = shortener.shorten_many(['http://example.com/1', 'not an url', 'http://example.com/2', 'http://example.com/3'])
+        self.assertEqual([result.code if isinstance(result, URL) else result.__class__ for result in results], ['a', ShortenerBadUrlError, 'd', 'c'])
+        self.assertEqual([url.code for url in self.registry.urls], ['b', 'a', 'c', 'd'])
+
+        resolved = shortener.resolve_many(['c', 'x', 'a'])
+        self.assertEqual([result.url if isinstance(result, URLRecord) else result.__class__ for result in resolved], ['http://example.com/3', ShortenerIdAbsentError, 'http://example.com/1'])
+        self.assertEqual(shortener.resolve('d').url, 'http://example.com/2')
+        self.assertRaises(ShortenerIdAbsentError, shortener.resolve, 'x')
+
+    def test_addressed_collisions(self):
+        # Other process stores the same url after the candidate id is cached as absent.
+        self.storage = CachedStorage(self.storage, absent_ttl=60)
+        generator = HashGenerator(min_length=3, salt='example.com')
+        shortener = Shortener(self.storage, self.registry, generator)
+        code = next(generator.candidates('http://example.com/1'))
+        self.assertRaises(StorageItemAbsentError, self.storage.fetch, code)
+        self.storage.storage.create(lambda: URL(code=code, url='http://example.com/1'))
+        self.assertEqual(shortener.shorten('http://example.com/1').code, code)
+        self.assertEqual(self.registry.urls, [])
+
+        # Same, but the item is not visible for a while after the collision.
+        code = next(generator.candidates('http://example.com/2'))
+        self.storage.storage.create(lambda: URL(code=code, url='http://example.com/2'))
+        shortener = Shortener(WrappedStorage(LaggingStorage(self.path, 'urls', lag=3), host='example.com'), self.registry, generator)
+        self.assertEqual(shortener.shorten('http://example.com/2').code, code)
+        self.assertEqual(self.registry.urls, [])
+
+    def test_normalize_url(self):
+        self.assertEqual(normalize_url('HTTP://User@Example.COM:80'), 'http://User@example.com/')
+        self.assertEqual(normalize_url('https://example.com:8443/Path?Q'), 'https://example.com:8443/Path?Q')
+        self.assertEqual(normalize_url('http://Example.com:abc/'), 'http://example.com:abc/')
+
+    def test_dedupe(self):
+        shortener = self.make_shortener(index=WrappedStorage(SQLiteStorage(self.path, 'url_index'), host='example.com'), dedupe='unwanted')
+        first = shortener.shorten('http://example.com/1')
+        self.assertEqual(shortener.shorten('HTTP://EXAMPLE.com:80/1').code, first.code)
+        self.assertNotEqual(shortener.shorten('http://example.com/1', id_wanted='wanted').code, first.code)
+        results = shortener.shorten_many(['http://example.com/2', 'http://example.com/1', 'http://example.com:abc/', 'http://example.com/2'])
+        self.assertEqual(results[1].code, first.code)
+        self.assertEqual(results[3].code, results[0].code)
+        self.assertEqual(shortener.shorten('http://example.com:abc/').code, results[2].code)
+        self.assertEqual(len(self.registry.urls), 4) # 1, wanted, 2, and the one with the bad port.
+
+
+class RecordTest(unittest.TestCase):
+    def test_dict_protocol(self):
+        record = URLRecord(code='a1', url='http://example.com/', created_ts=1000, remote_port=12345)
+        self.assertEqual(record['url'], 'http://example.com/')
+        self.assertEqual(record.get('absent', 'default'), 'default')
+        self.assertRaises(KeyError, record.__getitem__, 'absent')
+        self.assertEqual(record.keys(), list(URLRecord.fields))
+        self.assertEqual(record.values(), [record[field] for field in URLRecord.fields])
+        self.assertEqual(dict(record)['id'], 'a1')
+        record.update(host='example.com')
+        self.assertEqual(record.shortcut, 'http://example.com/a1')
+        self.assertRaises(KeyError, record.update, absent=1)
+
+    def test_equality(self):
+        record = URLRecord(code='a1', url='http://example.com/', created_ts=1000)
+        self.assertEqual(record, URLRecord(code='a1', url='http://example.com/', created_ts=1000.0))
+        self.assertEqual(record, URL(code='a1', url='http://example.com/', created_ts=1000))
+        self.assertEqual(record, dict(record))
+        self.assertNotEqual(record, URLRecord(code='a2', url='http://example.com/'))
+        self.assertFalse(record == None)
+        self.assertTrue(record != 'a1')
@@ -1,9 +1,12 @@
 from django.conf.urls.defaults import patterns, include, url
-from .views import resolve, shorten, analytics_recent_targets, analytics_popular_domains
+from .views import resolve, shorten, resolve_many, shorten_many, storage_stats, analytics_recent_targets, analytics_popular_domains
 
 urlpatterns = patterns('',
     url(r'^resolve.(?:html|json)$', resolve),
     url(r'^shorten.(?:html|json)$', shorten),
+    url(r'^resolve_many.json$', resolve_many),
+    url(r'^shorten_many.json$', shorten_many),
+    url(r'^stats.json$', storage_stats),
     url(r'^analytics/recent_targets.(?:html|json)$' , analytics_recent_targets ),
     url(r'^analytics/popular_domains.(?:html|json)$', analytics_popular_domains),
     url(r'', 'django.views.defaults.page_not_found'),
@@ -1,9 +1,16 @@
 # coding: utf-8
 import datetime
-from .decorators import with_profile, as_json, as_html, as_redirector
-from .setup import make_analytics, make_shortener
+import itertools
+import json
+from .decorators import with_profile, as_json, as_html, as_redirector, internal_only
+from .setup import make_analytics, make_shortener, STORAGE_METRICS
 from lib.shortener import ShortenerIdAbsentError
 from django.http import Http404
+from django.views.decorators.csrf import csrf_exempt
+
+
+# The limit on the number of urls or ids in one batch request, to keep the request time sane.
+BATCH_LIMIT = 10000
 
 
 @as_redirector()
@@ -43,6 +50,77 @@ def shorten(request):
         'shortened': shortened,
     }
 
+def parse_batch(request):
+    """
+    Extracts the list of strings from the body of the batch request (a JSON list).
+    """
+    if request.method != 'POST': raise ValueError("The list must be POSTed as JSON.")
+    items = json.loads(request.raw_post_data)
+    if not isinstance(items, list): raise ValueError("The list must be POSTed as JSON.")
+    if len(items) > BATCH_LIMIT: raise ValueError("No more than %s items per request." % BATCH_LIMIT)
+    return items
+
+def batch_result(result):
+    # Per-item errors are reported as the whole-request errors are (see as_json).
+    return {'exception': unicode(result)} if isinstance(result, Exception) else result
+
+@csrf_exempt
+@as_json
+@with_profile
+def resolve_many(request):
+    ids = parse_batch(request)
+
+    shortener = make_shortener(request)
+    resolved = shortener.resolve_many(ids)
+    return {
+        'resolved': map(batch_result, resolved),
+    }
+
+@csrf_exempt
+@as_json
+@with_profile
+def shorten_many(request):
+    urls = parse_batch(request)
+
+    shortener = make_shortener(request)
+    shortened = shortener.shorten_many(urls,
+                                    remote_addr=request.META.get('REMOTE_ADDR'),
+                                    remote_port=request.META.get('REMOTE_PORT'))
+    return {
+        'shortened': map(batch_result, shortened),
+    }
+
+def collect_stats(storage):
+    """
+    Collects the stats of the storage and of all the storages it wraps, by their class names.
+    """
+    stats = {}
+    def add(name, values):
+        # The same class can be there few times (e.g., process-local & shared caches).
+        numbered = name
+        for index in itertools.count(2):
+            if numbered not in stats: break
+            numbered = '%s%d' % (name, index)
+        stats[numbered] = values
+
+    while storage is not None:
+        if hasattr(storage, 'stats'):
+            add(storage.__class__.__name__, storage.stats())
+        if hasattr(storage, 'pool'):
+            add(storage.pool.__class__.__name__, storage.pool.stats())
+        storage = getattr(storage, 'storage', None)
+    return stats
+
+@as_json
+@internal_only
+@with_profile
+def storage_stats(request):
+    shortener = make_shortener(request)
+    return {
+        'urls': collect_stats(shortener.storage),
+        'metrics': STORAGE_METRICS.snapshot(), # of all the tables, if the storages are instrumented.
+    }
+
 @as_json
 @as_html('v1/recent_targets.html')
 @with_profile